@@ -0,0 +1,149 @@
+from __future__ import annotations
+
+import argparse
+import multiprocessing
+import os
+import smtplib
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import List
+
+from twisted.internet import defer, reactor, threads
+
+from smtp_relay.blobs import BlobStore
+from smtp_relay.config import RelayConfig
+from smtp_relay.delivery import DeliveryScheduler
+from smtp_relay.offload import Offloader
+from smtp_relay.smtp_server import RelaySMTPFactory
+from smtp_relay.spool import Spool
+from smtp_relay.store import MessageStore
+
+
+class _NullPool:
+    def send(self, from_addr, to_addrs, open_message, trace=None):  # type: ignore[no-untyped-def]
+        return defer.succeed(None)
+
+
+def _build_parser() -> argparse.ArgumentParser:
+    p = argparse.ArgumentParser(
+        description="Compare small-message SMTP latency with and without the offload "
+                    "pool while large messages are being received.")
+    p.add_argument("--sessions", type=int, default=50, help="small-message sessions")
+    p.add_argument("--messages", type=int, default=20, help="messages per small session")
+    p.add_argument("--size", type=int, default=2048, help="small body size in bytes")
+    p.add_argument("--large-sessions", type=int, default=4)
+    p.add_argument("--large-messages", type=int, default=3,
+                   help="messages per large session (every other one malformed)")
+    p.add_argument("--large-size", type=int, default=4 * 1024 * 1024)
+    p.add_argument("--threads", type=int, default=4, help="offload threads for the pooled run")
+    p.add_argument("--processes", type=int, default=0,
+                   help="offload processes for the pooled run")
+    p.add_argument("--threshold", type=int, default=256 * 1024)
+    return p
+
+
+def _config(port: int) -> RelayConfig:
+    return RelayConfig(
+        smtp_listen_host="127.0.0.1", smtp_listen_port=port,
+        http_listen_host="127.0.0.1", http_listen_port=8080,
+        gmail_host="unused", gmail_port=587,
+        gmail_username="bench@example.com", gmail_app_password="unused",
+        relay_from="bench@example.com", forward_to=["bench@example.com"],
+        allow_any_rcpt=True, add_x_headers=True, max_store=10_000,
+        max_connections=100_000, max_connections_per_peer=100_000,
+        dedup_window=0,
+    )
+
+
+def _small(port: int, index: int, messages: int, body: bytes) -> List[float]:
+    latencies = []
+    with smtplib.SMTP("127.0.0.1", port, timeout=120) as s:
+        for n in range(messages):
+            started = time.perf_counter()
+            s.sendmail(f"s{index}@example.com", [f"r{index}@example.com"],
+                       b"Subject: small %d-%d\r\n\r\n" % (index, n) + body)
+            latencies.append(time.perf_counter() - started)
+    return latencies
+
+
+def _large(port: int, index: int, messages: int, body: bytes) -> None:
+    with smtplib.SMTP("127.0.0.1", port, timeout=600) as s:
+        for n in range(messages):
+            # A header line without a colon sends it through MIME repair.
+            head = b"not a header\r\n" if n % 2 == 0 else b""
+            s.sendmail(f"big{index}@example.com", ["r@example.com"],
+                       b"Subject: large %d-%d\r\n" % (index, n) + head + b"\r\n" + body)
+
+
+def _small_sessions(port: int, sessions: int, messages: int, body: bytes) -> List[float]:
+    with ThreadPoolExecutor(sessions) as ex:
+        runs = [ex.submit(_small, port, i, messages, body) for i in range(sessions)]
+        return [x for r in runs for x in r.result()]
+
+
+def _large_sessions(port: int, sessions: int, messages: int, body: bytes) -> None:
+    with ThreadPoolExecutor(sessions) as ex:
+        for r in [ex.submit(_large, port, i, messages, body) for i in range(sessions)]:
+            r.result()
+
+
+def _pct(values: List[float], q: float) -> float:
+    return values[min(len(values) - 1, int(q * len(values)))] * 1000
+
+
+@defer.inlineCallbacks
+def _run(args: argparse.Namespace, label: str, offload: Offloader):  # type: ignore[no-untyped-def]
+    with tempfile.TemporaryDirectory() as tmp:
+        cfg = _config(0)
+        store = MessageStore(max_store=10_000)
+        spool = Spool(os.path.join(tmp, "spool"))
+        blobs = BlobStore(os.path.join(tmp, "blobs"), 1 << 40)
+        offload.start()
+        scheduler = DeliveryScheduler(cfg, store, spool, _NullPool(), reactor,  # type: ignore[arg-type]
+                                      blobs=blobs, offload=offload)
+        factory = RelaySMTPFactory(cfg, store, spool, scheduler, offload=offload)
+        port = reactor.listenTCP(0, factory, interface="127.0.0.1", backlog=1024)
+        n = port.getHost().port
+        small = b"x" * args.size + b"\r\n"
+        large = (b"y" * 998 + b"\r\n") * (args.large_size // 1000)
+
+        # Clients run in their own processes so they do not compete with
+        # the relay for the GIL.
+        clients = ProcessPoolExecutor(2, mp_context=multiprocessing.get_context("spawn"))
+        started = time.perf_counter()
+        results = yield defer.gatherResults([
+            threads.deferToThread(clients.submit(
+                _large_sessions, n, args.large_sessions, args.large_messages, large).result),
+            threads.deferToThread(clients.submit(
+                _small_sessions, n, args.sessions, args.messages, small).result),
+        ], consumeErrors=True)
+        elapsed = time.perf_counter() - started
+        clients.shutdown()
+        yield port.stopListening()
+        offload.stop()
+
+    latencies = sorted(results[1])
+    print(f"{label:>8}: {len(latencies)} small messages in {elapsed:.2f}s; "
+          f"p50 {_pct(latencies, 0.5):.1f} ms, p99 {_pct(latencies, 0.99):.1f} ms, "
+          f"max {latencies[-1] * 1000:.1f} ms")
+
+
+@defer.inlineCallbacks
+def _bench(args: argparse.Namespace):  # type: ignore[no-untyped-def]
+    yield _run(args, "inline", Offloader(reactor=reactor))
+    yield _run(args, "pooled", Offloader(args.threshold, args.threads, args.processes,
+                                         reactor))
+
+
+def main() -> int:
+    args = _build_parser().parse_args()
+    d = _bench(args)
+    d.addErrback(lambda f: f.printTraceback())
+    d.addBoth(lambda _: reactor.stop())
+    reactor.run()
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
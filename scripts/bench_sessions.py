@@ -0,0 +1,81 @@
+from __future__ import annotations
+
+import argparse
+import smtplib
+import tempfile
+import time
+
+from twisted.internet import defer, reactor, threads
+
+from smtp_relay.config import RelayConfig
+from smtp_relay.smtp_server import RelaySMTPFactory
+from smtp_relay.spool import Spool
+from smtp_relay.store import MessageStore
+
+
+class _NullScheduler:
+    def submit(self, entry, message_id, malformed=False, size_bytes=0, sha256=None,  # type: ignore[no-untyped-def]
+               trace=None):
+        pass
+
+
+def _build_parser() -> argparse.ArgumentParser:
+    p = argparse.ArgumentParser(
+        description="Measure SMTP ingest throughput with many concurrent sessions.")
+    p.add_argument("--sessions", type=int, default=200)
+    p.add_argument("--messages", type=int, default=5, help="messages per session")
+    p.add_argument("--size", type=int, default=2048, help="body size in bytes")
+    return p
+
+
+def _config(port: int) -> RelayConfig:
+    return RelayConfig(
+        smtp_listen_host="127.0.0.1", smtp_listen_port=port,
+        http_listen_host="127.0.0.1", http_listen_port=8080,
+        gmail_host="unused", gmail_port=587,
+        gmail_username="bench@example.com", gmail_app_password="unused",
+        relay_from="bench@example.com", forward_to=["bench@example.com"],
+        allow_any_rcpt=True, add_x_headers=True, max_store=1000,
+        max_connections=100_000, max_connections_per_peer=100_000,
+    )
+
+
+def _session(port: int, index: int, messages: int, body: bytes) -> None:
+    with smtplib.SMTP("127.0.0.1", port, timeout=60) as s:
+        for n in range(messages):
+            s.sendmail(f"s{index}@example.com", [f"r{index}-{n}@example.com"],
+                       b"Subject: bench %d-%d\r\n\r\n" % (index, n) + body)
+
+
+@defer.inlineCallbacks
+def _bench(args: argparse.Namespace, spool_dir: str):  # type: ignore[no-untyped-def]
+    store = MessageStore(max_store=1000)
+    factory = RelaySMTPFactory(_config(0), store, Spool(spool_dir),
+                               _NullScheduler())
+    port = reactor.listenTCP(0, factory, interface="127.0.0.1", backlog=1024)
+    reactor.suggestThreadPoolSize(args.sessions)
+    body = b"x" * args.size + b"\r\n"
+    started = time.perf_counter()
+    yield defer.gatherResults([
+        threads.deferToThread(_session, port.getHost().port, i, args.messages, body)
+        for i in range(args.sessions)
+    ], consumeErrors=True)
+    elapsed = time.perf_counter() - started
+    yield port.stopListening()
+    total = store.stats().received_total
+    print(f"{total} messages over {args.sessions} sessions in {elapsed:.2f}s "
+          f"({total / elapsed:.0f} msg/s)")
+
+
+def main() -> int:
+    args = _build_parser().parse_args()
+    with tempfile.TemporaryDirectory() as spool_dir:
+        d = _bench(args, spool_dir)
+        d.addErrback(lambda f: f.printTraceback())
+        d.addBoth(lambda _: reactor.stop())
+        reactor.run()
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
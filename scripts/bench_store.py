@@ -0,0 +1,97 @@
+from __future__ import annotations
+
+import argparse
+import hashlib
+import os
+import time
+import tracemalloc
+
+from smtp_relay.models import RelayAttempt, utc_now
+from smtp_relay.sqlite_store import SqliteMessageStore
+from smtp_relay.store import MessageStore
+
+
+def _build_parser() -> argparse.ArgumentParser:
+    p = argparse.ArgumentParser(
+        description="Measure MessageStore memory and throughput at a given MAX_STORE.")
+    p.add_argument("--max-store", type=int, action="append",
+                   help="store capacity; repeatable (default: 100000 and 1000000)")
+    p.add_argument("--laps", type=float, default=1.5,
+                   help="messages inserted, as a multiple of the capacity")
+    p.add_argument("--peers", type=int, default=50)
+    p.add_argument("--db", metavar="PATH",
+                   help="also persist to a SQLite database at PATH (recreated per run)")
+    return p
+
+
+def _fill(store: MessageStore, total: int, peers: int) -> None:
+    digest = hashlib.sha256(b"x").hexdigest()
+    attempt = RelayAttempt(started_at=utc_now(), finished_at=utc_now(), ok=True,
+                           error=None)
+    for i in range(total):
+        msg_id = store.add_received(
+            peer=f"10.0.0.{i % peers}:{40000 + i % 20000}",
+            helo=f"client{i % peers}",
+            envelope_from=f"sender{i % (peers * 4)}@example.com",
+            envelope_to=["dest@example.com"],
+            subject=f"message {i}",
+            sha256=digest,
+            size_bytes=1000 + i % 5000,
+        )
+        store.set_relay_attempt(msg_id, attempt)
+
+
+def _open(max_store: int, db: str | None) -> MessageStore:
+    if not db:
+        return MessageStore(max_store)
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(db + suffix):
+            os.remove(db + suffix)
+    return SqliteMessageStore(db, max_store)
+
+
+def _bench(max_store: int, laps: float, peers: int, db: str | None) -> None:
+    total = int(max_store * laps)
+    store = _open(max_store, db)
+    started = time.perf_counter()
+    _fill(store, total, peers)
+    elapsed = time.perf_counter() - started
+    flushed = ""
+    if isinstance(store, SqliteMessageStore):
+        # Paging below only reads the in-memory ring.
+        store.close()
+        flushed = f" (written to disk after {time.perf_counter() - started:.2f}s)"
+
+    started = time.perf_counter()
+    cursor = None
+    pages = 0
+    while pages < 1000:
+        _, cursor = store.page(cursor, 50)
+        pages += 1
+    page_elapsed = time.perf_counter() - started
+    del store
+
+    # Measured separately: tracing allocations slows the fill several times.
+    tracemalloc.start()
+    store = _open(max_store, db)
+    _fill(store, total, peers)
+    if isinstance(store, SqliteMessageStore):
+        store.close()
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print(f"MAX_STORE={max_store}: {total} adds+updates in {elapsed:.2f}s "
+          f"({total / elapsed:,.0f}/s){flushed}, {current / 2 ** 20:.1f} MiB "
+          f"({current / max_store:.0f} B/message), "
+          f"{page_elapsed / pages * 1e6:.0f} us per 50-item page")
+
+
+def main() -> int:
+    args = _build_parser().parse_args()
+    for max_store in args.max_store or [100_000, 1_000_000]:
+        _bench(max_store, args.laps, args.peers, args.db)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
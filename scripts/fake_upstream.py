@@ -0,0 +1,206 @@
+from __future__ import annotations
+
+import argparse
+import datetime
+import ipaddress
+import random
+import time
+from typing import Callable, List
+
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.x509.oid import NameOID
+from twisted.cred import checkers, portal
+from twisted.internet import defer, protocol
+from twisted.internet.ssl import PrivateCertificate
+from twisted.mail import imap4, smtp
+from zope.interface import implementer
+
+# The load generator stamps each message with its send time (time.time())
+# so that end-to-end latency can be measured at the sink.
+SENT_HEADER = b"x-bench-sent:"
+
+
+def make_certificate(hostname: str = "localhost") -> bytes:
+    """A self-signed certificate and key, PEM-encoded, valid for
+    ``hostname``, localhost and 127.0.0.1."""
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, hostname)])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = (
+        x509.CertificateBuilder()
+        .subject_name(name).issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - datetime.timedelta(minutes=5))
+        .not_valid_after(now + datetime.timedelta(days=7))
+        .add_extension(x509.SubjectAlternativeName([
+            x509.DNSName(hostname), x509.DNSName("localhost"),
+            x509.IPAddress(ipaddress.ip_address("127.0.0.1")),
+        ]), critical=False)
+        .add_extension(x509.BasicConstraints(ca=True, path_length=None), critical=True)
+        .sign(key, hashes.SHA256())
+    )
+    return (cert.public_bytes(serialization.Encoding.PEM)
+            + key.private_bytes(serialization.Encoding.PEM,
+                                serialization.PrivateFormat.PKCS8,
+                                serialization.NoEncryption()))
+
+
+@implementer(smtp.IMessage)
+class _Message:
+    def __init__(self, sink: "FakeUpstream") -> None:
+        self._sink = sink
+        self._in_header = True
+        self._sent: float | None = None
+        self._size = 0
+
+    def lineReceived(self, line: bytes) -> None:
+        self._size += len(line) + 2
+        if self._in_header:
+            if not line:
+                self._in_header = False
+            elif line[:len(SENT_HEADER)].lower() == SENT_HEADER:
+                try:
+                    self._sent = float(line[len(SENT_HEADER):])
+                except ValueError:
+                    pass
+
+    def eomReceived(self) -> defer.Deferred[bytes]:
+        return self._sink._finish(self._sent, self._size)
+
+    def connectionLost(self) -> None:
+        pass
+
+
+@implementer(smtp.IMessageDelivery)
+class _Delivery:
+    def __init__(self, sink: "FakeUpstream") -> None:
+        self._sink = sink
+
+    def receivedHeader(self, helo, origin, recipients):  # type: ignore[no-untyped-def]
+        return None
+
+    def validateFrom(self, helo, origin):  # type: ignore[no-untyped-def]
+        return origin
+
+    def validateTo(self, user):  # type: ignore[no-untyped-def]
+        # Refused at RCPT: a failed end-of-data always becomes a 550 in
+        # Twisted's server, and the relay would not retry that.
+        if self._sink._reject():
+            raise smtp.SMTPBadRcpt(user, 451, "Temporary failure, try again")
+        return lambda: _Message(self._sink)
+
+
+@implementer(portal.IRealm)
+class _Realm:
+    def __init__(self, sink: "FakeUpstream") -> None:
+        self._sink = sink
+
+    def requestAvatar(self, avatarId, mind, *interfaces):  # type: ignore[no-untyped-def]
+        if smtp.IMessageDelivery in interfaces:
+            return smtp.IMessageDelivery, _Delivery(self._sink), lambda: None
+        raise NotImplementedError()
+
+
+class FakeUpstream(protocol.ServerFactory):
+    """
+    An ESMTP sink that behaves enough like a submission server for the
+    relay to talk to it: STARTTLS with the given certificate, AUTH
+    PLAIN/LOGIN against one account, then accepts every message after
+    ``latency`` seconds. A ``fail_rate`` fraction of recipients are
+    refused with a 451 instead.
+
+    ``latencies`` collects send-to-accept times for messages stamped by
+    the load generator; only accepted messages are counted.
+    """
+
+    def __init__(self, cert_pem: bytes, username: str, password: str,
+                 latency: float = 0.0, fail_rate: float = 0.0,
+                 reactor=None, clock: Callable[[], float] = time.time) -> None:  # type: ignore[no-untyped-def]
+        if reactor is None:
+            from twisted.internet import reactor
+        self._reactor = reactor
+        self._clock = clock
+        self._tls = PrivateCertificate.loadPEM(cert_pem).options()
+        checker = checkers.InMemoryUsernamePasswordDatabaseDontUse()
+        checker.addUser(username.encode("utf-8"), password.encode("utf-8"))
+        self.portal = portal.Portal(_Realm(self), [checker])
+        self.latency = latency
+        self.fail_rate = fail_rate
+        self._random = random.Random(0)
+        self.accepted = 0
+        self.rejected = 0
+        self.bytes = 0
+        self.latencies: List[float] = []
+
+    def buildProtocol(self, addr):  # type: ignore[no-untyped-def]
+        p = smtp.ESMTP({b"LOGIN": smtp.LOGINCredentials, b"PLAIN": imap4.PLAINCredentials},
+                       self._tls)
+        p.host = b"fake-upstream.example"
+        p.portal = self.portal
+        p.factory = self
+        return p
+
+    def _reject(self) -> bool:
+        if self.fail_rate and self._random.random() < self.fail_rate:
+            self.rejected += 1
+            return True
+        return False
+
+    def _finish(self, sent: float | None, size: int) -> defer.Deferred[bytes]:
+        d: defer.Deferred[bytes] = defer.Deferred()
+
+        def _reply() -> None:
+            self.accepted += 1
+            self.bytes += size
+            if sent is not None:
+                self.latencies.append(self._clock() - sent)
+            d.callback(b"Queued")
+
+        if self.latency:
+            self._reactor.callLater(self.latency, _reply)
+        else:
+            _reply()
+        return d
+
+
+def _build_parser() -> argparse.ArgumentParser:
+    p = argparse.ArgumentParser(
+        description="Run a local ESMTP sink (STARTTLS + AUTH) for GMAIL_HOST/GMAIL_PORT.")
+    p.add_argument("--host", default="127.0.0.1")
+    p.add_argument("--port", type=int, default=2587)
+    p.add_argument("--username", default="bench@example.com")
+    p.add_argument("--password", default="bench")
+    p.add_argument("--latency", type=float, default=0.0, help="seconds before each 250")
+    p.add_argument("--fail-rate", type=float, default=0.0,
+                   help="fraction of recipients refused with 451 at RCPT")
+    p.add_argument("--cert-out", default="fake-upstream.pem",
+                   help="where to write the certificate, for GMAIL_CA_FILE")
+    return p
+
+
+def main() -> int:
+    from twisted.internet import reactor, task
+
+    args = _build_parser().parse_args()
+    pem = make_certificate()
+    with open(args.cert_out, "wb") as f:
+        f.write(pem)
+    sink = FakeUpstream(pem, args.username, args.password, args.latency, args.fail_rate)
+    reactor.listenTCP(args.port, sink, interface=args.host)
+    print(f"Listening on {args.host}:{args.port}; GMAIL_HOST=localhost GMAIL_PORT={args.port} "
+          f"GMAIL_USERNAME={args.username} GMAIL_APP_PASSWORD={args.password} "
+          f"GMAIL_CA_FILE={args.cert_out}")
+
+    def _report() -> None:
+        print(f"accepted {sink.accepted}, rejected {sink.rejected}", flush=True)
+
+    task.LoopingCall(_report).start(10, now=False)
+    reactor.run()
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
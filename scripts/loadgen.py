@@ -0,0 +1,315 @@
+from __future__ import annotations
+
+import argparse
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import random
+import smtplib
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Dict, List, Tuple
+
+from twisted.internet import defer, reactor, task, threads
+
+from scripts.fake_upstream import FakeUpstream, make_certificate
+
+_UNITS = {"": 1, "k": 1024, "m": 1024 * 1024}
+
+
+def parse_sizes(raw: str) -> List[Tuple[int, float]]:
+    """``2k:80,64k:15,1m:5`` -> [(2048, 80.0), (65536, 15.0), (1048576, 5.0)]."""
+    sizes = []
+    for part in raw.split(","):
+        size, _, weight = part.strip().partition(":")
+        size = size.lower()
+        unit = size[-1:] if size[-1:] in _UNITS else ""
+        sizes.append((int(float(size[:len(size) - len(unit)]) * _UNITS[unit]),
+                      float(weight or 1)))
+    return sizes
+
+
+def _build_parser() -> argparse.ArgumentParser:
+    p = argparse.ArgumentParser(
+        description="Drive the relay with concurrent SMTP sessions against a local fake "
+                    "upstream and report throughput, latency percentiles and RSS.")
+    p.add_argument("--sessions", type=int, default=50, help="concurrent SMTP sessions")
+    p.add_argument("--messages", type=int, default=20, help="messages per session")
+    p.add_argument("--sizes", default="2k:80,64k:15,1m:5",
+                   help="message size distribution as size:weight pairs")
+    p.add_argument("--client-processes", type=int, default=2,
+                   help="processes the sessions are spread over")
+    p.add_argument("--latency", type=float, default=0.0,
+                   help="fake upstream delay before each 250, seconds")
+    p.add_argument("--fail-rate", type=float, default=0.0,
+                   help="fraction of messages the fake upstream answers with 451")
+    p.add_argument("--upstream-port", type=int, default=0,
+                   help="fake upstream port (default: any free port)")
+    p.add_argument("--relay", metavar="HOST:PORT",
+                   help="use an already running relay (with GMAIL_PORT=--upstream-port and "
+                        "GMAIL_CA_FILE=--cert) instead of starting one")
+    p.add_argument("--relay-pid", type=int, help="pid of --relay, to sample its RSS")
+    p.add_argument("--cert", help="fake upstream certificate and key (PEM); created if "
+                                  "missing, so a --relay can keep using it")
+    p.add_argument("--workers", type=int, default=0, help="--workers for the started relay")
+    p.add_argument("--env", action="append", default=[], metavar="NAME=VALUE",
+                   help="extra environment for the started relay (repeatable)")
+    p.add_argument("--timeout", type=float, default=300,
+                   help="seconds to wait for every message to reach the upstream")
+    p.add_argument("--label", default="", help="free-form tag stored with the results")
+    p.add_argument("--results", metavar="PATH",
+                   help="append the results as one JSON line to PATH ('-' for stdout)")
+    return p
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _body(size: int) -> bytes:
+    line = b"x" * 76 + b"\r\n"
+    return line * (size // len(line)) + b"y" * (size % len(line))
+
+
+def _session(host: str, port: int, index: int, sizes: List[int]) -> Tuple[List[float], int]:
+    latencies = []
+    errors = 0
+    try:
+        with smtplib.SMTP(host, port, timeout=300) as s:
+            for n, size in enumerate(sizes):
+                sent = time.time()
+                head = (b"Subject: load %d-%d\r\nX-Bench-Sent: %.6f\r\n\r\n"
+                        % (index, n, sent))
+                try:
+                    s.sendmail(f"load{index}@example.com", ["sink@example.com"],
+                               head + _body(size))
+                except smtplib.SMTPResponseException:
+                    errors += 1
+                    continue
+                latencies.append(time.time() - sent)
+    except (OSError, smtplib.SMTPException):
+        errors += len(sizes) - len(latencies)
+    return latencies, errors
+
+
+def _sessions(host: str, port: int, plans: List[Tuple[int, List[int]]]) -> Tuple[List[float], int]:
+    with ThreadPoolExecutor(len(plans)) as ex:
+        runs = [ex.submit(_session, host, port, index, sizes) for index, sizes in plans]
+        latencies: List[float] = []
+        errors = 0
+        for r in runs:
+            got, failed = r.result()
+            latencies.extend(got)
+            errors += failed
+        return latencies, errors
+
+
+def _rss(pid: int) -> int | None:
+    # Resident memory of ``pid`` and its children (--workers), Linux only.
+    total = 0
+    pending = [pid]
+    try:
+        while pending:
+            p = pending.pop()
+            with open(f"/proc/{p}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1]) * 1024
+            with open(f"/proc/{p}/task/{p}/children") as f:
+                pending.extend(int(c) for c in f.read().split())
+    except (OSError, ValueError):
+        return total or None
+    return total
+
+
+def _summary(values: List[float]) -> Dict[str, float | None]:
+    if not values:
+        return {"p50_ms": None, "p95_ms": None, "p99_ms": None, "max_ms": None}
+    values = sorted(values)
+
+    def pct(q: float) -> float:
+        return round(values[min(len(values) - 1, int(q * len(values)))] * 1000, 2)
+
+    return {"p50_ms": pct(0.5), "p95_ms": pct(0.95), "p99_ms": pct(0.99),
+            "max_ms": round(values[-1] * 1000, 2)}
+
+
+def _wait_for_port(host: str, port: int, proc: subprocess.Popen | None) -> None:
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if proc is not None and proc.poll() is not None:
+            raise RuntimeError(f"relay exited with status {proc.returncode}")
+        try:
+            socket.create_connection((host, port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"relay did not start listening on {host}:{port}")
+
+
+def _start_relay(args: argparse.Namespace, tmp: str, upstream_port: int,
+                 cert_path: str, username: str, password: str) -> Tuple[subprocess.Popen, int]:
+    smtp_port = _free_port()
+    env = dict(os.environ)
+    env.update({
+        "GMAIL_HOST": "localhost", "GMAIL_PORT": str(upstream_port),
+        "GMAIL_USERNAME": username, "GMAIL_APP_PASSWORD": password,
+        "GMAIL_CA_FILE": cert_path, "FORWARD_TO": "sink@example.com",
+        "SMTP_LISTEN_PORT": str(smtp_port), "HTTP_LISTEN_PORT": str(_free_port()),
+        "SPOOL_DIR": os.path.join(tmp, "spool"),
+        "DEDUP_WINDOW": "0", "RETRY_BASE_DELAY": "1",
+        "MAX_CONNECTIONS": "100000", "MAX_CONNECTIONS_PER_PEER": "100000",
+    })
+    for item in args.env:
+        name, _, value = item.partition("=")
+        env[name] = value
+    cmd = [sys.executable, "-m", "smtp_relay.main"]
+    if args.workers:
+        cmd += ["--workers", str(args.workers)]
+    proc = subprocess.Popen(cmd, env=env, stdout=subprocess.DEVNULL,
+                            stderr=open(os.path.join(tmp, "relay.log"), "wb"))
+    return proc, smtp_port
+
+
+@defer.inlineCallbacks
+def _run(args: argparse.Namespace, tmp: str):  # type: ignore[no-untyped-def]
+    username, password = "bench@example.com", "bench"
+    cert_path = args.cert or os.path.join(tmp, "upstream.pem")
+    if os.path.exists(cert_path):
+        with open(cert_path, "rb") as f:
+            pem = f.read()
+    else:
+        pem = make_certificate()
+        with open(cert_path, "wb") as f:
+            f.write(pem)
+    sink = FakeUpstream(pem, username, password, args.latency, args.fail_rate, reactor)
+    listener = reactor.listenTCP(args.upstream_port, sink, interface="127.0.0.1")
+    upstream_port = listener.getHost().port
+
+    proc = None
+    if args.relay:
+        host, _, port_raw = args.relay.rpartition(":")
+        port, pid = int(port_raw), args.relay_pid
+    else:
+        host = "127.0.0.1"
+        proc, port = _start_relay(args, tmp, upstream_port, cert_path, username, password)
+        pid = proc.pid
+    try:
+        yield threads.deferToThread(_wait_for_port, host, port, proc)
+
+        rss_peak = [0]
+
+        def _sample() -> None:
+            if pid is not None:
+                rss_peak[0] = max(rss_peak[0], _rss(pid) or 0)
+
+        sampler = task.LoopingCall(_sample)
+        sampler.start(0.2)
+
+        rng = random.Random(1)
+        choices = parse_sizes(args.sizes)
+        plans = [(i, rng.choices([s for s, _ in choices], [w for _, w in choices],
+                                 k=args.messages))
+                 for i in range(args.sessions)]
+        clients = ProcessPoolExecutor(args.client_processes,
+                                      mp_context=multiprocessing.get_context("spawn"))
+        started = time.time()
+        runs = yield defer.gatherResults([
+            threads.deferToThread(clients.submit(_sessions, host, port,
+                                                 plans[k::args.client_processes]).result)
+            for k in range(args.client_processes)
+        ], consumeErrors=True)
+        ingest_seconds = time.time() - started
+        clients.shutdown()
+        accept = [x for latencies, _ in runs for x in latencies]
+        errors = sum(failed for _, failed in runs)
+
+        deadline = started + ingest_seconds + args.timeout
+        while sink.accepted < len(accept) and time.time() < deadline:
+            yield task.deferLater(reactor, 0.05, lambda: None)
+        delivered_seconds = time.time() - started
+        sampler.stop()
+        _sample()
+    finally:
+        if proc is not None:
+            proc.terminate()
+            yield threads.deferToThread(proc.wait)
+            if sink.accepted < len(accept):
+                with open(os.path.join(tmp, "relay.log"), "rb") as f:
+                    tail = f.read()[-4000:].decode("utf-8", errors="replace")
+                print(f"Not everything was delivered; end of the relay log:\n{tail}",
+                      file=sys.stderr)
+        yield listener.stopListening()
+
+    sent_bytes = sum(sum(sizes) for _, sizes in plans)
+    return {
+        "label": args.label,
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "params": {
+            "sessions": args.sessions, "messages": args.messages, "sizes": args.sizes,
+            "latency": args.latency, "fail_rate": args.fail_rate, "workers": args.workers,
+            "env": args.env,
+        },
+        "messages": args.sessions * args.messages,
+        "bytes": sent_bytes,
+        "accepted": len(accept),
+        "errors": errors,
+        "delivered": sink.accepted,
+        "upstream_rejected": sink.rejected,
+        "ingest_seconds": round(ingest_seconds, 3),
+        "ingest_msgs_per_sec": round(len(accept) / ingest_seconds, 1),
+        "delivered_msgs_per_sec": round(sink.accepted / delivered_seconds, 1),
+        "accept_latency": _summary(accept),
+        "end_to_end_latency": _summary(sink.latencies),
+        "rss_peak_bytes": rss_peak[0] or None,
+    }
+
+
+def _print(result: Dict) -> None:
+    def line(name: str, lat: Dict) -> str:
+        return (f"{name}: p50 {lat['p50_ms']} ms, p95 {lat['p95_ms']} ms, "
+                f"p99 {lat['p99_ms']} ms, max {lat['max_ms']} ms")
+
+    rss = result["rss_peak_bytes"]
+    print(f"{result['accepted']}/{result['messages']} accepted ({result['errors']} errors) in "
+          f"{result['ingest_seconds']}s: {result['ingest_msgs_per_sec']} msg/s", file=sys.stderr)
+    print(f"{result['delivered']} delivered ({result['upstream_rejected']} upstream 451s): "
+          f"{result['delivered_msgs_per_sec']} msg/s", file=sys.stderr)
+    print(line("accept", result["accept_latency"]), file=sys.stderr)
+    print(line("end-to-end", result["end_to_end_latency"]), file=sys.stderr)
+    print(f"relay peak RSS: {rss / 1048576:.1f} MiB" if rss else "relay peak RSS: unknown",
+          file=sys.stderr)
+
+
+def main() -> int:
+    args = _build_parser().parse_args()
+    parse_sizes(args.sizes)
+    outcome: Dict = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        d = _run(args, tmp)
+        d.addCallback(outcome.update)
+        d.addErrback(lambda f: f.printTraceback())
+        d.addBoth(lambda _: reactor.stop())
+        reactor.run()
+    if not outcome:
+        return 1
+    _print(outcome)
+    if args.results == "-":
+        print(json.dumps(outcome))
+    elif args.results:
+        with open(args.results, "a") as f:
+            f.write(json.dumps(outcome) + "\n")
+    return 0 if outcome["delivered"] >= outcome["accepted"] else 1
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,105 @@
+from __future__ import annotations
+
+from typing import Dict, Set
+
+from twisted.internet.interfaces import IPushProducer
+from twisted.mail import smtp
+
+from .config import RelayConfig
+from .store import MessageStore
+
+
+class AdmissionController:
+    """
+    Caps concurrent SMTP sessions (total and per peer IP) and the amount of
+    accepted-but-undelivered mail. While the relay queue is full, new
+    transactions get a 451 and every session's transport stops reading.
+    """
+
+    def __init__(self, cfg: RelayConfig, store: MessageStore | None = None) -> None:
+        self._cfg = cfg
+        self._store = store
+        self._per_peer: Dict[str, int] = {}
+        self._sessions: Set[IPushProducer] = set()
+        self._inflight = 0
+        self._queued_bytes = 0
+        self._paused = False
+        self._publish()
+
+    def connections(self) -> int:
+        return len(self._sessions)
+
+    def inflight(self) -> int:
+        return self._inflight
+
+    def queued_bytes(self) -> int:
+        return self._queued_bytes
+
+    def paused(self) -> bool:
+        return self._paused
+
+    def full(self) -> bool:
+        return (self._inflight >= self._cfg.max_inflight_relays
+                or self._queued_bytes >= self._cfg.max_queued_bytes)
+
+    def open_session(self, host: str, transport: IPushProducer) -> bytes | None:
+        """
+        Register a new session, or return the 421 reason it is refused with.
+        """
+        if len(self._sessions) >= self._cfg.max_connections:
+            return b"Too many connections, try again later"
+        if self._per_peer.get(host, 0) >= self._cfg.max_connections_per_peer:
+            return b"Too many connections from your address, try again later"
+        if self.full():
+            return b"Relay queue is full, try again later"
+        self._per_peer[host] = self._per_peer.get(host, 0) + 1
+        self._sessions.add(transport)
+        if self._paused:
+            transport.pauseProducing()
+        self._publish()
+        return None
+
+    def close_session(self, host: str, transport: IPushProducer) -> None:
+        if transport not in self._sessions:
+            return
+        self._sessions.discard(transport)
+        left = self._per_peer.get(host, 0) - 1
+        if left > 0:
+            self._per_peer[host] = left
+        else:
+            self._per_peer.pop(host, None)
+        self._publish()
+
+    def check_mail(self) -> None:
+        if self.full():
+            raise smtp.SMTPServerError(451, "Relay queue is full, try again later")
+
+    def relay_started(self, size: int) -> None:
+        self._inflight += 1
+        self._queued_bytes += size
+        self._update()
+
+    def relay_finished(self, size: int) -> None:
+        self._inflight -= 1
+        self._queued_bytes -= size
+        self._update()
+
+    def _update(self) -> None:
+        full = self.full()
+        if full and not self._paused:
+            self._paused = True
+            for transport in self._sessions:
+                transport.pauseProducing()
+        elif not full and self._paused:
+            self._paused = False
+            for transport in list(self._sessions):
+                transport.resumeProducing()
+        self._publish()
+
+    def _publish(self) -> None:
+        if self._store is None:
+            return
+        self._store.set_gauge("smtp_connections", len(self._sessions))
+        self._store.set_gauge("relays_inflight", self._inflight)
+        self._store.set_gauge("queued_bytes", self._queued_bytes)
+        self._store.set_gauge("ingest_paused", int(self._paused))
@@ -0,0 +1,222 @@
+from __future__ import annotations
+
+import json
+import re
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List
+
+from twisted.internet import defer
+from twisted.python import log
+from twisted.python.failure import Failure
+from twisted.web.resource import Resource
+from twisted.web.server import NOT_DONE_YET, Request
+
+from .models import StoredMessage
+from .store import STATUSES, MessageStore
+
+DEFAULT_PAGE = 50
+MAX_PAGE = 500
+
+_DURATION_RE = re.compile(r"^(\d+)([smhd])$")
+_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+# query parameter -> MessageStore.query() keyword
+_TEXT_FILTERS = {"status": "status", "from": "sender", "to": "recipient",
+                 "peer": "peer", "q": "text"}
+
+
+def _dt(dt: datetime | None) -> str | None:
+    return dt.isoformat() if dt is not None else None
+
+
+def message_json(m: StoredMessage) -> Dict[str, Any]:
+    attempt = m.relay_attempt
+    return {
+        "id": m.message_id,
+        "status": m.status,
+        "received_at": _dt(m.received_at),
+        "peer": m.peer,
+        "helo": m.helo,
+        "envelope_from": m.envelope_from,
+        "envelope_to": m.envelope_to,
+        "subject": m.subject,
+        "size_bytes": m.size_bytes,
+        "sha256": m.sha256,
+        "duplicate_of": m.duplicate_of,
+        "relay": None if attempt is None else {
+            "ok": attempt.ok,
+            "started_at": _dt(attempt.started_at),
+            "finished_at": _dt(attempt.finished_at),
+            "error": attempt.error,
+            "stages": [[stage, round(seconds, 6)] for stage, seconds in m.trace],
+        },
+    }
+
+
+def _json(request: Request, payload: Any, code: int = 200) -> bytes:
+    request.setResponseCode(code)
+    request.setHeader(b"content-type", b"application/json")
+    return json.dumps(payload).encode("utf-8")
+
+
+def render_deferred(request: Request, d: defer.Deferred[Any]) -> Any:
+    """
+    The render_GET result for a body (or NOT_DONE_YET) that ``d`` fires
+    with. A Deferred that already fired, as reads from memory do, is
+    returned inline; otherwise the request is finished when it fires.
+    """
+    fired: List[Any] = []
+    lost: List[Failure] = []
+
+    def _first(result: Any) -> Any:
+        if not fired:
+            fired.append(result)
+        return result
+
+    d.addBoth(_first)
+    if fired:
+        if isinstance(fired[0], Failure):
+            fired[0].raiseException()
+        return fired[0]
+
+    def _finish(body: Any) -> None:
+        if lost or body is NOT_DONE_YET:
+            return
+        request.write(body)
+        request.finish()
+
+    def _failed(failure: Failure) -> None:
+        log.err(failure, "Failed to render " + request.uri.decode("utf-8", "replace"))
+        if not lost:
+            request.setResponseCode(500)
+            request.setHeader(b"content-type", b"text/plain; charset=utf-8")
+            request.write(b"internal error\n")
+            request.finish()
+
+    request.notifyFinish().addErrback(lost.append)
+    d.addCallbacks(_finish, _failed)
+    return NOT_DONE_YET
+
+
+def int_arg(request: Request, name: str) -> int | None:
+    raw = request.args.get(name.encode("ascii"))
+    if not raw:
+        return None
+    value = int(raw[0])
+    if value < 1:
+        raise ValueError(f"{name} must be >= 1")
+    return value
+
+
+def _time_arg(request: Request, name: str) -> datetime | None:
+    raw = request.args.get(name.encode("ascii"))
+    if not raw:
+        return None
+    value = raw[0].decode("utf-8", errors="replace").strip()
+    m = _DURATION_RE.match(value)
+    if m:
+        ago = timedelta(seconds=int(m.group(1)) * _UNITS[m.group(2)])
+        return datetime.now(timezone.utc) - ago
+    try:
+        dt = datetime.fromisoformat(value)
+    except ValueError:
+        raise ValueError(f"{name} must be a duration like 30m or an ISO timestamp")
+    return dt if dt.tzinfo else dt.replace(tzinfo=timezone.utc)
+
+
+def filter_args(request: Request) -> Dict[str, Any]:
+    """
+    Message filters from the query string, as MessageStore.query() keywords.
+    ``since``/``until`` take a duration ago (90s, 30m, 1h, 2d) or an ISO
+    timestamp. Raises ValueError on bad input.
+    """
+    filters: Dict[str, Any] = {}
+    for arg, key in _TEXT_FILTERS.items():
+        raw = request.args.get(arg.encode("ascii"))
+        if raw and raw[0].strip():
+            filters[key] = raw[0].decode("utf-8", errors="replace").strip()
+    status = filters.get("status")
+    if status is not None and status.upper() not in STATUSES:
+        raise ValueError("status must be one of " + ", ".join(STATUSES))
+    for name in ("since", "until"):
+        dt = _time_arg(request, name)
+        if dt is not None:
+            filters[name] = dt
+    return filters
+
+
+class ApiRoot(Resource):
+    isLeaf = False
+
+    def __init__(self, store: MessageStore) -> None:
+        super().__init__()
+        self.putChild(b"stats", ApiStats(store))
+        self.putChild(b"messages", ApiMessages(store))
+
+
+class ApiStats(Resource):
+    isLeaf = True
+
+    def __init__(self, store: MessageStore) -> None:
+        super().__init__()
+        self._store = store
+
+    def render_GET(self, request: Request) -> bytes:
+        s = self._store.stats()
+        return _json(request, {
+            "started_at": _dt(s.started_at),
+            "received_total": s.received_total,
+            "relayed_ok_total": s.relayed_ok_total,
+            "relayed_fail_total": s.relayed_fail_total,
+            "duplicate_total": s.duplicate_total,
+            "stored_count": s.stored_count,
+            "last_seq": self._store.last_seq(),
+            "gauges": s.gauges,
+        })
+
+
+class ApiMessages(Resource):
+    isLeaf = False
+
+    def __init__(self, store: MessageStore) -> None:
+        super().__init__()
+        self._store = store
+
+    def getChild(self, path: bytes, request: Request) -> Resource:
+        if path == b"":
+            return self
+        return ApiMessage(self._store, path.decode("utf-8", errors="replace"))
+
+    def render_GET(self, request: Request) -> bytes:
+        try:
+            cursor = int_arg(request, "cursor")
+            limit = min(int_arg(request, "limit") or DEFAULT_PAGE, MAX_PAGE)
+            filters = filter_args(request)
+        except ValueError as exc:
+            return _json(request, {"error": str(exc)}, 400)
+        return render_deferred(request, self._store.fetch_page(cursor, limit, **filters)
+                               .addCallback(self._render, request))
+
+    def _render(self, page: tuple, request: Request) -> bytes:
+        items, next_cursor = page
+        return _json(request, {
+            "messages": [message_json(m) for m in items],
+            "next_cursor": next_cursor,
+        })
+
+
+class ApiMessage(Resource):
+    isLeaf = True
+
+    def __init__(self, store: MessageStore, message_id: str) -> None:
+        super().__init__()
+        self._store = store
+        self._id = message_id
+
+    def render_GET(self, request: Request) -> bytes | int:
+        return render_deferred(request, self._store.fetch(self._id)
+                               .addCallback(self._render, request))
+
+    def _render(self, item: StoredMessage | None, request: Request) -> bytes:
+        if item is None:
+            return _json(request, {"error": "not found"}, 404)
+        return _json(request, message_json(item))
@@ -1,31 +1,170 @@
 from __future__ import annotations
 
+import os
+from typing import Callable, List, Sequence
+
 from twisted.internet import reactor
 from twisted.python import log
 
+from .admission import AdmissionController
+from .blobs import BlobStore
 from .config import RelayConfig
-from .http_server import make_site
+from .dedup import DedupCache
+from .delivery import DeliveryScheduler
+from .http_server import MetricsSources, make_site
+from .metrics import Metrics
+from .offload import Offloader
+from .routing import RoutingTable
 from .smtp_server import RelaySMTPFactory
+from .spool import Spool
 from .store import MessageStore
+from .upstreams import UpstreamBalancer
+
+
+def _start_logging() -> None:
+    log.startLogging(open("/dev/stdout", "w"))  # type: ignore[arg-type]
+
+
+def _open_store(cfg: RelayConfig) -> MessageStore:
+    if not cfg.store_db:
+        return MessageStore(cfg.max_store)
+    from .sqlite_store import SqliteMessageStore
+
+    store = SqliteMessageStore(cfg.store_db, cfg.max_store, cfg.store_retention_days,
+                               cfg.store_retention_rows)
+    reactor.addSystemEventTrigger("after", "shutdown", store.close)
+    return store
+
+
+def _open_blobs(cfg: RelayConfig) -> BlobStore | None:
+    if not cfg.blob_dir:
+        return None
+    return BlobStore(cfg.blob_dir, cfg.blob_max_bytes)
+
+
+def _worker_spools(spool_dir: str, first: int) -> List[str]:
+    # Spools of worker-<n> for n >= first: left behind by an earlier run
+    # with more workers, or with any when running as a single process.
+    found = []
+    for name in sorted(os.listdir(spool_dir)) if os.path.isdir(spool_dir) else ():
+        prefix, _, n = name.partition("-")
+        if prefix == "worker" and n.isdigit() and int(n) >= first:
+            found.append(os.path.join(spool_dir, name))
+    return found
+
+
+def _start_smtp(
+    cfg: RelayConfig,
+    store: MessageStore,
+    metrics: Metrics,
+    spool_dir: str,
+    listen: Callable[[RelaySMTPFactory], object],
+    blobs: BlobStore | None = None,
+    orphans: Sequence[str] = (),
+) -> None:
+    sender = UpstreamBalancer(cfg, reactor)
+    reactor.addSystemEventTrigger("before", "shutdown", sender.close)
+    store.add_gauge_source(sender.gauges)
+
+    admission = AdmissionController(cfg, store)
+    spool = Spool(spool_dir, cfg.spill_threshold)
+    for orphan in orphans:
+        adopted = spool.adopt(orphan)
+        if adopted:
+            log.msg(f"Took over {adopted} spooled message(s) from {orphan}")
+    dedup = None
+    if cfg.dedup_window:
+        dedup = DedupCache(cfg.dedup_window, cfg.dedup_max_entries, reactor.seconds)
+    offload = Offloader(cfg.offload_threshold, cfg.offload_threads,
+                        cfg.offload_processes, reactor)
+    offload.start()
+    routes = RoutingTable.from_config(cfg)
+    scheduler = DeliveryScheduler(cfg, store, spool, sender, reactor, admission,
+                                  metrics, blobs, dedup, offload, routes)
+    store.add_gauge_source(scheduler.timings.gauges)
+    store.add_gauge_source(scheduler.gauges)
+    recovered = scheduler.recover()
+    if recovered:
+        log.msg(f"Recovered {recovered} spooled message(s) from {spool_dir}")
+
+    listen(RelaySMTPFactory(cfg, store, spool, scheduler, admission, metrics, offload,
+                            routes))
+
+
+def _start_http(cfg: RelayConfig, store: MessageStore, metrics: Metrics,
+                sources: MetricsSources | None = None,
+                blobs: BlobStore | None = None) -> None:
+    site = make_site(store, metrics, sources, blobs)
+    reactor.listenTCP(cfg.http_listen_port, site,
+                      interface=cfg.http_listen_host)
+    log.msg(
+        f"HTTP listening on {cfg.http_listen_host}:{cfg.http_listen_port}"
+    )
 
 
 def run(cfg: RelayConfig) -> None:
-    store = MessageStore(cfg.max_store)
+    store = _open_store(cfg)
+    metrics = Metrics()
+    blobs = _open_blobs(cfg)
 
-    log.startLogging(open("/dev/stdout", "w"))  # type: ignore[arg-type]
+    _start_logging()
 
-    smtp_factory = RelaySMTPFactory(cfg, store)
-    reactor.listenTCP(cfg.smtp_listen_port, smtp_factory,
-                      interface=cfg.smtp_listen_host)
+    _start_smtp(cfg, store, metrics, cfg.spool_dir, lambda factory: reactor.listenTCP(
+        cfg.smtp_listen_port, factory, interface=cfg.smtp_listen_host), blobs,
+        _worker_spools(cfg.spool_dir, 0))
     log.msg(
         f"SMTP listening on {cfg.smtp_listen_host}:{cfg.smtp_listen_port}"
     )
 
-    site = make_site(store)
-    reactor.listenTCP(cfg.http_listen_port, site,
-                      interface=cfg.http_listen_host)
+    _start_http(cfg, store, metrics, blobs=blobs)
+
+    reactor.run()
+
+
+def run_supervisor(cfg: RelayConfig, workers: int) -> None:
+    from .workers import WorkerSupervisor, listen_socket
+
+    store = _open_store(cfg)
+
+    _start_logging()
+
+    sock = listen_socket(cfg.smtp_listen_host, cfg.smtp_listen_port)
+    supervisor = WorkerSupervisor(cfg, store, sock.fileno(), workers, reactor)
+    supervisor.start()
     log.msg(
-        f"HTTP listening on {cfg.http_listen_host}:{cfg.http_listen_port}"
+        f"SMTP listening on {cfg.smtp_listen_host}:{cfg.smtp_listen_port} "
+        f"with {workers} workers"
     )
 
+    _start_http(cfg, store, Metrics(), supervisor.metric_sources, _open_blobs(cfg))
+
+    reactor.run()
+
+
+def run_worker(cfg: RelayConfig, index: int, listen_fd: int, workers: int) -> None:
+    from twisted.internet import stdio, task
+
+    from .workers import EVENT_FD, WorkerChannel, socket_family, worker_config
+
+    cfg = worker_config(cfg, max(1, workers))
+    store = MessageStore(cfg.max_store)
+    metrics = Metrics()
+
+    _start_logging()
+
+    channel = WorkerChannel(reactor)
+    stdio.StandardIO(channel, stdin=0, stdout=EVENT_FD)
+    store.subscribe(channel.forward)
+    task.LoopingCall(channel.send_stats, store, metrics).start(1.0)
+
+    spool_dir = os.path.join(cfg.spool_dir, f"worker-{index}")
+    # Worker 0 takes over the spools of workers that are no longer started.
+    orphans = _worker_spools(cfg.spool_dir, max(1, workers)) if index == 0 else []
+    family = socket_family(listen_fd)
+    _start_smtp(cfg, store, metrics, spool_dir,
+                lambda factory: reactor.adoptStreamPort(listen_fd, family, factory),
+                _open_blobs(cfg), orphans)
+    os.close(listen_fd)
+    log.msg(f"SMTP worker {index} accepting connections")
+
     reactor.run()
@@ -0,0 +1,192 @@
+from __future__ import annotations
+
+import os
+import tempfile
+import time
+import zlib
+from collections import OrderedDict
+from typing import BinaryIO, Iterator, Tuple
+
+from twisted.python import log
+
+try:
+    import zstandard
+except ImportError:  # optional
+    zstandard = None
+
+_CHUNK = 64 * 1024
+_ZLIB = ".z"
+_ZSTD = ".zst"
+# Formats this process can read back.
+_EXTS = (_ZSTD, _ZLIB) if zstandard is not None else (_ZLIB,)
+
+
+def _compressor(ext: str):  # type: ignore[no-untyped-def]
+    if ext == _ZSTD:
+        return zstandard.ZstdCompressor(level=3).compressobj()
+    return zlib.compressobj(6)
+
+
+class BlobStore:
+    """
+    Compressed copies of raw messages, one file per distinct SHA-256 under
+    ``directory``/<first two hex digits>/. Identical payloads are stored
+    once. When the compressed total exceeds ``max_bytes`` the least
+    recently stored or read blobs are deleted.
+    """
+
+    def __init__(self, directory: str, max_bytes: int) -> None:
+        self._dir = directory
+        self._max = max_bytes
+        self._ext = _ZSTD if zstandard is not None else _ZLIB
+        self._lru: "OrderedDict[str, Tuple[str, int]]" = OrderedDict()
+        self._total = 0
+        os.makedirs(directory, exist_ok=True)
+        self._scan()
+
+    @property
+    def total_bytes(self) -> int:
+        return self._total
+
+    def __len__(self) -> int:
+        return len(self._lru)
+
+    def _scan(self) -> None:
+        found = []
+        for sub in os.listdir(self._dir):
+            subdir = os.path.join(self._dir, sub)
+            if len(sub) != 2 or not os.path.isdir(subdir):
+                continue
+            for name in os.listdir(subdir):
+                sha256, ext = os.path.splitext(name)
+                path = os.path.join(subdir, name)
+                if ext == ".tmp":
+                    # Left over from an interrupted compress(); recent ones
+                    # may belong to another worker sharing the directory.
+                    if os.stat(path).st_mtime < time.time() - 3600:
+                        os.remove(path)
+                    continue
+                if ext not in _EXTS:
+                    continue
+                st = os.stat(path)
+                found.append((st.st_mtime, sha256, path, st.st_size))
+        for _, sha256, path, size in sorted(found):
+            self._lru[sha256] = (path, size)
+            self._total += size
+
+    def _find(self, sha256: str) -> str | None:
+        known = self._lru.get(sha256)
+        if known is not None:
+            return known[0]
+        # Another process sharing the directory may have stored it.
+        base = os.path.join(self._dir, sha256[:2], sha256)
+        for ext in _EXTS:
+            if os.path.exists(base + ext):
+                return base + ext
+        return None
+
+    def __contains__(self, sha256: str) -> bool:
+        return self._find(sha256) is not None
+
+    def put(self, sha256: str, source: BinaryIO) -> bool:
+        """
+        Compress ``source`` (read to EOF) under ``sha256``. Returns False if
+        that payload was already stored.
+        """
+        if self.touch(sha256):
+            return False
+        return self.add(sha256, *self.compress(sha256, source))
+
+    def touch(self, sha256: str) -> bool:
+        """Mark a blob as recently used; False if it is not stored."""
+        if self._find(sha256) is None:
+            return False
+        if sha256 in self._lru:
+            self._lru.move_to_end(sha256)
+        return True
+
+    def compress(self, sha256: str, source: BinaryIO) -> Tuple[str, int]:
+        """
+        Write the compressed copy to a temporary file, returning its path and
+        size for add(). Touches no shared state, so it can run in a thread.
+        """
+        subdir = os.path.join(self._dir, sha256[:2])
+        os.makedirs(subdir, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(prefix=sha256, suffix=".tmp", dir=subdir)
+        comp = _compressor(self._ext)
+        size = 0
+        with os.fdopen(fd, "wb") as out:
+            chunk = source.read(_CHUNK)
+            while chunk:
+                data = comp.compress(chunk)
+                out.write(data)
+                size += len(data)
+                chunk = source.read(_CHUNK)
+            data = comp.flush()
+            out.write(data)
+            size += len(data)
+        return tmp, size
+
+    def add(self, sha256: str, tmp: str, size: int) -> bool:
+        if size > self._max or self.touch(sha256):
+            os.remove(tmp)
+            return False
+        path = os.path.join(self._dir, sha256[:2], sha256 + self._ext)
+        os.replace(tmp, path)
+        self._lru[sha256] = (path, size)
+        self._total += size
+        self._evict()
+        return True
+
+    def _evict(self) -> None:
+        while self._total > self._max and self._lru:
+            _, (path, size) = self._lru.popitem(last=False)
+            self._total -= size
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError:
+                log.err(None, f"Failed to remove blob {path}")
+
+    def chunks(self, sha256: str) -> Iterator[bytes] | None:
+        """
+        Decompressed contents of a blob, a chunk at a time, or None if it is
+        not stored. The file is opened before returning, so a blob evicted
+        afterwards can still be read to the end.
+        """
+        path = self._find(sha256)
+        if path is None:
+            return None
+        try:
+            f = open(path, "rb")
+        except FileNotFoundError:
+            return None
+        if sha256 in self._lru:
+            self._lru.move_to_end(sha256)
+        if path.endswith(_ZSTD):
+            return self._read_zstd(f)
+        return self._read_zlib(f)
+
+    @staticmethod
+    def _read_zstd(f: BinaryIO) -> Iterator[bytes]:
+        with f:
+            yield from zstandard.ZstdDecompressor().read_to_iter(
+                f, read_size=_CHUNK, write_size=_CHUNK)
+
+    @staticmethod
+    def _read_zlib(f: BinaryIO) -> Iterator[bytes]:
+        # max_length keeps each chunk bounded however well the data compressed.
+        decomp = zlib.decompressobj()
+        with f:
+            buf = f.read(_CHUNK)
+            while buf:
+                data = decomp.decompress(buf, _CHUNK)
+                if data:
+                    yield data
+                buf = decomp.unconsumed_tail or f.read(_CHUNK)
+            tail = decomp.flush()
+            if tail:
+                yield tail
+            if not decomp.eof:
+                raise zlib.error(f"Blob {f.name} is truncated")
@@ -0,0 +1,61 @@
+from __future__ import annotations
+
+import hashlib
+from collections import OrderedDict
+from typing import Callable, Tuple
+
+from .models import InboundMeta
+
+
+def dedup_key(sha256: str, meta: InboundMeta) -> bytes:
+    # Same bytes from the same sender to the same recipients, in any order.
+    h = hashlib.blake2b(digest_size=16)
+    h.update(bytes.fromhex(sha256))
+    h.update(meta.envelope_from.lower().encode("utf-8"))
+    for rcpt in sorted({r.lower() for r in meta.envelope_to}):
+        h.update(b"\0" + rcpt.encode("utf-8"))
+    return h.digest()
+
+
+class DedupCache:
+    """
+    Message ids by dedup_key() for ``window`` seconds after they were first
+    seen, capped at ``max_entries`` (oldest dropped first). Entries are kept
+    in insertion order, so expiry only ever looks at the front.
+    """
+
+    def __init__(self, window: float, max_entries: int,
+                 clock: Callable[[], float]) -> None:
+        self._window = window
+        self._max = max_entries
+        self._clock = clock
+        self._entries: "OrderedDict[bytes, Tuple[float, str]]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _expire(self, now: float) -> None:
+        entries = self._entries
+        while entries and (len(entries) > self._max
+                           or next(iter(entries.values()))[0] <= now):
+            entries.popitem(last=False)
+
+    def check(self, key: bytes, message_id: str) -> str | None:
+        """
+        The id of the message ``key`` was first seen with, if that was
+        within the window; otherwise records ``message_id`` and returns None.
+        """
+        now = self._clock()
+        self._expire(now)
+        seen = self._entries.get(key)
+        if seen is not None:
+            return seen[1]
+        self._entries[key] = (now + self._window, message_id)
+        self._expire(now)
+        return None
+
+    def forget(self, key: bytes, message_id: str) -> None:
+        # Lets a resubmission through after the first copy failed.
+        seen = self._entries.get(key)
+        if seen is not None and seen[1] == message_id:
+            del self._entries[key]
@@ -0,0 +1,288 @@
+from __future__ import annotations
+
+import random
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Dict, List, Set, Tuple
+
+from twisted.internet import defer
+from twisted.mail import smtp
+from twisted.python import log
+from twisted.python.failure import Failure
+
+from .admission import AdmissionController
+from .blobs import BlobStore
+from .config import RelayConfig
+from .dedup import DedupCache, dedup_key
+from .metrics import Metrics
+from .models import RelayAttempt, utc_now
+from .offload import Offloader
+from .pool import UpstreamPool
+from .relay_client import SendScheduler, is_permanent, parse_headers, relay_to_gmail
+from .routing import RoutingTable, Transaction
+from .spool import Spool, SpoolEntry
+from .store import MessageStore
+from .tracing import MessageTrace, StageTimings
+from .upstreams import UpstreamBalancer
+
+
+@dataclass(slots=True)
+class _Pending:
+    entry: SpoolEntry
+    message_id: str
+    malformed: bool
+    size_bytes: int = 0
+    submitted: float = 0.0
+    dedup_key: bytes | None = None
+    started_at: datetime = field(default_factory=utc_now)
+    trace: MessageTrace = field(default_factory=MessageTrace)
+    attempts: int = 0
+    transactions: List[Transaction] = field(default_factory=list)
+    # Transactions already accepted upstream; retries skip them.
+    done: Set[Transaction] = field(default_factory=set)
+
+
+# submit() arguments of a duplicate waiting on its original.
+_Duplicate = Tuple[SpoolEntry, str, bool, int, str, "MessageTrace | None"]
+
+
+class DeliveryScheduler:
+    """
+    Drains spooled messages to the upstream, as one transaction per
+    recipient route. Temporary failures are retried with exponential
+    backoff and jitter, resending only the transactions that failed; a
+    message leaves the spool once it is delivered, or is moved aside after
+    a permanent failure. A duplicate of a message still being relayed
+    stays spooled until the original is delivered (and is then dropped) or
+    fails for good (and is then relayed itself).
+    """
+
+    def __init__(
+        self,
+        cfg: RelayConfig,
+        store: MessageStore,
+        spool: Spool,
+        pool: UpstreamPool | SendScheduler | UpstreamBalancer,
+        reactor=None,  # type: ignore[no-untyped-def]
+        admission: AdmissionController | None = None,
+        metrics: Metrics | None = None,
+        blobs: BlobStore | None = None,
+        dedup: DedupCache | None = None,
+        offload: Offloader | None = None,
+        routes: RoutingTable | None = None,
+    ) -> None:
+        if reactor is None:
+            from twisted.internet import reactor
+        self._cfg = cfg
+        self._admission = admission
+        self._metrics = metrics or Metrics()
+        self._store = store
+        self._spool = spool
+        self._pool = pool
+        self._blobs = blobs
+        self._dedup = dedup
+        self._offload = offload or Offloader()
+        self._routes = routes or RoutingTable.from_config(cfg)
+        self._reactor = reactor
+        self._random = random.Random()
+        self._pending = 0
+        # Spooled messages whose queueing failed, waiting to be tried again.
+        self._requeue_waiting = 0
+        # In-flight originals by message id, with the duplicates waiting on them.
+        self._duplicates: Dict[str, List[_Duplicate]] = {}
+        self.timings = StageTimings()
+
+    def pending(self) -> int:
+        return self._pending
+
+    def submit(self, entry: SpoolEntry, message_id: str,
+               malformed: bool = False, size_bytes: int = 0,
+               sha256: str | None = None, trace: MessageTrace | None = None) -> None:
+        if self._blobs is not None and sha256 is not None:
+            self._retain(entry, sha256, size_bytes)
+        key = None
+        if self._dedup is not None and sha256 is not None:
+            key = dedup_key(sha256, entry.meta)
+            original = self._dedup.check(key, message_id)
+            if original is not None:
+                self._metrics.duplicate_messages.inc()
+                self._store.set_duplicate(message_id, original)
+                waiting = self._duplicates.get(original)
+                if waiting is None:
+                    # The original has been delivered already.
+                    self._spool.remove(entry)
+                else:
+                    waiting.append((entry, message_id, malformed, size_bytes, sha256, trace))
+                return
+            self._duplicates[message_id] = []
+        self._start(entry, message_id, malformed, size_bytes, key, trace)
+
+    def _start(self, entry: SpoolEntry, message_id: str, malformed: bool,
+               size_bytes: int, key: bytes | None, trace: MessageTrace | None) -> None:
+        self._pending += 1
+        if self._admission is not None:
+            self._admission.relay_started(size_bytes)
+        self._attempt(_Pending(entry=entry, message_id=message_id,
+                               malformed=malformed, size_bytes=size_bytes,
+                               submitted=self._reactor.seconds(), dedup_key=key,
+                               trace=trace or MessageTrace(),
+                               transactions=self._routes.split(entry.meta.envelope_to)))
+
+    def _promote(self, key: bytes | None, waiting: List[_Duplicate]) -> None:
+        # The first waiting copy becomes the original for the rest. They were
+        # counted as duplicates when they arrived, so they are not again.
+        if not waiting:
+            return
+        (entry, message_id, malformed, size_bytes, _, trace), rest = waiting[0], waiting[1:]
+        if self._dedup is not None and key is not None:
+            self._dedup.check(key, message_id)
+        self._store.relink_duplicate(message_id, None)
+        for dup in rest:
+            self._store.relink_duplicate(dup[1], message_id)
+        self._duplicates[message_id] = rest
+        self._start(entry, message_id, malformed, size_bytes, key, trace)
+
+    def _retain(self, entry: SpoolEntry, sha256: str, size_bytes: int) -> None:
+        blobs = self._blobs
+        assert blobs is not None
+        if blobs.touch(sha256):
+            return
+        try:
+            # Opened here: the spool file may be gone by the time a worker
+            # thread gets to it.
+            f = self._spool.open_body(entry)
+        except OSError as exc:
+            log.err(exc, f"Failed to keep a copy of {entry.spool_id}")
+            return
+        d = self._offload.run(size_bytes, blobs.compress, sha256, f)
+        d.addBoth(lambda result: (f.close(), result)[1])
+        d.addCallback(lambda res: blobs.add(sha256, *res))
+        d.addErrback(log.err, f"Failed to keep a copy of {entry.spool_id}")
+
+    def recover(self) -> int:
+        entries = self._spool.recover()
+        for entry in entries:
+            self._adopt(entry)
+        return len(entries)
+
+    def _adopt(self, entry: SpoolEntry) -> None:
+        headers, sha256, size = self._spool.scan(entry)
+        info = parse_headers(headers)
+        msg_id = self._store.add_received(
+            peer=entry.meta.peer,
+            helo=entry.meta.helo,
+            envelope_from=entry.meta.envelope_from,
+            envelope_to=entry.meta.envelope_to,
+            subject=info.subject,
+            sha256=sha256,
+            size_bytes=size,
+        )
+        self.submit(entry, msg_id, info.malformed, size, sha256)
+
+    def requeue(self, entry: SpoolEntry, attempts: int = 1) -> None:
+        """
+        Queue a spooled message again, as recovery would, after queueing it
+        failed; retried with backoff until that works.
+        """
+        if attempts == 1:
+            self._metrics.requeued_messages.inc()
+        self._requeue_waiting += 1
+        self._reactor.callLater(self.backoff(attempts), self._requeued, entry, attempts)
+
+    def _requeued(self, entry: SpoolEntry, attempts: int) -> None:
+        self._requeue_waiting -= 1
+        try:
+            self._adopt(entry)
+        except Exception:
+            log.err(None, f"Failed to queue spooled message {entry.spool_id}")
+            self.requeue(entry, attempts + 1)
+
+    def gauges(self) -> Dict[str, int]:
+        return {"requeue_waiting": self._requeue_waiting}
+
+    def backoff(self, attempts: int) -> float:
+        delay = min(
+            self._cfg.retry_max_delay,
+            self._cfg.retry_base_delay * 2 ** (attempts - 1),
+        )
+        return self._random.uniform(delay / 2, delay)
+
+    def _send(self, p: _Pending, tx: Transaction,
+              trace: MessageTrace) -> defer.Deferred[object]:
+        upstream, to_addrs = tx
+        d = relay_to_gmail(self._cfg, self._pool,
+                           lambda: self._spool.open_body(p.entry), p.entry.meta,
+                           p.malformed, self._offload, p.size_bytes,
+                           list(to_addrs), upstream, trace)
+        return d.addCallback(lambda result: (p.done.add(tx), result)[1])
+
+    def _relay(self, p: _Pending) -> defer.Deferred[object]:
+        if not p.transactions:
+            # Recovered from the spool after the routes changed.
+            raise smtp.SMTPDeliveryError(550, b"No route for any recipient")
+        todo = [tx for tx in p.transactions if tx not in p.done]
+        if len(todo) == 1:
+            return self._send(p, todo[0], p.trace)
+        forks = [p.trace.fork() for _ in todo]
+
+        def _combine(results: list) -> object:
+            p.trace.join(forks)
+            failures = [r for ok, r in results if not ok]
+            if not failures:
+                return None
+            # Retry while any transaction can still succeed.
+            temporary = [f for f in failures if not is_permanent(f)]
+            return (temporary or failures)[0]
+
+        return defer.DeferredList([self._send(p, tx, trace) for tx, trace in zip(todo, forks)],
+                                  consumeErrors=True).addCallback(_combine)
+
+    def _attempt(self, p: _Pending) -> None:
+        if p.attempts:
+            p.trace.mark("retry")
+        p.attempts += 1
+        d = defer.maybeDeferred(self._relay, p)
+        d.addCallbacks(self._delivered, self._failed,
+                       callbackArgs=(p,), errbackArgs=(p,))
+
+    def _finish(self, p: _Pending, ok: bool, error: str | None) -> None:
+        self._pending -= 1
+        if self._admission is not None:
+            self._admission.relay_finished(p.size_bytes)
+        self._store.set_relay_attempt(p.message_id, RelayAttempt(
+            started_at=p.started_at,
+            finished_at=utc_now(),
+            ok=ok,
+            error=error,
+        ), p.trace.stages())
+
+    def _delivered(self, _: object, p: _Pending) -> None:
+        m = self._metrics
+        m.upstream_ack_seconds.observe(self._reactor.seconds() - p.submitted)
+        m.relayed_messages.inc()
+        m.relayed_bytes.inc(p.size_bytes)
+        self.timings.add(p.trace.stages())
+        self._spool.remove(p.entry)
+        for dup in self._duplicates.pop(p.message_id, ()):
+            self._spool.remove(dup[0])
+        self._finish(p, True, None)
+
+    def _failed(self, failure: Failure, p: _Pending) -> None:
+        error = str(failure.getErrorMessage())
+        if is_permanent(failure) or p.attempts >= self._cfg.retry_max_attempts:
+            log.err(failure, "Failed to relay message to Gmail")
+            self._spool.move_to_failed(p.entry)
+            self._metrics.failed_messages.inc()
+            self._metrics.failed_bytes.inc(p.size_bytes)
+            if self._dedup is not None and p.dedup_key is not None:
+                self._dedup.forget(p.dedup_key, p.message_id)
+            self._finish(p, False, f"{error} (after {p.attempts} attempts)")
+            self._promote(p.dedup_key, self._duplicates.pop(p.message_id, []))
+            return
+        self._metrics.relay_retries.inc()
+        delay = self.backoff(p.attempts)
+        log.msg(
+            f"Relay of message {p.message_id} failed (attempt {p.attempts}), "
+            f"retrying in {delay:.0f}s: {error}"
+        )
+        self._reactor.callLater(delay, self._attempt, p)
@@ -0,0 +1,170 @@
+from __future__ import annotations
+
+import json
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Set
+
+from twisted.internet import task
+from twisted.internet.interfaces import IPushProducer
+from twisted.web.resource import Resource
+from twisted.web.server import NOT_DONE_YET, Request
+from zope.interface import implementer
+
+from .api import message_json
+from .models import StoredMessage
+from .store import MessageStore, StatsSnapshot
+
+STATS_INTERVAL = 2.0
+MAX_BUFFERED = 256
+
+
+def _frame(event: str, data: Dict[str, Any]) -> bytes:
+    return (f"event: {event}\ndata: " + json.dumps(data, separators=(",", ":"))
+            + "\n\n").encode("utf-8")
+
+
+def _stats_dict(s: StatsSnapshot) -> Dict[str, Any]:
+    return {
+        "received_total": s.received_total,
+        "relayed_ok_total": s.relayed_ok_total,
+        "relayed_fail_total": s.relayed_fail_total,
+        "duplicate_total": s.duplicate_total,
+        "stored_count": s.stored_count,
+        "gauges": dict(s.gauges),
+    }
+
+
+def _stats_delta(old: Dict[str, Any], new: Dict[str, Any]) -> Dict[str, Any]:
+    delta = {k: v for k, v in new.items() if k != "gauges" and old.get(k) != v}
+    old_gauges = old.get("gauges", {})
+    gauges = {k: v for k, v in new["gauges"].items() if old_gauges.get(k) != v}
+    if gauges:
+        delta["gauges"] = gauges
+    return delta
+
+
+@implementer(IPushProducer)
+class _Subscriber:
+    """
+    One SSE client. While its transport is backed up, events wait in a
+    bounded buffer where a newer event for the same message replaces the
+    older one and stats deltas are merged. On overflow the buffer is
+    replaced by a single "resync" event and later events are dropped.
+    """
+
+    def __init__(self, hub: "EventHub", request: Request, max_buffered: int) -> None:
+        self._hub = hub
+        self._request = request
+        self._max = max_buffered
+        self._paused = False
+        self._pending: "OrderedDict[Hashable, tuple]" = OrderedDict()
+
+    def push(self, key: Hashable, event: str, data: Dict[str, Any],
+             frame: bytes | None = None) -> None:
+        if not self._paused:
+            self._request.write(frame or _frame(event, data))
+            return
+        if "resync" in self._pending:
+            return
+        if key == "stats" and key in self._pending:
+            merged = self._pending.pop(key)[1]
+            gauges = {**merged.get("gauges", {}), **data.get("gauges", {})}
+            data = {**merged, **data}
+            if gauges:
+                data["gauges"] = gauges
+        else:
+            self._pending.pop(key, None)
+        self._pending[key] = (event, data)
+        if len(self._pending) > self._max:
+            self._pending.clear()
+            self._pending["resync"] = ("resync", {})
+
+    def keepalive(self) -> None:
+        if not self._paused:
+            self._request.write(b":\n\n")
+
+    def pauseProducing(self) -> None:
+        self._paused = True
+
+    def resumeProducing(self) -> None:
+        self._paused = False
+        pending, self._pending = self._pending, OrderedDict()
+        for event, data in pending.values():
+            self._request.write(_frame(event, data))
+
+    def stopProducing(self) -> None:
+        self._hub.remove(self)
+
+
+class EventHub:
+    """
+    Fans store changes out to SSE subscribers, plus a stats delta every
+    STATS_INTERVAL seconds while anyone is listening.
+    """
+
+    def __init__(self, store: MessageStore, clock=None,  # type: ignore[no-untyped-def]
+                 max_buffered: int = MAX_BUFFERED) -> None:
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self._store = store
+        self._max = max_buffered
+        self._subscribers: Set[_Subscriber] = set()
+        self._last: Dict[str, Any] = {}
+        self._ticker = task.LoopingCall(self._tick)
+        self._ticker.clock = clock
+        store.subscribe(self._on_change)
+
+    def subscribers(self) -> int:
+        return len(self._subscribers)
+
+    def add(self, request: Request) -> _Subscriber:
+        sub = _Subscriber(self, request, self._max)
+        self._subscribers.add(sub)
+        request.registerProducer(sub, True)
+        stats = _stats_dict(self._store.stats())
+        sub.push("stats", "stats", stats)
+        if not self._ticker.running:
+            self._last = stats
+            self._ticker.start(STATS_INTERVAL, now=False)
+        return sub
+
+    def remove(self, sub: _Subscriber) -> None:
+        self._subscribers.discard(sub)
+        if not self._subscribers and self._ticker.running:
+            self._ticker.stop()
+
+    def _on_change(self, event: str, item: StoredMessage) -> None:
+        if not self._subscribers:
+            return
+        data = message_json(item)
+        data["event"] = event
+        frame = _frame("message", data)
+        for sub in list(self._subscribers):
+            sub.push(("message", item.message_id), "message", data, frame)
+
+    def _tick(self) -> None:
+        stats = _stats_dict(self._store.stats())
+        delta = _stats_delta(self._last, stats)
+        self._last = stats
+        frame = _frame("stats", delta) if delta else None
+        for sub in list(self._subscribers):
+            if delta:
+                sub.push("stats", "stats", delta, frame)
+            else:
+                sub.keepalive()
+
+
+class EventStream(Resource):
+    isLeaf = True
+
+    def __init__(self, hub: EventHub) -> None:
+        super().__init__()
+        self._hub = hub
+
+    def render_GET(self, request: Request) -> int:
+        request.setHeader(b"content-type", b"text/event-stream; charset=utf-8")
+        request.setHeader(b"cache-control", b"no-cache")
+        request.setHeader(b"x-accel-buffering", b"no")
+        sub = self._hub.add(request)
+        request.notifyFinish().addBoth(lambda _: self._hub.remove(sub))
+        return NOT_DONE_YET
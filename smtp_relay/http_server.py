@@ -1,14 +1,32 @@
 from __future__ import annotations
 
+import gzip
+import hashlib
 import html
+import json
+from collections import OrderedDict
+from dataclasses import dataclass
 from datetime import datetime, timezone
-from typing import List
+from typing import Any, Callable, Dict, Hashable, Iterator, List, Tuple
+from urllib.parse import urlencode
 
+from twisted.internet import defer
+from twisted.internet.interfaces import IPullProducer
+from twisted.python import log
 from twisted.web.resource import Resource
-from twisted.web.server import Request, Site
-
-from .store import MessageStore
+from twisted.web.server import NOT_DONE_YET, Request, Site
+from zope.interface import implementer
+
+from .api import MAX_PAGE, ApiRoot, filter_args, int_arg, render_deferred
+from .blobs import BlobStore
+from .events import EventHub, EventStream
+from .metrics import Metrics, render
+from .store import MessageStore, StatsSnapshot
 from .models import StoredMessage
+from .tracing import STAGES
+
+# (labels, Metrics.snapshot()) for every process whose metrics are served.
+MetricsSources = Callable[[], List[Tuple[Dict[str, str], Dict[str, object]]]]
 
 
 def _fmt_dt(dt: datetime) -> str:
@@ -19,6 +37,87 @@ def _esc(s: str) -> str:
     return html.escape(s, quote=True)
 
 
+_GAUGE_LABELS = {
+    "smtp_connections": "SMTP connections",
+    "relays_inflight": "Relays in flight",
+    "queued_bytes": "Queued bytes",
+    "ingest_paused": "Ingest paused",
+    "requeue_waiting": "Spooled, waiting to be queued again",
+    "history_dropped_writes": "History writes dropped",
+    "upstream_queued": "Waiting for upstream quota",
+    "upstream_drain_seconds": "Estimated seconds until queue drains",
+    "quota_msgs_per_sec_used": "Quota used: messages this second",
+    "quota_msgs_per_sec_limit": "Quota limit: messages per second",
+    "quota_rcpts_per_min_used": "Quota used: recipients this minute",
+    "quota_rcpts_per_min_limit": "Quota limit: recipients per minute",
+    "quota_msgs_per_day_used": "Quota used: messages today",
+    "quota_msgs_per_day_limit": "Quota limit: messages per day",
+}
+
+# Per-upstream gauges ("upstream.<name>.<field>"), as dashboard table columns.
+_UPSTREAM_COLUMNS = [
+    ("breaker", "Breaker"), ("weight", "Weight"), ("sessions", "Sessions"),
+    ("inflight", "Assigned"), ("sent", "Sent"), ("failed", "Failed"),
+    ("failure_pct", "Recent failures %"), ("latency_ms", "Recent latency ms"),
+]
+_BREAKER_STATES = ["closed", "half-open", "open"]
+
+# Per-stage percentiles ("stage.<name>.<field>").
+_STAGE_COLUMNS = [("p50_ms", "p50 ms"), ("p95_ms", "p95 ms"), ("p99_ms", "p99 ms")]
+
+
+# Keeps the dashboard current from /events without reloading the page.
+_LIVE_SCRIPT = """<script>
+(function () {
+  if (!window.EventSource) return;
+  var labels = %s;
+  var breakers = %s;
+  function set(id, value) {
+    var el = document.getElementById(id);
+    if (el) el.textContent = value;
+  }
+  var es = new EventSource("/events");
+  es.addEventListener("stats", function (e) {
+    var d = JSON.parse(e.data);
+    for (var k in d) if (k !== "gauges") set("s-" + k, d[k]);
+    var gauges = d.gauges || {};
+    for (var g in gauges) {
+      if (g.indexOf(".") >= 0) {
+        var v = gauges[g];
+        set("g-" + g, /\\.breaker$/.test(g) ? (breakers[v] || v) : v);
+        continue;
+      }
+      if (!document.getElementById("g-" + g)) {
+        var li = document.createElement("li");
+        li.appendChild(document.createTextNode((labels[g] || g) + ": "));
+        var code = document.createElement("code");
+        code.id = "g-" + g;
+        li.appendChild(code);
+        document.getElementById("gauges").appendChild(li);
+      }
+      set("g-" + g, gauges[g]);
+    }
+  });
+  es.addEventListener("message", function (e) {
+    var m = JSON.parse(e.data);
+    var list = document.getElementById("activity");
+    var li = document.getElementById("m-" + m.id) || document.createElement("li");
+    li.id = "m-" + m.id;
+    li.textContent = "";
+    var a = document.createElement("a");
+    a.href = "/messages/" + m.id;
+    a.textContent = m.id;
+    li.appendChild(a);
+    li.appendChild(document.createTextNode(
+      " " + m.status + " " + m.envelope_from + " - " + (m.subject || "(no subject)")));
+    list.insertBefore(li, list.firstChild);
+    while (list.children.length > 20) list.removeChild(list.lastChild);
+  });
+  es.addEventListener("resync", function () { location.reload(); });
+})();
+</script>"""
+
+
 def _page(title: str, body: str) -> bytes:
     doc = f"""<!doctype html>
 <html>
@@ -47,25 +146,160 @@ def _page(title: str, body: str) -> bytes:
     return doc.encode("utf-8")
 
 
+@dataclass(slots=True)
+class _CacheEntry:
+    stamp: Hashable
+    etag: bytes
+    body: bytes
+    gzipped: bytes | None = None
+
+
+def _etag_matches(header: bytes | None, etag: bytes) -> bool:
+    if header is None:
+        return False
+    tags = [t.strip() for t in header.split(b",")]
+    return b"*" in tags or etag in tags or b"W/" + etag in tags
+
+
+class RenderCache:
+    """
+    Rendered pages keyed by path, reused until their stamp (the store
+    version, plus anything else the page shows) changes. Serves strong
+    ETags, answers If-None-Match with 304 and keeps a gzipped copy.
+    """
+
+    def __init__(self, max_entries: int = 256) -> None:
+        self._max = max_entries
+        self._entries: "OrderedDict[bytes, _CacheEntry]" = OrderedDict()
+
+    def serve(self, request: Request, stamp: Hashable,
+              render: Callable[[], bytes | defer.Deferred[bytes]]) -> bytes | int:
+        key = request.uri
+        entry = self._entries.get(key)
+        if entry is not None and entry.stamp == stamp:
+            self._entries.move_to_end(key)
+            return self._respond(request, entry)
+        d = defer.maybeDeferred(render)
+        return render_deferred(request, d.addCallback(
+            lambda body: self._respond(request, self._add(key, stamp, body))))
+
+    def _add(self, key: bytes, stamp: Hashable, body: bytes) -> _CacheEntry:
+        etag = b'"' + hashlib.blake2b(body, digest_size=12).hexdigest().encode() + b'"'
+        entry = self._entries[key] = _CacheEntry(stamp, etag, body)
+        if len(self._entries) > self._max:
+            self._entries.popitem(last=False)
+        return entry
+
+    def _respond(self, request: Request, entry: _CacheEntry) -> bytes:
+        body, etag = entry.body, entry.etag
+        if b"gzip" in (request.getHeader(b"accept-encoding") or b""):
+            if entry.gzipped is None:
+                entry.gzipped = gzip.compress(entry.body, compresslevel=6, mtime=0)
+            body, etag = entry.gzipped, etag[:-1] + b'-gz"'
+            request.setHeader(b"content-encoding", b"gzip")
+        request.setHeader(b"content-type", b"text/html; charset=utf-8")
+        request.setHeader(b"vary", b"Accept-Encoding")
+        request.setHeader(b"cache-control", b"no-cache")
+        request.setHeader(b"etag", etag)
+        if _etag_matches(request.getHeader(b"if-none-match"), etag):
+            request.setResponseCode(304)
+            request.responseHeaders.removeHeader(b"content-encoding")
+            return b""
+        return body
+
+
 class Root(Resource):
     isLeaf = False
 
-    def __init__(self, store: MessageStore) -> None:
+    def __init__(self, store: MessageStore, metrics: Metrics | None = None,
+                 sources: MetricsSources | None = None,
+                 blobs: BlobStore | None = None) -> None:
         super().__init__()
         self._store = store
-        self.putChild(b"", Dashboard(store))
-        self.putChild(b"messages", Messages(store))
+        cache = RenderCache()
+        if metrics is None:
+            metrics = Metrics()
+        if sources is None:
+            local = metrics
+            sources = lambda: [({}, local.snapshot())]  # noqa: E731
+        self.putChild(b"", Dashboard(store, cache))
+        self.putChild(b"messages", Messages(store, cache, blobs))
+        self.putChild(b"metrics", MetricsPage(store, metrics, sources))
+        self.putChild(b"api", ApiRoot(store))
+        self.putChild(b"events", EventStream(EventHub(store)))
+
+
+def _upstream_table(gauges: Dict[str, int]) -> str:
+    names = sorted({key.split(".")[1] for key in gauges
+                    if key.startswith("upstream.") and key.count(".") == 2})
+    if not names:
+        return '<p class="muted">None</p>'
+    head = "".join(f"<th>{_esc(label)}</th>" for _, label in _UPSTREAM_COLUMNS)
+    rows = []
+    for name in names:
+        cells = []
+        for field, _ in _UPSTREAM_COLUMNS:
+            key = f"upstream.{name}.{field}"
+            value = gauges.get(key, 0)
+            shown = _BREAKER_STATES[value] if field == "breaker" and 0 <= value < 3 else value
+            cells.append(f'<td><code id="g-{_esc(key)}">{_esc(str(shown))}</code></td>')
+        rows.append(f"  <tr><td>{_esc(name)}</td>{''.join(cells)}</tr>\n")
+    return f"""<table>
+  <thead><tr><th>Upstream</th>{head}</tr></thead>
+  <tbody>
+{''.join(rows)}  </tbody>
+</table>"""
+
+
+def _stage_table(gauges: Dict[str, int]) -> str:
+    present = {key.split(".")[1] for key in gauges
+               if key.startswith("stage.") and key.count(".") == 2}
+    names = [stage for stage in STAGES if stage in present]
+    if not names:
+        return '<p class="muted">No messages delivered yet</p>'
+    head = "".join(f"<th>{_esc(label)}</th>" for _, label in _STAGE_COLUMNS)
+    rows = []
+    for name in names:
+        cells = "".join(
+            f'<td><code id="g-stage.{_esc(name)}.{field}">'
+            f'{gauges.get(f"stage.{name}.{field}", 0)}</code></td>'
+            for field, _ in _STAGE_COLUMNS)
+        rows.append(f"  <tr><td>{_esc(name)}</td>{cells}</tr>\n")
+    return f"""<table>
+  <thead><tr><th>Stage</th>{head}</tr></thead>
+  <tbody>
+{''.join(rows)}  </tbody>
+</table>"""
+
+
+def _trace_list(item: StoredMessage) -> str:
+    if not item.trace:
+        return '<p class="muted">Not recorded</p>'
+    lines = "".join(f"  <li>{_esc(stage)}: <code>{seconds * 1000:.1f} ms</code></li>\n"
+                    for stage, seconds in item.trace)
+    total = sum(seconds for _, seconds in item.trace)
+    return f"<ul>\n{lines}  <li>Total: <code>{total * 1000:.1f} ms</code></li>\n</ul>"
 
 
 class Dashboard(Resource):
     isLeaf = True
 
-    def __init__(self, store: MessageStore) -> None:
+    def __init__(self, store: MessageStore, cache: RenderCache) -> None:
         super().__init__()
         self._store = store
+        self._cache = cache
 
     def render_GET(self, request: Request) -> bytes:
         s = self._store.stats()
+        stamp = (self._store.version(), tuple(sorted(s.gauges.items())))
+        return self._cache.serve(request, stamp, lambda: self._render(s))
+
+    def _render(self, s: StatsSnapshot) -> bytes:
+        gauges = "".join(
+            f"  <li>{_esc(_GAUGE_LABELS.get(name, name))}: "
+            f'<code id="g-{_esc(name)}">{value}</code></li>\n'
+            for name, value in sorted(s.gauges.items()) if "." not in name
+        )
         body = f"""
 <h1>Twisted SMTP Relay</h1>
 <p class="muted">Dashboard</p>
@@ -73,38 +307,88 @@ class Dashboard(Resource):
 <h2>Stats</h2>
 <ul>
   <li>Started: <code>{_esc(_fmt_dt(s.started_at))}</code></li>
-  <li>Received: <code>{s.received_total}</code></li>
-  <li>Relayed OK: <code>{s.relayed_ok_total}</code></li>
-  <li>Relayed Fail: <code>{s.relayed_fail_total}</code></li>
-  <li>Stored: <code>{s.stored_count}</code></li>
+  <li>Received: <code id="s-received_total">{s.received_total}</code></li>
+  <li>Relayed OK: <code id="s-relayed_ok_total">{s.relayed_ok_total}</code></li>
+  <li>Relayed Fail: <code id="s-relayed_fail_total">{s.relayed_fail_total}</code></li>
+  <li>Duplicates (not relayed): <code id="s-duplicate_total">{s.duplicate_total}</code></li>
+  <li>Stored: <code id="s-stored_count">{s.stored_count}</code></li>
 </ul>
 
+<h2>Load</h2>
+<ul id="gauges">
+{gauges}</ul>
+
+<h2>Upstreams</h2>
+{_upstream_table(s.gauges)}
+
+<h2>Stage timings (last 1000 delivered messages)</h2>
+{_stage_table(s.gauges)}
+
+<h2>Live activity</h2>
+<ul id="activity" class="muted"></ul>
+
 <p><a href="/messages">View messages</a></p>
 """
-        request.setHeader(b"content-type", b"text/html; charset=utf-8")
-        return _page("SMTP Relay Dashboard", body)
+        return _page("SMTP Relay Dashboard",
+                     body + _LIVE_SCRIPT % (json.dumps(_GAUGE_LABELS),
+                                            json.dumps(_BREAKER_STATES)))
+
+
+class MetricsPage(Resource):
+    isLeaf = True
+
+    def __init__(self, store: MessageStore, metrics: Metrics,
+                 sources: MetricsSources) -> None:
+        super().__init__()
+        self._store = store
+        self._metrics = metrics
+        self._sources = sources
+
+    def render_GET(self, request: Request) -> bytes:
+        request.setHeader(b"content-type", b"text/plain; version=0.0.4; charset=utf-8")
+        return render(self._metrics, self._sources(), self._store.stats())
 
 
 class Messages(Resource):
     isLeaf = False
 
-    def __init__(self, store: MessageStore) -> None:
+    def __init__(self, store: MessageStore, cache: RenderCache,
+                 blobs: BlobStore | None = None) -> None:
         super().__init__()
         self._store = store
+        self._cache = cache
+        self._blobs = blobs
 
     def getChild(self, path: bytes, request: Request) -> Resource:
         if path == b"" or path is None:
             return self
-        return MessageDetail(self._store, path.decode("utf-8", errors="replace"))
+        return MessageDetail(self._store, self._cache,
+                             path.decode("utf-8", errors="replace"), self._blobs)
 
     def render_GET(self, request: Request) -> bytes:
-        items = self._store.list_recent()
+        try:
+            cursor = int_arg(request, "cursor")
+            limit = min(int_arg(request, "limit") or MAX_PAGE, MAX_PAGE)
+            filters = filter_args(request)
+        except ValueError as exc:
+            request.setResponseCode(400)
+            request.setHeader(b"content-type", b"text/html; charset=utf-8")
+            return _page("Bad request", f"<h1>Bad request</h1><p>{_esc(str(exc))}</p>"
+                         "<p><a href='/messages'>Back</a></p>")
+        args = {k.decode(): v[0].decode("utf-8", errors="replace")
+                for k, v in request.args.items() if k != b"cursor"}
+        stamp = (self._store.version(), tuple(sorted(filters.items())), cursor, limit)
+        return self._cache.serve(
+            request, stamp,
+            lambda: self._store.fetch_page(cursor, limit, **filters).addCallback(self._render, args))
+
+    def _render(self, page: Tuple[List[StoredMessage], int | None],
+                args: Dict[str, str]) -> bytes:
+        items, next_cursor = page
         rows = []
         for m in items:
-            status = "PENDING"
+            status = m.status
             pill = "pill"
-            if m.relay_attempt is not None:
-                status = "OK" if m.relay_attempt.ok else "FAIL"
             subj = m.subject or "(no subject)"
             rows.append(
                 "<tr>"
@@ -117,9 +401,20 @@ class Messages(Resource):
                 f"<td>{m.size_bytes}</td>"
                 "</tr>"
             )
+        fields = "".join(
+            f"<label>{label} <input name='{name}' value='{_esc(args.get(name, ''))}' "
+            f"size='{size}' /></label> "
+            for name, label, size in (("status", "Status", 7), ("from", "From", 24),
+                                      ("to", "To", 24), ("peer", "Peer", 15),
+                                      ("q", "Subject", 16), ("since", "Since", 6)))
+        older = ""
+        if next_cursor is not None:
+            older = ("<p><a href='/messages?"
+                     + _esc(urlencode({**args, "cursor": next_cursor})) + "'>Older</a></p>")
         body = """
 <h1>Messages</h1>
 <p><a href="/">Back to dashboard</a></p>
+<form method="get" action="/messages">""" + fields + """<button>Filter</button></form>
 <table>
   <thead>
     <tr>
@@ -131,38 +426,59 @@ class Messages(Resource):
 """ + "\n".join(rows) + """
   </tbody>
 </table>
-"""
-        request.setHeader(b"content-type", b"text/html; charset=utf-8")
+""" + older
         return _page("Messages", body)
 
 
 class MessageDetail(Resource):
-    isLeaf = True
+    isLeaf = False
 
-    def __init__(self, store: MessageStore, message_id: str) -> None:
+    def __init__(self, store: MessageStore, cache: RenderCache, message_id: str,
+                 blobs: BlobStore | None = None) -> None:
         super().__init__()
         self._store = store
+        self._cache = cache
         self._id = message_id
+        self._blobs = blobs
 
-    def render_GET(self, request: Request) -> bytes:
-        item = self._store.get(self._id)
+    def getChild(self, path: bytes, request: Request) -> Resource:
+        if path == b"":
+            return self
+        if path == b"raw" and self._blobs is not None:
+            return MessageRaw(self._store, self._blobs, self._id)
+        return super().getChild(path, request)
+
+    def render_GET(self, request: Request) -> bytes | int:
+        version = self._store.version()
+        return render_deferred(request, self._store.fetch(self._id)
+                               .addCallback(self._serve, request, version))
+
+    def _serve(self, item: StoredMessage | None, request: Request, version: int) -> Any:
         if item is None:
             request.setResponseCode(404)
             request.setHeader(b"content-type", b"text/html; charset=utf-8")
             return _page("Not found", "<h1>Not found</h1><p><a href='/messages'>Back</a></p>")
+        return self._cache.serve(request, version, lambda: self._render(item))
 
-        status = "PENDING"
+    def _render(self, item: StoredMessage) -> bytes:
+        status = item.status
         err = ""
         started = ""
         finished = ""
         if item.relay_attempt is not None:
-            status = "OK" if item.relay_attempt.ok else "FAIL"
             started = _fmt_dt(item.relay_attempt.started_at)
             if item.relay_attempt.finished_at is not None:
                 finished = _fmt_dt(item.relay_attempt.finished_at)
             if item.relay_attempt.error:
                 err = item.relay_attempt.error
 
+        dup = ""
+        if item.duplicate_of is not None:
+            dup = (f"\n  <li>Duplicate of: <a href='/messages/{_esc(item.duplicate_of)}'>"
+                   f"{_esc(item.duplicate_of)}</a></li>")
+        raw = ""
+        if self._blobs is not None:
+            raw = f"<p><a href='/messages/{_esc(item.message_id)}/raw'>Download raw message</a></p>\n"
         body = f"""
 <h1>Message {_esc(item.message_id)}</h1>
 <p><a href="/messages">Back to messages</a> | <a href="/">Dashboard</a></p>
@@ -182,20 +498,86 @@ class MessageDetail(Resource):
   <li>SHA-256: <code>{_esc(item.sha256)}</code></li>
   <li>Received: <code>{_esc(_fmt_dt(item.received_at))}</code></li>
 </ul>
-
+{raw}
 <h2>Relay</h2>
 <ul>
-  <li>Status: <code>{_esc(status)}</code></li>
+  <li>Status: <code>{_esc(status)}</code></li>{dup}
   <li>Started: <code>{_esc(started)}</code></li>
   <li>Finished: <code>{_esc(finished)}</code></li>
 </ul>
 
 <pre>{_esc(err)}</pre>
+
+<h2>Timing</h2>
+{_trace_list(item)}
 """
-        request.setHeader(b"content-type", b"text/html; charset=utf-8")
         return _page(f"Message {item.message_id}", body)
 
 
-def make_site(store: MessageStore) -> Site:
-    root = Root(store)
+@implementer(IPullProducer)
+class _ChunkProducer:
+    """Writes one chunk each time the transport asks for more."""
+
+    def __init__(self, request: Request, chunks: Iterator[bytes]) -> None:
+        self._request: Request | None = request
+        self._chunks = chunks
+
+    def start(self) -> None:
+        self._request.registerProducer(self, False)  # type: ignore[union-attr]
+
+    def resumeProducing(self) -> None:
+        if self._request is None:
+            return
+        try:
+            chunk = next(self._chunks, None)
+        except Exception:
+            # Headers are out already, so the client can only see it cut off.
+            log.err(None, "Failed to read a stored message")
+            request, self._request = self._request, None
+            request.unregisterProducer()
+            request.transport.abortConnection()
+            return
+        if chunk is None:
+            request, self._request = self._request, None
+            request.unregisterProducer()
+            request.finish()
+            return
+        self._request.write(chunk)
+
+    def stopProducing(self) -> None:
+        self._request = None
+        self._chunks.close()  # type: ignore[attr-defined]
+
+
+class MessageRaw(Resource):
+    isLeaf = True
+
+    def __init__(self, store: MessageStore, blobs: BlobStore, message_id: str) -> None:
+        super().__init__()
+        self._store = store
+        self._blobs = blobs
+        self._id = message_id
+
+    def render_GET(self, request: Request) -> bytes | int:
+        return render_deferred(request, self._store.fetch(self._id)
+                               .addCallback(self._serve, request))
+
+    def _serve(self, item: StoredMessage | None, request: Request) -> bytes | int:
+        chunks = self._blobs.chunks(item.sha256) if item is not None else None
+        if chunks is None:
+            request.setResponseCode(404)
+            request.setHeader(b"content-type", b"text/plain; charset=utf-8")
+            return b"not found\n"
+        request.setHeader(b"content-type", b"message/rfc822")
+        request.setHeader(b"content-length", str(item.size_bytes).encode())  # type: ignore[union-attr]
+        request.setHeader(b"content-disposition",
+                          f'attachment; filename="{item.message_id}.eml"'.encode())  # type: ignore[union-attr]
+        _ChunkProducer(request, chunks).start()
+        return NOT_DONE_YET
+
+
+def make_site(store: MessageStore, metrics: Metrics | None = None,
+              sources: MetricsSources | None = None,
+              blobs: BlobStore | None = None) -> Site:
+    root = Root(store, metrics, sources, blobs)
     return Site(root)
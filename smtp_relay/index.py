@@ -0,0 +1,126 @@
+from __future__ import annotations
+
+import re
+from array import array
+from bisect import bisect_left, bisect_right
+from typing import Dict, Iterable, Iterator, List, Set
+
+_TOKEN_RE = re.compile(r"\w+")
+
+
+def subject_tokens(subject: str | None) -> Set[str]:
+    if not subject:
+        return set()
+    return {t.lower() for t in _TOKEN_RE.findall(subject)}
+
+
+class _Postings:
+    """
+    Ascending sequence numbers for one index key. Messages are only ever
+    added newest and evicted oldest, so this is an append-only array with
+    a moving head.
+    """
+
+    __slots__ = ("seqs", "head")
+
+    def __init__(self) -> None:
+        self.seqs = array("q")
+        self.head = 0
+
+    def __len__(self) -> int:
+        return len(self.seqs) - self.head
+
+    def evict(self, seq: int) -> None:
+        if self.head < len(self.seqs) and self.seqs[self.head] == seq:
+            self.head += 1
+            if self.head > 1024 and self.head * 2 > len(self.seqs):
+                del self.seqs[:self.head]
+                self.head = 0
+
+    def count_between(self, lo: int, hi: int) -> int:
+        return (bisect_right(self.seqs, hi, self.head)
+                - bisect_left(self.seqs, lo, self.head))
+
+    def descending(self, lo: int, hi: int) -> Iterator[int]:
+        stop = bisect_left(self.seqs, lo, self.head)
+        for i in range(bisect_right(self.seqs, hi, self.head) - 1, stop - 1, -1):
+            yield self.seqs[i]
+
+
+class _KeyIndex:
+    """
+    Key -> postings. Most subject tokens (ids, dates) are seen only once,
+    so a key with a single message maps to its bare sequence number.
+    """
+
+    __slots__ = ("_postings",)
+
+    def __init__(self) -> None:
+        self._postings: Dict[str, int | _Postings] = {}
+
+    def __len__(self) -> int:
+        return len(self._postings)
+
+    def add(self, keys: Iterable[str], seq: int) -> None:
+        postings = self._postings
+        for key in keys:
+            p = postings.get(key)
+            if p is None:
+                postings[key] = seq
+            elif isinstance(p, int):
+                p2 = postings[key] = _Postings()
+                p2.seqs.append(p)
+                p2.seqs.append(seq)
+            else:
+                p.seqs.append(seq)
+
+    def evict(self, keys: Iterable[str], seq: int) -> None:
+        postings = self._postings
+        for key in keys:
+            p = postings.get(key)
+            if p is None:
+                continue
+            if isinstance(p, int):
+                if p == seq:
+                    del postings[key]
+                continue
+            p.evict(seq)
+            if p.head == len(p.seqs):
+                del postings[key]
+
+    def get(self, key: str) -> _Postings | None:
+        p = self._postings.get(key)
+        if isinstance(p, int):
+            single = _Postings()
+            single.seqs.append(p)
+            return single
+        return p
+
+
+class MessageIndex:
+    """
+    Secondary indexes over the store: envelope sender, each recipient, peer
+    host and subject tokens map to the sequence numbers carrying them.
+    Keys are lower-cased. Kept in step with the ring buffer by evicting
+    each message's keys when its slot is reused.
+    """
+
+    def __init__(self) -> None:
+        self.sender = _KeyIndex()
+        self.recipient = _KeyIndex()
+        self.peer = _KeyIndex()
+        self.token = _KeyIndex()
+
+    def add(self, seq: int, sender: str, recipients: List[str], peer_host: str,
+            subject: str | None) -> None:
+        self.sender.add((sender.lower(),), seq)
+        self.recipient.add({r.lower() for r in recipients}, seq)
+        self.peer.add((peer_host.lower(),), seq)
+        self.token.add(subject_tokens(subject), seq)
+
+    def evict(self, seq: int, sender: str, recipients: List[str], peer_host: str,
+              subject: str | None) -> None:
+        self.sender.evict((sender.lower(),), seq)
+        self.recipient.evict({r.lower() for r in recipients}, seq)
+        self.peer.evict((peer_host.lower(),), seq)
+        self.token.evict(subject_tokens(subject), seq)
@@ -1,19 +1,45 @@
 from __future__ import annotations
 
+import argparse
 import sys
 
-from .app import run
+from twisted.python.runtime import platform
+
+from .app import run, run_supervisor, run_worker
 from .config import RelayConfig
 
 
+def _build_parser() -> argparse.ArgumentParser:
+    p = argparse.ArgumentParser(prog="smtp_relay",
+                                description="Twisted SMTP relay with HTTP stats.")
+    p.add_argument("--workers", type=int, default=0,
+                   help="run N SMTP worker processes sharing the listening socket "
+                        "(POSIX only; default: single process)")
+    p.add_argument("--worker-index", type=int, help=argparse.SUPPRESS)
+    p.add_argument("--listen-fd", type=int, help=argparse.SUPPRESS)
+    return p
+
+
 def main(argv: list[str] | None = None) -> int:
-    _ = argv or sys.argv[1:]
+    args = _build_parser().parse_args(argv if argv is not None else sys.argv[1:])
     try:
         cfg = RelayConfig.from_env()
     except ValueError as exc:
         print(f"Config error: {exc}", file=sys.stderr)
         return 2
-    run(cfg)
+    if args.workers < 0:
+        print("Config error: --workers must be >= 0", file=sys.stderr)
+        return 2
+    if args.workers and platform.isWindows():
+        print("Config error: --workers is not supported on Windows", file=sys.stderr)
+        return 2
+
+    if args.worker_index is not None and args.listen_fd is not None:
+        run_worker(cfg, args.worker_index, args.listen_fd, args.workers)
+    elif args.workers:
+        run_supervisor(cfg, args.workers)
+    else:
+        run(cfg)
     return 0
 
 
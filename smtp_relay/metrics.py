@@ -0,0 +1,157 @@
+from __future__ import annotations
+
+import re
+from bisect import bisect_left
+from typing import Dict, Iterable, List, Tuple
+
+from .store import StatsSnapshot
+
+_PREFIX = "smtp_relay_"
+_NAME_RE = re.compile(r"[^a-zA-Z0-9_]")
+
+
+class Counter:
+    __slots__ = ("name", "help", "value")
+
+    def __init__(self, name: str, help: str) -> None:
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    def inc(self, amount: int = 1) -> None:
+        self.value += amount
+
+
+class Histogram:
+    __slots__ = ("name", "help", "bounds", "counts", "sum", "count")
+
+    def __init__(self, name: str, help: str, bounds: Iterable[float]) -> None:
+        self.name = name
+        self.help = help
+        self.bounds = sorted(bounds)
+        # one slot per bound plus +Inf; cumulated when rendered
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+_SIZE_BUCKETS = [1024 * 4 ** i for i in range(10)]
+_DATA_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+_ACK_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600]
+
+
+class Metrics:
+    """
+    Counters and histograms updated on the SMTP and delivery paths. Updates
+    are plain attribute arithmetic; all formatting happens at scrape time.
+    """
+
+    def __init__(self) -> None:
+        self.received_messages = Counter(
+            "received_messages_total", "Messages accepted over SMTP.")
+        self.received_bytes = Counter(
+            "received_bytes_total", "Bytes of message data accepted over SMTP.")
+        self.relayed_messages = Counter(
+            "relayed_messages_total", "Messages delivered upstream.")
+        self.relayed_bytes = Counter(
+            "relayed_bytes_total", "Bytes of message data delivered upstream.")
+        self.failed_messages = Counter(
+            "failed_messages_total", "Messages given up on after failed relays.")
+        self.failed_bytes = Counter(
+            "failed_bytes_total", "Bytes of message data given up on.")
+        self.duplicate_messages = Counter(
+            "duplicate_messages_total",
+            "Messages accepted but not relayed, as copies of a recent message.")
+        self.oversized_messages = Counter(
+            "oversized_messages_total",
+            "Messages refused for exceeding MAX_MESSAGE_SIZE, declared or sent.")
+        self.requeued_messages = Counter(
+            "requeued_messages_total",
+            "Spooled messages that failed to queue and were retried later.")
+        self.relay_retries = Counter(
+            "relay_retries_total", "Relay attempts that failed and were rescheduled.")
+        self.message_size = Histogram(
+            "message_size_bytes", "Size of accepted messages.", _SIZE_BUCKETS)
+        self.data_seconds = Histogram(
+            "data_to_eom_seconds", "Time from DATA to end of message.", _DATA_BUCKETS)
+        self.upstream_ack_seconds = Histogram(
+            "eom_to_upstream_ack_seconds",
+            "Time from end of message to the upstream accepting it.", _ACK_BUCKETS)
+
+    def counters(self) -> List[Counter]:
+        return [v for v in vars(self).values() if isinstance(v, Counter)]
+
+    def histograms(self) -> List[Histogram]:
+        return [v for v in vars(self).values() if isinstance(v, Histogram)]
+
+    def snapshot(self) -> Dict[str, object]:
+        snap: Dict[str, object] = {c.name: c.value for c in self.counters()}
+        for h in self.histograms():
+            snap[h.name] = [list(h.counts), h.sum, h.count]
+        return snap
+
+
+def _labels(labels: Dict[str, str], extra: str = "") -> str:
+    parts = [f'{k}="{v}"' for k, v in labels.items()]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _num(value: float) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render(
+    metrics: Metrics,
+    sources: List[Tuple[Dict[str, str], Dict[str, object]]],
+    stats: StatsSnapshot,
+) -> bytes:
+    """
+    Prometheus text exposition. ``metrics`` supplies names and bucket bounds;
+    ``sources`` holds (labels, snapshot) pairs, one per process.
+    """
+    out: List[str] = []
+    for c in metrics.counters():
+        name = _PREFIX + c.name
+        out.append(f"# HELP {name} {c.help}")
+        out.append(f"# TYPE {name} counter")
+        for labels, snap in sources:
+            out.append(f"{name}{_labels(labels)} {snap.get(c.name, 0)}")
+    for h in metrics.histograms():
+        name = _PREFIX + h.name
+        out.append(f"# HELP {name} {h.help}")
+        out.append(f"# TYPE {name} histogram")
+        for labels, snap in sources:
+            counts, total, count = snap.get(h.name, ([0] * (len(h.bounds) + 1), 0.0, 0))  # type: ignore[misc]
+            running = 0
+            for bound, n in zip(h.bounds + [float("inf")], counts):
+                running += n
+                le = "+Inf" if bound == float("inf") else _num(bound)
+                bucket_labels = _labels(labels, 'le="' + le + '"')
+                out.append(f"{name}_bucket{bucket_labels} {running}")
+            out.append(f"{name}_sum{_labels(labels)} {_num(total)}")
+            out.append(f"{name}_count{_labels(labels)} {count}")
+
+    gauges = dict(stats.gauges)
+    gauges["store_messages"] = stats.stored_count
+    series: Dict[str, List[str]] = {}
+    for key, value in sorted(gauges.items()):
+        # "upstream.<name>.<field>" becomes <prefix>upstream_<field>{upstream="<name>"}.
+        group, _, rest = key.partition(".")
+        label, _, field = rest.partition(".")
+        if field:
+            name = _PREFIX + _NAME_RE.sub("_", f"{group}_{field}")
+            series.setdefault(name, []).append(f'{name}{{{group}="{label}"}} {value}')
+        else:
+            name = _PREFIX + _NAME_RE.sub("_", key)
+            series.setdefault(name, []).append(f"{name} {value}")
+    for name, lines in sorted(series.items()):
+        out.append(f"# TYPE {name} gauge")
+        out.extend(lines)
+    return ("\n".join(out) + "\n").encode("utf-8")
@@ -2,7 +2,7 @@ from __future__ import annotations
 
 from dataclasses import dataclass
 from datetime import datetime, timezone
-from typing import List
+from typing import List, Tuple
 
 
 def utc_now() -> datetime:
@@ -37,3 +37,14 @@ class StoredMessage:
     size_bytes: int
     sha256: str
     relay_attempt: RelayAttempt | None
+    duplicate_of: str | None = None
+    # (stage, seconds) as in tracing.StageTimes; set once the relay finishes.
+    trace: Tuple[Tuple[str, float], ...] = ()
+
+    @property
+    def status(self) -> str:
+        if self.duplicate_of is not None:
+            return "DUP"
+        if self.relay_attempt is None:
+            return "PENDING"
+        return "OK" if self.relay_attempt.ok else "FAIL"
@@ -0,0 +1,73 @@
+from __future__ import annotations
+
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Any, Callable, TypeVar
+
+from twisted.internet import defer
+from twisted.internet.threads import deferToThreadPool
+from twisted.python.threadpool import ThreadPool
+
+T = TypeVar("T")
+
+
+class Offloader:
+    """
+    Runs per-message work off the reactor thread once the message is at
+    least ``threshold`` bytes; smaller messages run inline, where a thread
+    handoff would cost more than the work. run() is for file I/O and for
+    work that releases the GIL (zlib, hashing large buffers); run_cpu() is
+    for pure-Python work such as MIME parsing, and uses the process pool
+    when there is one.
+    """
+
+    def __init__(self, threshold: int = 0, threads: int = 0, processes: int = 0,
+                 reactor=None) -> None:  # type: ignore[no-untyped-def]
+        if reactor is None:
+            from twisted.internet import reactor
+        self._reactor = reactor
+        self._threshold = threshold
+        self._pool = ThreadPool(1, threads, "offload") if threads else None
+        # spawn, not fork: the parent has a reactor and worker threads running.
+        self._processes = ProcessPoolExecutor(
+            processes, mp_context=multiprocessing.get_context("spawn")) if processes else None
+
+    def start(self) -> None:
+        if self._pool is not None:
+            self._pool.start()
+        self._reactor.addSystemEventTrigger("during", "shutdown", self.stop)
+
+    def stop(self) -> None:
+        if self._pool is not None and self._pool.started:
+            self._pool.stop()
+        if self._processes is not None:
+            self._processes.shutdown(wait=False, cancel_futures=True)
+
+    def _inline(self, size: int) -> bool:
+        return self._pool is None or size < self._threshold
+
+    def run(self, size: int, fn: Callable[..., T], *args: Any) -> defer.Deferred[T]:
+        if self._inline(size):
+            return defer.maybeDeferred(fn, *args)
+        return deferToThreadPool(self._reactor, self._pool, fn, *args)
+
+    def run_cpu(self, size: int, fn: Callable[..., T], *args: Any) -> defer.Deferred[T]:
+        # ``fn`` and ``args`` must be picklable when a process pool is set.
+        if self._processes is None or size < self._threshold:
+            return self.run(size, fn, *args)
+        d: defer.Deferred[T] = defer.Deferred()
+
+        def _done(future: Future) -> None:
+            if future.cancelled():
+                # Still queued when the pool was shut down.
+                d.errback(defer.CancelledError())
+                return
+            exc = future.exception()
+            if exc is not None:
+                d.errback(exc)
+            else:
+                d.callback(future.result())
+
+        self._processes.submit(fn, *args).add_done_callback(
+            lambda future: self._reactor.callFromThread(_done, future))
+        return d
@@ -0,0 +1,432 @@
+from __future__ import annotations
+
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import BinaryIO, Callable, Deque, Iterable, List, Set, Tuple
+
+from twisted.internet import defer, protocol
+from twisted.internet.interfaces import IDelayedCall
+from twisted.internet.ssl import Certificate, optionsForClientTLS
+from twisted.mail import smtp
+from twisted.python import log
+
+from .config import RelayConfig, Upstream
+from .tracing import MessageTrace
+
+
+@dataclass(slots=True)
+class _Job:
+    from_addr: str
+    to_addrs: List[str]
+    open_data: Callable[[], BinaryIO]
+    deferred: defer.Deferred = field(repr=False)
+    requeued: bool = False
+    trace: MessageTrace | None = field(default=None, repr=False)
+
+
+class _PooledSender(smtp.ESMTPSender):
+    """
+    An ESMTP client that stays connected after a transaction and asks its
+    pool for the next batch of messages instead of sending QUIT.
+
+    When the server advertises PIPELINING, MAIL, every RCPT and DATA of a
+    transaction are written in one go and no RSET is sent after a
+    successful transaction.
+    """
+
+    def __init__(self, pool: "UpstreamPool", *args, **kw) -> None:  # type: ignore[no-untyped-def]
+        smtp.ESMTPSender.__init__(self, *args, **kw)
+        self.pool = pool
+        self.ready = False
+        self.pipelining = False
+        self.messages_sent = 0
+        self.idle_call: IDelayedCall | None = None
+        self._batch: Deque[_Job] = deque()
+        self._job: _Job | None = None
+        self._file: BinaryIO | None = None
+        self._data_sent = False
+        self._error: Exception | None = None
+        self._awaiting: List[bytes] = []
+        self._mail_reply: Tuple[int, bytes] = (0, b"")
+        # (stage, time.monotonic()) of the session's setup, handed to the
+        # trace of the first message sent over it.
+        self.handshake: List[Tuple[str, float]] = []
+
+    def connectionMade(self) -> None:
+        self.handshake.append(("connect", time.monotonic()))
+        smtp.ESMTPSender.connectionMade(self)
+
+    def esmtpState_serverConfig(self, code, resp):  # type: ignore[no-untyped-def]
+        if self._tlsMode and self.handshake and self.handshake[-1][0] == "connect":
+            self.handshake.append(("starttls", time.monotonic()))
+        self.pipelining = any(
+            line.split(None, 1)[:1] == [b"PIPELINING"]
+            for line in resp.upper().splitlines()
+        )
+        smtp.ESMTPSender.esmtpState_serverConfig(self, code, resp)
+
+    def smtpState_from(self, code, resp):  # type: ignore[no-untyped-def]
+        if not self.ready:
+            self.handshake.append(("auth", time.monotonic()))
+        self.ready = True
+        if self._batch:
+            self._next()
+        else:
+            self.pool._connectionReady(self)
+
+    def deliver(self, jobs: Iterable[_Job]) -> None:
+        self._batch.extend(jobs)
+        self.setTimeout(self.timeout)
+        self._next()
+
+    def park(self) -> None:
+        self.setTimeout(None)
+
+    def quit(self) -> None:
+        self._job = None
+        smtp.ESMTPSender.smtpState_from(self, -1, b"")
+
+    def _next(self) -> None:
+        self._job = self._batch.popleft()
+        self._data_sent = False
+        self.messages_sent += 1
+        trace = self._job.trace
+        if trace is not None:
+            if self.handshake:
+                for stage, at in self.handshake:
+                    trace.mark(stage, at)
+            else:
+                trace.mark("pool")
+        self.handshake = []
+        if self.pipelining:
+            self._sendPipelined()
+        else:
+            smtp.ESMTPSender.smtpState_from(self, -1, b"")
+
+    def _sendPipelined(self) -> None:
+        assert self._job is not None
+        self._from = self._job.from_addr
+        self._awaiting = self.getMailTo()
+        self.toAddressesResult = []
+        self.successAddresses = []
+        self.sendLine(b"MAIL FROM:" + smtp.quoteaddr(self._from))
+        for addr in self._awaiting:
+            self.sendLine(b"RCPT TO:" + smtp.quoteaddr(addr))
+        self.sendLine(b"DATA")
+        self._expected = range(0, 1000)
+        self._okresponse = self._pipelineState_mail
+
+    def _pipelineState_mail(self, code, resp):  # type: ignore[no-untyped-def]
+        self._mail_reply = (code, resp)
+        self._okresponse = self._pipelineState_rcpt
+
+    def _pipelineState_rcpt(self, code, resp):  # type: ignore[no-untyped-def]
+        if not self._awaiting:
+            return self._pipelineState_data(code, resp)
+        addr = self._awaiting.pop(0)
+        self.toAddressesResult.append((addr, code, resp))
+        if code in smtp.SUCCESS:
+            self.successAddresses.append(addr)
+        return None
+
+    def _pipelineState_data(self, code, resp):  # type: ignore[no-untyped-def]
+        mail_code, mail_resp = self._mail_reply
+        if mail_code not in smtp.SUCCESS:
+            fail_code, fail_resp = mail_code, mail_resp
+        elif not self.successAddresses:
+            fail_code, fail_resp = self.toAddressesResult[-1][1], b"No recipients accepted"
+        elif code == 354:
+            self.smtpState_data(code, resp)
+            self._failresponse = self.smtpTransferFailed
+            return
+        else:
+            fail_code, fail_resp = code, resp
+        if code == 354:
+            # The server wants a body even though the transaction already
+            # failed, and an empty one might still be delivered; drop the
+            # session instead. Its remaining batch goes back to the queue.
+            self.sentMail(fail_code, fail_resp, 0, self.toAddressesResult, self.log)
+            self.transport.abortConnection()
+            return
+        self.smtpState_msgSent(fail_code, fail_resp)
+
+    def smtpState_msgSent(self, code, resp):  # type: ignore[no-untyped-def]
+        if self.pipelining and code in smtp.SUCCESS and self._from is not None:
+            self.sentMail(code, resp, len(self.successAddresses),
+                          self.toAddressesResult, self.log)
+            self.toAddressesResult = []
+            self._from = None
+            self.smtpState_from(code, resp)
+            return
+        smtp.ESMTPSender.smtpState_msgSent(self, code, resp)
+
+    def finishedFileTransfer(self, lastsent):  # type: ignore[no-untyped-def]
+        if self._job is not None and self._job.trace is not None:
+            self._job.trace.mark("transfer")
+        smtp.ESMTPSender.finishedFileTransfer(self, lastsent)
+
+    def getMailFrom(self):  # type: ignore[no-untyped-def]
+        if self._job is None:
+            return None
+        return self._job.from_addr
+
+    def getMailTo(self):  # type: ignore[no-untyped-def]
+        assert self._job is not None
+        return [a.encode("utf-8") for a in self._job.to_addrs]
+
+    def getMailData(self):  # type: ignore[no-untyped-def]
+        assert self._job is not None
+        self._data_sent = True
+        self._file = self._job.open_data()
+        return self._file
+
+    def _closeFile(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def sentMail(self, code, resp, numOk, addresses, log):  # type: ignore[no-untyped-def]
+        job, self._job = self._job, None
+        self._closeFile()
+        if job is None:
+            return
+        if job.trace is not None:
+            job.trace.mark("reply")
+        if code not in smtp.SUCCESS:
+            errlog = []
+            for addr, acode, aresp in addresses:
+                if acode not in smtp.SUCCESS:
+                    errlog.append(addr + b": " + b"%03d " % (acode,) + aresp)
+            errlog.append(log.str())
+            job.deferred.errback(
+                smtp.SMTPDeliveryError(code, resp, b"\n".join(errlog), addresses)
+            )
+        else:
+            job.deferred.callback((numOk, addresses))
+
+    def sendError(self, exc):  # type: ignore[no-untyped-def]
+        self._error = exc
+        smtp.SMTPClient.sendError(self, exc)
+
+    def connectionLost(self, reason=protocol.connectionDone):  # type: ignore[no-untyped-def]
+        smtp.ESMTPSender.connectionLost(self, reason)
+        if self.idle_call is not None and self.idle_call.active():
+            self.idle_call.cancel()
+        self.idle_call = None
+        self._closeFile()
+        job, self._job = self._job, None
+        unsent, self._batch = list(self._batch), deque()
+        error = self._error
+        if error is None:
+            error = smtp.SMTPConnectError(
+                -1, "Upstream connection lost: " + str(reason.value)
+            )
+        self.pool._connectionLost(self, job, self._data_sent, unsent, error)
+
+
+class _PooledSenderFactory(protocol.ClientFactory):
+    protocol = _PooledSender  # type: ignore[assignment]
+    domain = smtp.DNSNAME
+
+    def __init__(self, pool: "UpstreamPool") -> None:
+        self.pool = pool
+        self.started = time.monotonic()
+
+    def buildProtocol(self, addr):  # type: ignore[no-untyped-def]
+        upstream = self.pool.upstream
+        p = self.protocol(
+            self.pool,
+            upstream.username.encode("utf-8"),
+            upstream.password.encode("utf-8"),
+            optionsForClientTLS(hostname=upstream.host, trustRoot=self.pool.trust_root),
+            self.domain,
+            hostname=upstream.host,
+        )
+        p.heloFallback = True
+        p.requireAuthentication = False
+        p.requireTransportSecurity = True
+        p.factory = self
+        p.handshake.append(("pool", self.started))
+        return p
+
+    def clientConnectionFailed(self, connector, reason):  # type: ignore[no-untyped-def]
+        self.pool._connectFailed(reason)
+
+
+class UpstreamPool:
+    """
+    Keeps up to ``upstream.max_connections`` authenticated sessions to
+    ``upstream.host`` (by default the GMAIL_* upstream) open and hands queued messages to whichever one is
+    idle, up to ``cfg.upstream_batch_size`` at a time so they go out as
+    back-to-back transactions. With ``cfg.upstream_batch_linger_ms`` set,
+    a partial batch waits that long for more messages before dispatch.
+    Sessions are retired after ``cfg.upstream_max_messages`` transactions
+    or ``cfg.upstream_idle_timeout`` seconds without work.
+    """
+
+    def __init__(self, cfg: RelayConfig, reactor=None,
+                 upstream: Upstream | None = None) -> None:  # type: ignore[no-untyped-def]
+        if reactor is None:
+            from twisted.internet import reactor
+        self.cfg = cfg
+        self.upstream = upstream or cfg.upstream_hosts()[0]
+        self.trust_root: Certificate | None = None
+        if self.upstream.ca_file:
+            # Trust only this CA (e.g. a test upstream's self-signed
+            # certificate) instead of the platform's.
+            with open(self.upstream.ca_file, "rb") as f:
+                self.trust_root = Certificate.loadPEM(f.read())
+        self._reactor = reactor
+        self._queue: Deque[_Job] = deque()
+        self._idle: List[_PooledSender] = []
+        self._open: Set[_PooledSender] = set()
+        self._connecting = 0
+        self._linger_call: IDelayedCall | None = None
+
+    def size(self) -> int:
+        return len(self._open) + self._connecting
+
+    def idle_count(self) -> int:
+        return len(self._idle)
+
+    def queued(self) -> int:
+        return len(self._queue)
+
+    def send(
+        self,
+        from_addr: str,
+        to_addrs: List[str],
+        open_data: Callable[[], BinaryIO],
+        trace: MessageTrace | None = None,
+    ) -> defer.Deferred[object]:
+        """
+        Queue one message. ``open_data`` is called each time the message
+        body is needed and must return a fresh binary file positioned at
+        the start of the message.
+        """
+        d: defer.Deferred[object] = defer.Deferred(self._cancel)
+        job = _Job(from_addr=from_addr, to_addrs=list(to_addrs),
+                   open_data=open_data, deferred=d, trace=trace)
+        self._queue.append(job)
+        linger = self.cfg.upstream_batch_linger_ms
+        if linger and len(self._queue) < self.cfg.upstream_batch_size:
+            if self._linger_call is None:
+                self._linger_call = self._reactor.callLater(
+                    linger / 1000.0, self._lingerExpired
+                )
+        else:
+            self._dispatch()
+        return d
+
+    def close(self) -> None:
+        while self._idle:
+            self._retire(self._idle.pop())
+
+    def _cancel(self, d: defer.Deferred[object]) -> None:
+        for job in self._queue:
+            if job.deferred is d:
+                self._queue.remove(job)
+                return
+
+    def _lingerExpired(self) -> None:
+        self._linger_call = None
+        self._dispatch()
+
+    def _takeBatch(self, conn: _PooledSender) -> List[_Job]:
+        n = min(self.cfg.upstream_batch_size,
+                self.cfg.upstream_max_messages - conn.messages_sent,
+                len(self._queue))
+        return [self._queue.popleft() for _ in range(n)]
+
+    def _dispatch(self) -> None:
+        if self._linger_call is not None and self._linger_call.active():
+            self._linger_call.cancel()
+        self._linger_call = None
+        while self._queue and self._idle:
+            conn = self._idle.pop()
+            self._cancelIdle(conn)
+            conn.deliver(self._takeBatch(conn))
+        batch = self.cfg.upstream_batch_size
+        while (len(self._queue) > self._connecting * batch
+               and self.size() < self.upstream.max_connections):
+            self._connecting += 1
+            self._reactor.connectTCP(self.upstream.host, self.upstream.port,
+                                     _PooledSenderFactory(self))
+
+    def _connectionReady(self, conn: _PooledSender) -> None:
+        if conn not in self._open:
+            self._connecting -= 1
+            self._open.add(conn)
+        if conn.messages_sent >= self.cfg.upstream_max_messages:
+            self._retire(conn)
+            self._dispatch()
+            return
+        if self._queue:
+            conn.deliver(self._takeBatch(conn))
+            return
+        conn.park()
+        conn.idle_call = self._reactor.callLater(
+            self.cfg.upstream_idle_timeout, self._idleTimeout, conn
+        )
+        self._idle.append(conn)
+
+    def _idleTimeout(self, conn: _PooledSender) -> None:
+        conn.idle_call = None
+        if conn in self._idle:
+            self._idle.remove(conn)
+            self._retire(conn)
+
+    def _cancelIdle(self, conn: _PooledSender) -> None:
+        if conn.idle_call is not None and conn.idle_call.active():
+            conn.idle_call.cancel()
+        conn.idle_call = None
+
+    def _retire(self, conn: _PooledSender) -> None:
+        self._cancelIdle(conn)
+        self._open.discard(conn)
+        conn.quit()
+
+    def _connectFailed(self, reason) -> None:  # type: ignore[no-untyped-def]
+        self._connecting -= 1
+        self._failOne(smtp.SMTPConnectError(
+            -1, "Unable to connect to SMTP server: " + str(reason.value)
+        ))
+        self._dispatch()
+
+    def _connectionLost(
+        self,
+        conn: _PooledSender,
+        job: _Job | None,
+        data_sent: bool,
+        unsent: List[_Job],
+        error: Exception,
+    ) -> None:
+        if conn in self._idle:
+            self._idle.remove(conn)
+        if conn in self._open:
+            self._open.discard(conn)
+        elif not conn.ready:
+            self._connecting -= 1
+        # Messages batched onto this session but never started go back to
+        # the front of the queue in their original order.
+        self._queue.extendleft(reversed(unsent))
+        if not conn.ready:
+            # The handshake never completed; the error belongs to whichever
+            # message was waiting for this connection.
+            self._failOne(error)
+        if job is not None:
+            if conn.messages_sent > 1 and not data_sent and not job.requeued:
+                # A reused session went away underneath us before the
+                # message was transferred; try once more on a fresh one.
+                log.msg("Upstream session dropped, requeueing message")
+                job.requeued = True
+                self._queue.appendleft(job)
+            else:
+                job.deferred.errback(error)
+        self._dispatch()
+
+    def _failOne(self, error: Exception) -> None:
+        # Only give up on a message when no other session could pick it up.
+        if self._queue and not self._open and not self._connecting:
+            self._queue.popleft().deferred.errback(error)
@@ -1,14 +1,101 @@
 from __future__ import annotations
 
+import functools
+import io
+import re
+from collections import deque
+from dataclasses import dataclass
 from email import policy, message_from_bytes
 from email.message import EmailMessage
+from typing import Any, BinaryIO, Callable, Deque, Dict, List, Tuple
 
-from twisted.internet import defer, reactor
-from twisted.internet.ssl import optionsForClientTLS
+from twisted.internet import defer
 from twisted.mail import smtp
+from twisted.python.failure import Failure
 
 from .config import RelayConfig
 from .models import InboundMeta
+from .offload import Offloader
+from .pool import UpstreamPool
+from .tracing import MessageTrace
+
+# RFC 5322 field-name: printable US-ASCII except ':'.
+_FIELD_RE = re.compile(rb"^([\x21-\x39\x3b-\x7e]+)[ \t]*:")
+_MAX_HEADER_LINE = 900
+
+
+@dataclass(frozen=True, slots=True)
+class HeaderInfo:
+    fields: Dict[str, str]
+    malformed: bool
+
+    @property
+    def subject(self) -> str | None:
+        return self.fields.get("subject")
+
+    @property
+    def message_id(self) -> str | None:
+        return self.fields.get("message-id")
+
+
+def parse_headers(block: bytes) -> HeaderInfo:
+    """
+    Scan a message header block once, without building an email.message
+    tree. Only the first occurrence of each field is kept; values are
+    unfolded but otherwise returned as sent.
+    """
+    fields: Dict[str, str] = {}
+    malformed = False
+    name: str | None = None
+    parts: List[bytes] = []
+
+    def _flush() -> None:
+        if name is not None and name not in fields:
+            value = b"".join(parts).strip().decode("utf-8", errors="replace")
+            if value:
+                fields[name] = value
+
+    for line in block.split(b"\n"):
+        if not line:
+            continue
+        if line[:1] in (b" ", b"\t"):
+            if name is None:
+                malformed = True
+            else:
+                parts.append(line)
+            continue
+        m = _FIELD_RE.match(line)
+        if m is None:
+            malformed = True
+            continue
+        _flush()
+        name = m.group(1).decode("ascii").lower()
+        parts = [line[m.end():]]
+    _flush()
+    return HeaderInfo(fields=fields, malformed=malformed)
+
+
+class _PrefixedReader(io.BufferedIOBase):
+    def __init__(self, prefix: bytes, f: BinaryIO) -> None:
+        super().__init__()
+        self._prefix = prefix
+        self._file = f
+
+    def readable(self) -> bool:
+        return True
+
+    def read(self, size: int | None = -1) -> bytes:
+        if not self._prefix:
+            return self._file.read(size)
+        if size is None or size < 0:
+            data, self._prefix = self._prefix + self._file.read(), b""
+            return data
+        data, self._prefix = self._prefix[:size], self._prefix[size:]
+        return data
+
+    def close(self) -> None:
+        self._file.close()
+        super().close()
 
 
 def _as_email_message(raw_bytes: bytes) -> EmailMessage:
@@ -37,39 +124,221 @@ def add_x_headers(msg: EmailMessage, meta: InboundMeta) -> None:
     msg["X-Original-Rcpt-To"] = ", ".join(meta.envelope_to)
 
 
-def extract_subject(raw_bytes: bytes) -> str | None:
-    msg = message_from_bytes(raw_bytes)
-    try:
-        subject = msg.get("Subject")
-        if subject is None:
-            return None
-        subject = str(subject).strip()
-        return subject if subject else None
-    except Exception:
-        return None
+def repair_message(raw_bytes: bytes, meta: InboundMeta) -> bytes:
+    msg = _as_email_message(raw_bytes)
+    add_x_headers(msg, meta)
+    return msg.as_bytes()
+
+
+def _read_all(open_message: Callable[[], BinaryIO]) -> bytes:
+    with open_message() as f:
+        return f.read()
+
+
+def x_header_bytes(meta: InboundMeta) -> bytes:
+    """Render the X-Original-* headers added by add_x_headers as raw bytes."""
+    def _clean(value: str) -> str:
+        return value.replace("\r", " ").replace("\n", " ")
+
+    rcpts = [_clean(a) for a in meta.envelope_to]
+    rcpt_value = ", ".join(rcpts)
+    if len(rcpt_value) > _MAX_HEADER_LINE:
+        rcpt_value = ",\n ".join(rcpts)
+    lines = [f"X-Original-Peer: {_clean(meta.peer)}"]
+    if meta.helo:
+        lines.append(f"X-Original-HELO: {_clean(meta.helo)}")
+    lines.append(f"X-Original-Mail-From: {_clean(meta.envelope_from)}")
+    lines.append(f"X-Original-Rcpt-To: {rcpt_value}")
+    return "".join(line + "\n" for line in lines).encode("utf-8")
+
+
+def extract_subject(header_block: bytes) -> str | None:
+    return parse_headers(header_block).subject
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float,
+                 clock: Callable[[], float]) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self._clock = clock
+        self._tokens = capacity
+        self._stamp = clock()
+
+    def _refill(self) -> None:
+        now = self._clock()
+        self._tokens = min(self.capacity,
+                           self._tokens + (now - self._stamp) * self.rate)
+        self._stamp = now
+
+    def available(self) -> float:
+        self._refill()
+        return self._tokens
+
+    def delay(self, n: float) -> float:
+        # A single request larger than the bucket waits for a full bucket
+        # rather than forever.
+        n = min(n, self.capacity)
+        self._refill()
+        if self._tokens >= n - 1e-9:
+            return 0.0
+        return (n - self._tokens) / self.rate
+
+    def take(self, n: float) -> None:
+        self._refill()
+        self._tokens -= min(n, self.capacity)
+
+
+def is_permanent(failure: Failure) -> bool:
+    # A 5xx reply that resending, to this upstream or another, won't fix.
+    if not failure.check(smtp.SMTPClientError):
+        return False
+    # Gmail reports an exhausted sending quota as "550 5.4.5"; it clears.
+    if "5.4.5" in failure.getErrorMessage():
+        return False
+    return 500 <= failure.value.code < 600
+
+
+_SendJob = Tuple[str, List[str], Callable[[], BinaryIO], "defer.Deferred[object]",
+                 MessageTrace | None, Dict[str, Any]]
+
+
+class SendScheduler:
+    """
+    Paces sends to the upstream's quotas (messages/second, recipients/minute,
+    messages/day). Sends over quota wait in a FIFO queue instead of being
+    attempted and failing.
+    """
+
+    def __init__(self, cfg: RelayConfig, pool: UpstreamPool,
+                 reactor=None) -> None:  # type: ignore[no-untyped-def]
+        if reactor is None:
+            from twisted.internet import reactor
+        self._pool = pool
+        self._reactor = reactor
+        self._queue: Deque[_SendJob] = deque()
+        self._wakeup = None
+        clock = reactor.seconds
+        # name -> (bucket, counts recipients rather than messages)
+        self._buckets: Dict[str, Tuple[TokenBucket, bool]] = {}
+        if cfg.upstream_msgs_per_sec:
+            rate = cfg.upstream_msgs_per_sec
+            self._buckets["msgs_per_sec"] = (
+                TokenBucket(rate, max(1.0, rate), clock), False)
+        if cfg.upstream_rcpts_per_min:
+            limit = cfg.upstream_rcpts_per_min
+            self._buckets["rcpts_per_min"] = (
+                TokenBucket(limit / 60.0, limit, clock), True)
+        if cfg.upstream_msgs_per_day:
+            limit = cfg.upstream_msgs_per_day
+            self._buckets["msgs_per_day"] = (
+                TokenBucket(limit / 86400.0, limit, clock), False)
+
+    def queued(self) -> int:
+        return len(self._queue)
+
+    def send(self, from_addr: str, to_addrs: List[str],
+             open_data: Callable[[], BinaryIO],
+             trace: MessageTrace | None = None, **pool_args: Any) -> defer.Deferred[object]:
+        # ``pool_args`` are passed on to the pool's send().
+        d: defer.Deferred[object] = defer.Deferred()
+        self._queue.append((from_addr, list(to_addrs), open_data, d, trace, pool_args))
+        self._pump()
+        return d
+
+    def _wait(self, rcpts: int) -> float:
+        return max((bucket.delay(rcpts if per_rcpt else 1)
+                    for bucket, per_rcpt in self._buckets.values()), default=0.0)
+
+    def _pump(self) -> None:
+        if self._wakeup is not None:
+            return
+        while self._queue:
+            from_addr, to_addrs, open_data, d, trace, pool_args = self._queue[0]
+            wait = self._wait(len(to_addrs))
+            if wait > 0:
+                self._wakeup = self._reactor.callLater(wait, self._wake)
+                return
+            self._queue.popleft()
+            for bucket, per_rcpt in self._buckets.values():
+                bucket.take(len(to_addrs) if per_rcpt else 1)
+            if trace is None:
+                sent = self._pool.send(from_addr, to_addrs, open_data, **pool_args)
+            else:
+                trace.mark("quota")
+                sent = self._pool.send(from_addr, to_addrs, open_data, trace, **pool_args)
+            sent.chainDeferred(d)
+
+    def _wake(self) -> None:
+        self._wakeup = None
+        self._pump()
+
+    def drain_seconds(self) -> float:
+        """
+        Estimated time until everything queued now has been let through,
+        going by quota alone.
+        """
+        msgs = len(self._queue)
+        rcpts = sum(len(job[1]) for job in self._queue)
+        eta = 0.0
+        for bucket, per_rcpt in self._buckets.values():
+            need = rcpts if per_rcpt else msgs
+            eta = max(eta, (need - bucket.available()) / bucket.rate)
+        return eta
+
+    def gauges(self) -> Dict[str, int]:
+        values = {
+            "upstream_queued": len(self._queue),
+            "upstream_drain_seconds": int(self.drain_seconds() + 0.999),
+        }
+        for name, (bucket, _) in self._buckets.items():
+            values[f"quota_{name}_used"] = int(bucket.capacity - bucket.available())
+            values[f"quota_{name}_limit"] = int(bucket.capacity)
+        return values
 
 
 def relay_to_gmail(
     cfg: RelayConfig,
-    raw_message: bytes,
+    pool: UpstreamPool | SendScheduler,
+    open_message: Callable[[], BinaryIO],
     meta: InboundMeta,
-) -> defer.Deferred[None]:
-    msg = _as_email_message(raw_message)
-    if cfg.add_x_headers:
-        add_x_headers(msg, meta)
-    msg_bytes = msg.as_bytes()
-
-    context = optionsForClientTLS(hostname=cfg.gmail_host)
-
-    d: defer.Deferred[None] = smtp.sendmail(
-        cfg.gmail_host,
-        cfg.relay_from,
-        cfg.forward_to,
-        msg_bytes,
-        port=cfg.gmail_port,
-        username=cfg.gmail_username,
-        password=cfg.gmail_app_password,
-        requireTransportSecurity=True,
-        reactor=reactor
-    )
-    return d
+    malformed: bool = False,
+    offload: Offloader | None = None,
+    size_bytes: int = 0,
+    to_addrs: List[str] | None = None,
+    upstream: str | None = None,
+    trace: MessageTrace | None = None,
+) -> defer.Deferred[object]:
+    """
+    Send one spooled message to ``to_addrs`` (default FORWARD_TO), through
+    the named upstream when ``upstream`` is given. Stages are marked on
+    ``trace`` from here to the upstream's reply.
+    """
+    rcpts = cfg.forward_to if to_addrs is None else to_addrs
+    kwargs: Dict[str, object] = {}
+    if upstream is not None:
+        kwargs["upstream"] = upstream
+    if trace is not None:
+        kwargs["trace"] = trace
+    send = functools.partial(pool.send, **kwargs)
+
+    def _prepared(*args: object) -> defer.Deferred[object]:
+        if trace is not None:
+            trace.mark("prepare")
+        return send(*args)
+
+    if not cfg.add_x_headers:
+        return _prepared(cfg.relay_from, rcpts, open_message)
+
+    if malformed:
+        # Let the email package repair the structure before adding headers;
+        # for large messages this runs off the reactor thread.
+        off = offload or Offloader()
+        d = off.run(size_bytes, _read_all, open_message)
+        d.addCallback(lambda raw: off.run_cpu(size_bytes, repair_message, raw, meta))
+        d.addCallback(lambda msg_bytes: _prepared(cfg.relay_from, rcpts,
+                                                  lambda: io.BytesIO(msg_bytes)))
+        return d
+
+    prefix = x_header_bytes(meta)
+    return _prepared(cfg.relay_from, rcpts, lambda: _PrefixedReader(prefix, open_message()))
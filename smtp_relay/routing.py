@@ -0,0 +1,95 @@
+from __future__ import annotations
+
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Tuple
+
+from .config import RelayConfig, RouteRule
+
+
+@dataclass(frozen=True, slots=True)
+class Route:
+    # Empty destinations: deliver to the original recipient.
+    destinations: Tuple[str, ...]
+    upstream: str | None = None
+
+
+# (upstream name or None, recipients) for one upstream transaction.
+Transaction = Tuple[str | None, Tuple[str, ...]]
+
+
+def _norm(addr: str) -> str:
+    return addr.strip().lower()
+
+
+class RoutingTable:
+    """
+    Recipient routes compiled into dicts: exact addresses, whole domains,
+    and domain suffixes keyed by the part after the leading dot, so a
+    lookup costs one dict probe per domain label at most. The most
+    specific match wins: address, then domain, then the longest suffix,
+    then the ``*`` default.
+    """
+
+    def __init__(self, rules: Iterable[RouteRule]) -> None:
+        self._exact: Dict[str, Route] = {}
+        self._domains: Dict[str, Route] = {}
+        self._suffixes: Dict[str, Route] = {}
+        self._default: Route | None = None
+        for rule in rules:
+            route = Route(tuple(rule.destinations), rule.upstream)
+            pattern = _norm(rule.pattern)
+            if pattern == "*":
+                self._default = route
+            elif pattern.startswith(("*.", ".")):
+                self._suffixes[pattern.lstrip("*.")] = route
+            elif pattern.startswith(("*@", "@")):
+                self._domains[pattern.lstrip("*@")] = route
+            else:
+                self._exact[pattern] = route
+
+    @classmethod
+    def from_config(cls, cfg: RelayConfig) -> "RoutingTable":
+        if cfg.routes:
+            return cls(cfg.routes)
+        # No ROUTES_FILE: everything goes to FORWARD_TO, and with
+        # ALLOW_ANY_RCPT off only those addresses are accepted.
+        dests = tuple(cfg.forward_to)
+        if cfg.allow_any_rcpt:
+            return cls([RouteRule("*", dests)])
+        return cls([RouteRule(addr, dests) for addr in cfg.forward_to])
+
+    def lookup(self, rcpt: str) -> Route | None:
+        addr = _norm(rcpt)
+        route = self._exact.get(addr)
+        if route is not None:
+            return route
+        domain = addr.rpartition("@")[2]
+        route = self._domains.get(domain)
+        if route is not None:
+            return route
+        if self._suffixes:
+            dot = domain.find(".")
+            while dot >= 0:
+                route = self._suffixes.get(domain[dot + 1:])
+                if route is not None:
+                    return route
+                dot = domain.find(".", dot + 1)
+        return self._default
+
+    def split(self, recipients: Iterable[str]) -> List[Transaction]:
+        """
+        One transaction per distinct (upstream, destinations) among the
+        recipients' routes, in first-seen order. Recipients routed to
+        themselves are grouped per upstream. Unroutable recipients are
+        left out.
+        """
+        groups: Dict[Tuple[str | None, Tuple[str, ...]], List[str]] = {}
+        for rcpt in recipients:
+            route = self.lookup(rcpt)
+            if route is None:
+                continue
+            targets = groups.setdefault((route.upstream, route.destinations), [])
+            for addr in route.destinations or (rcpt,):
+                if addr not in targets:
+                    targets.append(addr)
+        return [(upstream, tuple(targets)) for (upstream, _), targets in groups.items()]
@@ -1,138 +1,461 @@
 from __future__ import annotations
 
+import re
+import time
 from typing import List
 
 from twisted.internet import defer
 from twisted.mail import smtp
 from twisted.python import log
+from twisted.python.failure import Failure
 
+from .admission import AdmissionController
 from .config import RelayConfig
-from .models import InboundMeta, RelayAttempt, utc_now
-from .relay_client import extract_subject, relay_to_gmail
+from .delivery import DeliveryScheduler
+from .metrics import Metrics
+from .models import InboundMeta
+from .offload import Offloader
+from .relay_client import parse_headers
+from .routing import RoutingTable
+from .spool import Spool, SpoolEntry
 from .store import MessageStore
+from .tracing import MessageTrace
 
 from zope.interface import implementer
 
-def _norm_addr(addr: str) -> str:
-    return addr.strip().lower()
-
-
 def _decode_addr(addr: smtp.Address) -> str:
     return str(addr)
 
+
+_SIZE_PARAM_RE = re.compile(rb"(?:^|\s)SIZE=(\S*)", re.I)
+_TOO_BIG = b"5.3.4 Message size exceeds fixed maximum message size"
+_BDAT_RE = re.compile(rb"^(\d+)(?:\s+(LAST))?$", re.I)
+
+
+def _declared_size(opts: bytes | None) -> int | None:
+    # The SIZE= parameter of MAIL FROM (RFC 1870); ValueError if malformed.
+    m = _SIZE_PARAM_RE.search(opts or b"")
+    if m is None:
+        return None
+    if not m.group(1).isdigit():
+        raise ValueError(m.group(1))
+    return int(m.group(1))
+
+
+def _decode_helo(helo) -> str | None:  # type: ignore[no-untyped-def]
+    # twisted passes (helo name, peer ip) as bytes
+    if not helo or not helo[0]:
+        return None
+    return helo[0].decode("utf-8", "replace")
+
 @implementer(smtp.IMessage)
 class _Message:
-    def __init__(self, cfg: RelayConfig, store: MessageStore, meta: InboundMeta) -> None:
-        self._cfg = cfg
+    def __init__(self, store: MessageStore, spool: Spool,
+                 scheduler: DeliveryScheduler, meta: InboundMeta,
+                 metrics: Metrics, offload: Offloader, trace: MessageTrace,
+                 max_size: int = 0) -> None:
         self._store = store
+        self._spool = spool
+        self._scheduler = scheduler
         self._meta = meta
-        self._lines: List[bytes] = []
+        self._metrics = metrics
+        self._offload = offload
+        self._trace = trace
+        trace.mark("envelope")
+        self._started = time.monotonic()
+        self._writer = spool.writer(meta)
+        self._committing = False
+        self._max_size = max_size
+
+    def _check_size(self, added: int) -> None:
+        if self._max_size and self._writer.size + added > self._max_size:
+            # Twisted drops the rest of the data and sends this error after
+            # the final dot; connectionLost() discards what was written.
+            self._metrics.oversized_messages.inc()
+            raise smtp.SMTPServerError(552, _TOO_BIG)
 
     def lineReceived(self, line: bytes) -> None:
-        self._lines.append(line)
+        self._check_size(len(line) + 1)
+        self._writer.append_line(line)
+
+    def write(self, data: bytes) -> None:
+        # BDAT chunk data, already in the spool's LF line endings.
+        self._check_size(len(data))
+        self._writer.write(data)
 
     def eomReceived(self) -> defer.Deferred[None]:
-        raw = b"\n".join(self._lines) + b"\n"
-        subject = extract_subject(raw)
+        # Large messages are fsynced off the reactor thread.
+        self._trace.mark("data")
+        self._committing = True
+        d = self._offload.run(self._writer.size, self._writer.commit)
+        d.addCallbacks(self._committed, self._commitFailed)
+        return d
+
+    def _commitFailed(self, failure: Failure) -> Failure:
+        failure.trap(OSError)
+        self._writer.discard()
+        log.err(failure, "Failed to spool message")
+        return Failure(smtp.SMTPServerError(451, "Local error spooling message"))
+
+    def _committed(self, entry: SpoolEntry) -> None:
+        # The message is safely spooled, so the client gets its 250 whatever
+        # happens next; a message that could not be queued is handed back to
+        # the scheduler to retry from the spool. Failing here would only make
+        # the client send it again.
+        try:
+            self._queue(entry)
+        except Exception:
+            log.err(None, f"Failed to queue spooled message {entry.spool_id}")
+            self._scheduler.requeue(entry)
+
+    def _queue(self, entry: SpoolEntry) -> None:
+        self._trace.mark("spool")
+        w = self._writer
+        m = self._metrics
+        m.data_seconds.observe(time.monotonic() - self._started)
+        m.received_messages.inc()
+        m.received_bytes.inc(w.size)
+        m.message_size.observe(w.size)
+        info = parse_headers(w.headers)
         msg_id = self._store.add_received(
             peer=self._meta.peer,
             helo=self._meta.helo,
             envelope_from=self._meta.envelope_from,
             envelope_to=self._meta.envelope_to,
-            subject=subject,
-            raw_bytes=raw,
+            subject=info.subject,
+            sha256=w.sha256,
+            size_bytes=w.size,
         )
-        attempt = RelayAttempt(started_at=utc_now(), finished_at=None, ok=False,
-                              error=None)
+        self._trace.mark("parse")
+        self._scheduler.submit(entry, msg_id, info.malformed, w.size, w.sha256,
+                               trace=self._trace)
 
-        d = relay_to_gmail(self._cfg, raw, self._meta)
+    def connectionLost(self) -> None:
+        # Once committing, the message is ours whether or not the client
+        # stays for the reply.
+        if not self._committing:
+            self._writer.discard()
 
-        def _ok(_: object) -> None:
-            finished = RelayAttempt(
-                started_at=attempt.started_at,
-                finished_at=utc_now(),
-                ok=True,
-                error=None,
-            )
-            self._store.set_relay_attempt(msg_id, finished)
-
-        def _fail(failure):  # type: ignore[no-untyped-def]
-            finished = RelayAttempt(
-                started_at=attempt.started_at,
-                finished_at=utc_now(),
-                ok=False,
-                error=str(getattr(failure, "getErrorMessage", lambda: failure)()),
-            )
-            self._store.set_relay_attempt(msg_id, finished)
-            log.err(failure, "Failed to relay message to Gmail")
-            return None
 
-        d.addCallback(_ok)
-        d.addErrback(_fail)
-        return d
+@implementer(smtp.IMessage)
+class _NullMessage:
+    # Twisted asks for one message per recipient; the transaction's first
+    # recipient gets the real message, the rest get this.
+    def lineReceived(self, line: bytes) -> None:
+        pass
+
+    def write(self, data: bytes) -> None:
+        pass
+
+    def eomReceived(self) -> defer.Deferred[None]:
+        return defer.succeed(None)
 
     def connectionLost(self) -> None:
-        self._lines.clear()
+        pass
 
 @implementer(smtp.IMessageDelivery)
 class _Delivery:
-    def __init__(self, cfg: RelayConfig, store: MessageStore) -> None:
+    def __init__(self, cfg: RelayConfig, store: MessageStore, spool: Spool,
+                 scheduler: DeliveryScheduler, admission: AdmissionController,
+                 metrics: Metrics, offload: Offloader, routes: RoutingTable) -> None:
         self._cfg = cfg
+        self._routes = routes
         self._store = store
+        self._spool = spool
+        self._scheduler = scheduler
+        self._admission = admission
+        self._metrics = metrics
+        self._offload = offload
         self._peer = "unknown"
         self._helo: str | None = None
         self._mail_from = ""
         self._rcpt_tos: List[str] = []
+        self._message: _Message | None = None
+        self._trace: MessageTrace | None = None
+        # Until the session's first MAIL, so its trace covers the greeting.
+        self._connected_at: float | None = None
 
     def receivedHeader(self, helo: smtp.IHelo, origin, recipients):  # type: ignore[no-untyped-def]
         return None
 
     def validateFrom(self, helo: smtp.IHelo, origin: smtp.Address):  # type: ignore[no-untyped-def]
-        self._helo = getattr(helo, "host", None) if helo else None
+        # MAIL starts a new transaction (twisted's RSET only clears its own
+        # state, so reset ours here).
+        self._admission.check_mail()
+        self._helo = _decode_helo(helo)
         self._mail_from = _decode_addr(origin)
+        self._rcpt_tos = []
+        self._message = None
+        if self._connected_at is not None:
+            self._trace = MessageTrace(self._connected_at)
+            self._trace.mark("greeting")
+            self._connected_at = None
+        else:
+            self._trace = MessageTrace()
         return origin
 
     def validateTo(self, user: smtp.User):  # type: ignore[no-untyped-def]
         rcpt = _decode_addr(user.dest)
-        if not self._cfg.allow_any_rcpt:
-            allowed = {_norm_addr(a) for a in self._cfg.forward_to}
-            if _norm_addr(rcpt) not in allowed:
-                raise smtp.SMTPBadRcpt(user, b"550 relaying denied")
+        if self._routes.lookup(rcpt) is None:
+            raise smtp.SMTPBadRcpt(user, 550, "Relaying denied")
         self._rcpt_tos.append(rcpt)
 
-        def _mk() -> _Message:
+        def _mk() -> _Message | _NullMessage:
+            if self._message is not None:
+                return _NullMessage()
             meta = InboundMeta(
                 peer=self._peer,
                 helo=self._helo,
                 envelope_from=self._mail_from,
                 envelope_to=list(self._rcpt_tos),
             )
-            return _Message(self._cfg, self._store, meta)
+            self._message = _Message(self._store, self._spool, self._scheduler, meta,
+                                     self._metrics, self._offload,
+                                     self._trace or MessageTrace(),
+                                     self._cfg.max_message_size)
+            return self._message
 
         return _mk
 
     def setPeer(self, peer: str) -> None:
         self._peer = peer
+        self._connected_at = time.monotonic()
+
+
+def _resp_bytes(resp) -> bytes:  # type: ignore[no-untyped-def]
+    return resp if isinstance(resp, bytes) else str(resp).encode("utf-8")
 
 
 class _PeerTrackingESMTP(smtp.ESMTP):
+    _admitted = False
+    # Input not yet handed to lineReceived() or to a BDAT chunk.
+    _inbuf = b""
+    _inpos = 0
+    _draining = False
+    # Set while the reply to the end of a message is pending, so that
+    # pipelined commands behind it are answered after it.
+    _awaiting_reply = False
+    # The BDAT transaction: its messages (None outside one), the bytes of
+    # the current chunk still to come, and a CR held back from the end of
+    # the previous chunk in case it starts a CRLF.
+    _chunk_msgs: List[smtp.IMessage] | None = None
+    _chunk_left = 0
+    _chunk_size = 0
+    _chunk_last = False
+    _chunk_error: tuple | None = None
+    _chunk_cr = b""
+
     def connectionMade(self) -> None:
-        super().connectionMade()
         peer = self.transport.getPeer()
+        admission = self.factory.admission  # type: ignore[attr-defined]
+        refusal = admission.open_session(peer.host, self.transport)
+        if refusal is not None:
+            self.sendCode(421, refusal)
+            self.transport.loseConnection()
+            return
+        self._admitted = True
+        super().connectionMade()
         peer_str = f"{peer.host}:{peer.port}"
-        delivery = self.factory.delivery  # type: ignore[attr-defined]
+        delivery = self.delivery
         if hasattr(delivery, "setPeer"):
             delivery.setPeer(peer_str)
 
+    def connectionLost(self, reason):  # type: ignore[no-untyped-def]
+        self._inbuf = b""
+        self._inpos = 0
+        self._abort_chunks()
+        super().connectionLost(reason)
+        if self._admitted:
+            self.factory.admission.close_session(  # type: ignore[attr-defined]
+                self.transport.getPeer().host, self.transport)
+
+    def extensions(self):  # type: ignore[no-untyped-def]
+        ext = super().extensions()
+        limit = self.factory.max_message_size  # type: ignore[attr-defined]
+        # A bare SIZE means the client may declare sizes but there is no limit.
+        ext[b"SIZE"] = [str(limit).encode("ascii")] if limit else None
+        ext[b"PIPELINING"] = None
+        ext[b"CHUNKING"] = None
+        return ext
+
+    def dataReceived(self, data: bytes) -> None:
+        # LineOnlyReceiver.dataReceived, except that BDAT chunks are read
+        # as raw bytes and nothing is read while a message reply is pending.
+        self._inbuf += data
+        self._drain()
+
+    def _drain(self) -> None:
+        if self._draining:
+            return
+        self._draining = True
+        try:
+            while not self._awaiting_reply and not self.transport.disconnecting:
+                buf, pos = self._inbuf, self._inpos
+                if pos >= len(buf):
+                    break
+                if self._chunk_left:
+                    end = min(len(buf), pos + self._chunk_left)
+                    self._inpos = end
+                    self.resetTimeout()
+                    self._chunk_received(buf[pos:end])
+                    continue
+                eol = buf.find(self.delimiter, pos)
+                if eol < 0:
+                    if len(buf) - pos > self.MAX_LENGTH:
+                        self.lineLengthExceeded(buf[pos:])
+                    break
+                self._inpos = eol + len(self.delimiter)
+                line = buf[pos:eol]
+                if len(line) > self.MAX_LENGTH:
+                    self.lineLengthExceeded(line)
+                    break
+                self.lineReceived(line)
+        finally:
+            self._inbuf = self._inbuf[self._inpos:]
+            self._inpos = 0
+            self._draining = False
+
+    def _resume(self) -> None:
+        self._awaiting_reply = False
+        self._drain()
+
+    def state_DATA(self, line):  # type: ignore[no-untyped-def]
+        if line == b"." and not self.datafailed:
+            self._awaiting_reply = True
+        smtp.ESMTP.dataLineReceived(self, line)
+
+    def do_BDAT(self, rest):  # type: ignore[no-untyped-def]
+        m = _BDAT_RE.match(rest.strip())
+        if m is None:
+            # Without a size there is no telling where the chunk ends.
+            self.sendCode(501, b"5.5.4 Syntax: BDAT <size> [LAST]")
+            self.transport.loseConnection()
+            return
+        self._chunk_size = self._chunk_left = int(m.group(1))
+        self._chunk_last = m.group(2) is not None
+        self._chunk_error = None
+        if self._chunk_msgs is None:
+            self._chunk_error = self._start_chunks()
+        if not self._chunk_left:
+            self._chunk_done()
+
+    def _start_chunks(self) -> tuple | None:
+        # As do_DATA, for the first chunk of a transaction.
+        if self._from is None or not self._to:
+            return 503, b"5.5.1 Need MAIL and RCPT before BDAT"
+        helo, origin, recipients = self._helo, self._from, self._to
+        self._from = None
+        self._to = []
+        msgs: List[smtp.IMessage] = []
+        try:
+            for user, msgFunc in recipients:
+                msg = msgFunc()
+                msgs.append(msg)
+                rcvdhdr = self.receivedHeader(helo, origin, [user])
+                if rcvdhdr:
+                    msg.lineReceived(rcvdhdr)
+        except smtp.SMTPServerError as e:
+            self._disconnect(msgs)
+            return e.code, _resp_bytes(e.resp)
+        self._chunk_msgs = msgs
+        return None
+
+    def _chunk_received(self, data: bytes) -> None:
+        self._chunk_left -= len(data)
+        if self._chunk_error is None:
+            # The spool keeps LF line endings, as the DATA path writes them.
+            data = self._chunk_cr + data
+            self._chunk_cr = b""
+            if data.endswith(b"\r"):
+                data, self._chunk_cr = data[:-1], b"\r"
+            self._write_chunk(data.replace(b"\r\n", b"\n"))
+        if not self._chunk_left:
+            self._chunk_done()
+
+    def _write_chunk(self, data: bytes) -> None:
+        try:
+            for msg in self._chunk_msgs or ():
+                msg.write(data)
+        except smtp.SMTPServerError as e:
+            # The rest of the chunk is read and dropped; the client must not
+            # send more chunks for this transaction after the error reply.
+            self._chunk_error = e.code, _resp_bytes(e.resp)
+            self._abort_chunks()
+
+    def _chunk_done(self) -> None:
+        if self._chunk_last and self._chunk_cr and self._chunk_error is None:
+            self._chunk_cr = b""
+            self._write_chunk(b"\r")
+        if self._chunk_error is not None:
+            self.sendCode(*self._chunk_error)
+        elif not self._chunk_last:
+            self.sendCode(250, b"2.0.0 %d octets received" % self._chunk_size)
+        else:
+            msgs, self._chunk_msgs = self._chunk_msgs or [], None
+            self._awaiting_reply = True
+            defer.DeferredList(
+                [m.eomReceived() for m in msgs], consumeErrors=True
+            ).addCallback(self._messageHandled)
+
+    def _abort_chunks(self) -> None:
+        if self._chunk_msgs is not None:
+            self._disconnect(self._chunk_msgs)
+            self._chunk_msgs = None
+        self._chunk_cr = b""
+
+    def do_RSET(self, rest):  # type: ignore[no-untyped-def]
+        self._abort_chunks()
+        super().do_RSET(rest)
+
+    def do_MAIL(self, rest):  # type: ignore[no-untyped-def]
+        if self._chunk_msgs is not None:
+            self.sendCode(503, b"5.5.1 BDAT transaction in progress")
+            return
+        m = None if self._from else self.mail_re.match(rest)
+        if m is not None:
+            try:
+                declared = _declared_size(m.group("opts"))
+            except ValueError:
+                self.sendCode(501, b"5.5.4 Syntax error in SIZE parameter")
+                return
+            limit = self.factory.max_message_size  # type: ignore[attr-defined]
+            if declared is not None and limit and declared > limit:
+                self.factory.metrics.oversized_messages.inc()  # type: ignore[attr-defined]
+                self.sendCode(552, _TOO_BIG)
+                return
+        super().do_MAIL(rest)
+
+    def _messageHandled(self, resultList):  # type: ignore[no-untyped-def]
+        # Report local temporary failures (e.g. the spool being unwritable)
+        # with their own code rather than the generic 550.
+        for success, result in resultList:
+            if not success and result.check(smtp.SMTPServerError):
+                self.sendCode(result.value.code, _resp_bytes(result.value.resp))
+                break
+        else:
+            super()._messageHandled(resultList)
+        self._resume()
+
 
 class RelaySMTPFactory(smtp.SMTPFactory):
     protocol = _PeerTrackingESMTP
-    def __init__(self, cfg, store):
-        self.delivery = _Delivery(cfg, store)
+    def __init__(self, cfg, store, spool, scheduler, admission=None, metrics=None,
+                 offload=None, routes=None):
+        self.admission = admission or AdmissionController(cfg)
+        self.metrics = metrics or Metrics()
+        self.offload = offload or Offloader()
+        self.routes = routes or RoutingTable.from_config(cfg)
+        self.max_message_size = cfg.max_message_size
+        self._cfg = cfg
+        self._store = store
+        self._spool = spool
+        self._scheduler = scheduler
         super().__init__()
 
     def buildProtocol(self, addr):
         p = super().buildProtocol(addr)
-        # attach the delivery object so validateFrom/validateTo work
-        p.delivery = self.delivery
+        # one delivery object per session so envelopes never leak between
+        # concurrent connections
+        p.delivery = _Delivery(self._cfg, self._store, self._spool, self._scheduler,
+                               self.admission, self.metrics, self.offload, self.routes)
         return p
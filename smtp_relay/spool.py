@@ -0,0 +1,247 @@
+from __future__ import annotations
+
+import hashlib
+import itertools
+import json
+import os
+import time
+from dataclasses import dataclass
+from typing import BinaryIO, List, Tuple
+
+from twisted.python import log
+
+from .models import InboundMeta
+
+_SUFFIX = ".msg"
+_TMP_SUFFIX = ".tmp"
+_CHUNK = 64 * 1024
+
+# Bytes kept from the start of each message so the header block can be
+# inspected without reading the message back.
+MAX_HEADER_BYTES = 256 * 1024
+
+
+@dataclass(frozen=True, slots=True)
+class SpoolEntry:
+    spool_id: str
+    path: str
+    meta: InboundMeta
+
+
+def _fsync_dir(directory: str) -> None:
+    # Directory fsync makes the rename itself durable; not available on
+    # Windows, where the rename is already journaled by NTFS.
+    if not hasattr(os, "O_DIRECTORY"):
+        return
+    fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _header_block(head: bytes) -> bytes:
+    if head.startswith(b"\n"):
+        return b""
+    end = head.find(b"\n\n")
+    return head if end < 0 else head[:end + 1]
+
+
+def _envelope_line(meta: InboundMeta) -> bytes:
+    return json.dumps({
+        "peer": meta.peer,
+        "helo": meta.helo,
+        "from": meta.envelope_from,
+        "to": meta.envelope_to,
+    }).encode("utf-8") + b"\n"
+
+
+class SpoolWriter:
+    """
+    Accumulates one message as it arrives, keeping a running SHA-256 and
+    size. Small messages stay in memory; once ``spill_threshold`` bytes have
+    been received the data goes to the spool's temporary file instead, so
+    committing never copies the message again.
+    """
+
+    def __init__(self, spool: "Spool", meta: InboundMeta,
+                 spill_threshold: int) -> None:
+        self._spool = spool
+        self._meta = meta
+        self._threshold = spill_threshold
+        self._id = spool._next_id()
+        self._tmp = os.path.join(spool.directory, self._id + _SUFFIX + _TMP_SUFFIX)
+        self._hash = hashlib.sha256()
+        self._size = 0
+        self._head = bytearray()
+        self._mem = bytearray()
+        self._file: BinaryIO | None = None
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    @property
+    def sha256(self) -> str:
+        return self._hash.hexdigest()
+
+    @property
+    def headers(self) -> bytes:
+        return _header_block(bytes(self._head))
+
+    @property
+    def spilled(self) -> bool:
+        return self._file is not None
+
+    def append_line(self, line: bytes) -> None:
+        self.write(line + b"\n")
+
+    def write(self, data: bytes) -> None:
+        self._hash.update(data)
+        self._size += len(data)
+        if len(self._head) < MAX_HEADER_BYTES:
+            self._head += data[:MAX_HEADER_BYTES - len(self._head)]
+        if self._file is not None:
+            self._file.write(data)
+            return
+        self._mem += data
+        if len(self._mem) >= self._threshold:
+            self._file = self._open_tmp()
+            self._file.write(self._mem)
+            self._mem = bytearray()
+
+    def commit(self) -> SpoolEntry:
+        f = self._file if self._file is not None else self._open_tmp()
+        self._file = None
+        try:
+            if self._mem:
+                f.write(self._mem)
+                self._mem = bytearray()
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        path = os.path.join(self._spool.directory, self._id + _SUFFIX)
+        os.replace(self._tmp, path)
+        _fsync_dir(self._spool.directory)
+        return SpoolEntry(spool_id=self._id, path=path, meta=self._meta)
+
+    def discard(self) -> None:
+        self._mem = bytearray()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        try:
+            os.remove(self._tmp)
+        except FileNotFoundError:
+            pass
+
+    def _open_tmp(self) -> BinaryIO:
+        f = open(self._tmp, "wb")
+        f.write(_envelope_line(self._meta))
+        return f
+
+
+class Spool:
+    """
+    One file per accepted message: a JSON envelope line followed by the raw
+    message bytes. A message is only visible under its final name once its
+    contents and the directory entry have been fsynced.
+    """
+
+    def __init__(self, directory: str, spill_threshold: int = 1024 * 1024) -> None:
+        self._dir = directory
+        self._failed_dir = os.path.join(directory, "failed")
+        self._spill_threshold = spill_threshold
+        self._seq = itertools.count(1)
+        os.makedirs(self._failed_dir, exist_ok=True)
+
+    @property
+    def directory(self) -> str:
+        return self._dir
+
+    def writer(self, meta: InboundMeta) -> SpoolWriter:
+        return SpoolWriter(self, meta, self._spill_threshold)
+
+    def write(self, meta: InboundMeta, raw_bytes: bytes) -> SpoolEntry:
+        w = self.writer(meta)
+        w.write(raw_bytes)
+        return w.commit()
+
+    def open_body(self, entry: SpoolEntry) -> BinaryIO:
+        f = open(entry.path, "rb")
+        f.readline()
+        return f
+
+    def read(self, entry: SpoolEntry) -> bytes:
+        with self.open_body(entry) as f:
+            return f.read()
+
+    def scan(self, entry: SpoolEntry) -> Tuple[bytes, str, int]:
+        """Return the header block, SHA-256 and size of a spooled message."""
+        h = hashlib.sha256()
+        size = 0
+        with self.open_body(entry) as f:
+            head = f.read(MAX_HEADER_BYTES)
+            chunk = head
+            while chunk:
+                h.update(chunk)
+                size += len(chunk)
+                chunk = f.read(_CHUNK)
+        return _header_block(head), h.hexdigest(), size
+
+    def remove(self, entry: SpoolEntry) -> None:
+        try:
+            os.remove(entry.path)
+        except FileNotFoundError:
+            pass
+        except OSError:
+            # e.g. on Windows while another thread still has it open (a blob
+            # copy being made); recovery will find it on the next start.
+            log.err(None, f"Failed to remove spooled message {entry.spool_id}")
+
+    def move_to_failed(self, entry: SpoolEntry) -> None:
+        try:
+            os.replace(entry.path, os.path.join(self._failed_dir,
+                                                entry.spool_id + _SUFFIX))
+        except OSError:
+            log.err(None, f"Failed to move spooled message {entry.spool_id} aside")
+
+    def adopt(self, directory: str) -> int:
+        """
+        Move the messages spooled in ``directory`` by a process that no
+        longer runs into this spool, for recover() to pick up.
+        """
+        moved = 0
+        for name in sorted(os.listdir(directory)):
+            if name.endswith(_SUFFIX):
+                os.replace(os.path.join(directory, name), os.path.join(self._dir, name))
+                moved += 1
+        if moved:
+            _fsync_dir(self._dir)
+        return moved
+
+    def recover(self) -> List[SpoolEntry]:
+        entries: List[SpoolEntry] = []
+        for name in sorted(os.listdir(self._dir)):
+            path = os.path.join(self._dir, name)
+            if name.endswith(_TMP_SUFFIX):
+                # Never acknowledged to the client, so it is safe to drop.
+                os.remove(path)
+                continue
+            if not name.endswith(_SUFFIX):
+                continue
+            with open(path, "rb") as f:
+                header = json.loads(f.readline())
+            meta = InboundMeta(
+                peer=header["peer"],
+                helo=header["helo"],
+                envelope_from=header["from"],
+                envelope_to=list(header["to"]),
+            )
+            entries.append(SpoolEntry(spool_id=name[:-len(_SUFFIX)], path=path,
+                                      meta=meta))
+        return entries
+
+    def _next_id(self) -> str:
+        return f"{time.time_ns():020d}-{next(self._seq):06d}"
@@ -0,0 +1,426 @@
+from __future__ import annotations
+
+import queue
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Sequence, Tuple
+
+from twisted.internet import defer
+from twisted.python import log
+from twisted.python.failure import Failure
+
+from .index import subject_tokens
+from .models import RelayAttempt, StoredMessage
+from .store import STATUSES, MessageStore, StatsSnapshot, _DUP, _FAIL, _OK, _PENDING, _from_ns, _to_ns
+from .tracing import StageTimes
+
+BATCH_MAX = 1000
+BATCH_LINGER = 0.05
+RETENTION_INTERVAL = 60.0
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    seq INTEGER PRIMARY KEY,
+    received_ns INTEGER NOT NULL,
+    peer TEXT NOT NULL,
+    peer_host TEXT NOT NULL COLLATE NOCASE,
+    helo TEXT,
+    envelope_from TEXT NOT NULL COLLATE NOCASE,
+    envelope_to TEXT NOT NULL,
+    subject TEXT,
+    size_bytes INTEGER NOT NULL,
+    sha256 TEXT NOT NULL,
+    status INTEGER NOT NULL DEFAULT 0,
+    relay_started_ns INTEGER,
+    relay_finished_ns INTEGER,
+    error TEXT,
+    duplicate_of TEXT
+);
+CREATE INDEX IF NOT EXISTS messages_received ON messages (received_ns);
+CREATE INDEX IF NOT EXISTS messages_from ON messages (envelope_from, seq);
+CREATE INDEX IF NOT EXISTS messages_peer ON messages (peer_host, seq);
+CREATE INDEX IF NOT EXISTS messages_status ON messages (status, seq);
+CREATE TABLE IF NOT EXISTS recipients (
+    rcpt TEXT NOT NULL COLLATE NOCASE,
+    seq INTEGER NOT NULL,
+    PRIMARY KEY (rcpt, seq)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS recipients_seq ON recipients (seq);
+"""
+
+_INSERT = (
+    "INSERT OR REPLACE INTO messages (seq, received_ns, peer, peer_host, helo,"
+    " envelope_from, envelope_to, subject, size_bytes, sha256, status,"
+    " relay_started_ns, relay_finished_ns, error, duplicate_of)"
+    " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+)
+_UPDATE = (
+    "UPDATE messages SET status = ?, relay_started_ns = ?, relay_finished_ns = ?,"
+    " error = ? WHERE seq = ?"
+)
+_SET_DUPLICATE = "UPDATE messages SET status = ?, duplicate_of = ? WHERE seq = ?"
+_RECIPIENT = "INSERT OR IGNORE INTO recipients VALUES (?, ?)"
+_COLUMNS = (
+    "seq, received_ns, peer, helo, envelope_from, envelope_to, subject, size_bytes,"
+    " sha256, status, relay_started_ns, relay_finished_ns, error, duplicate_of"
+)
+
+
+def _connect(path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+def _migrate(conn: sqlite3.Connection) -> None:
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(messages)")}
+    if "duplicate_of" not in columns:
+        # Databases from before the column kept the original's id in error.
+        conn.execute("BEGIN")
+        conn.execute("ALTER TABLE messages ADD COLUMN duplicate_of TEXT")
+        conn.execute("UPDATE messages SET duplicate_of = error, error = NULL"
+                     " WHERE status = ?", (_DUP,))
+        conn.execute("COMMIT")
+
+
+def _row_message(row: Sequence[Any]) -> StoredMessage:
+    (seq, received_ns, peer, helo, envelope_from, envelope_to, subject, size_bytes,
+     sha256, status, started_ns, finished_ns, error, duplicate_of) = row
+    attempt = None
+    if status in (_OK, _FAIL):
+        attempt = RelayAttempt(
+            started_at=_from_ns(started_ns),
+            finished_at=_from_ns(finished_ns) if finished_ns else None,
+            ok=status == _OK,
+            error=error,
+        )
+    return StoredMessage(
+        message_id=f"{seq:08d}",
+        received_at=_from_ns(received_ns),
+        peer=peer,
+        helo=helo,
+        envelope_from=envelope_from,
+        envelope_to=envelope_to.split("\n") if envelope_to else [],
+        subject=subject,
+        size_bytes=size_bytes,
+        sha256=sha256,
+        relay_attempt=attempt,
+        duplicate_of=duplicate_of,
+    )
+
+
+def _get(conn: sqlite3.Connection, seq: int) -> StoredMessage | None:
+    row = conn.execute(f"SELECT {_COLUMNS} FROM messages WHERE seq = ?", (seq,)).fetchone()
+    return None if row is None else _row_message(row)
+
+
+def _history(conn: sqlite3.Connection, before: int, limit: int, status: str | None = None,
+             sender: str | None = None, recipient: str | None = None,
+             peer: str | None = None, text: str | None = None,
+             since: datetime | None = None, until: datetime | None = None,
+             ) -> List[StoredMessage]:
+    where = ["seq < ?"]
+    params: List[Any] = []
+    if status:
+        where.append("status = ?")
+        params.append(STATUSES[status.upper()])
+    if sender:
+        where.append("envelope_from = ?")
+        params.append(sender)
+    if peer:
+        where.append("peer_host = ?")
+        params.append(peer)
+    if recipient:
+        where.append("seq IN (SELECT seq FROM recipients WHERE rcpt = ?)")
+        params.append(recipient)
+    tokens = subject_tokens(text)
+    for token in tokens:
+        # LIKE narrows to subjects containing the word; whole words are
+        # checked below.
+        where.append("subject LIKE ?")
+        params.append(f"%{token}%")
+    if since is not None:
+        where.append("received_ns >= ?")
+        params.append(_to_ns(since))
+    if until is not None:
+        where.append("received_ns <= ?")
+        params.append(_to_ns(until) + 999)
+    sql = (f"SELECT {_COLUMNS} FROM messages WHERE {' AND '.join(where)}"
+           " ORDER BY seq DESC LIMIT ?")
+
+    items: List[StoredMessage] = []
+    while len(items) < limit:
+        rows = conn.execute(sql, [before, *params, limit]).fetchall()
+        for row in rows:
+            if tokens and not tokens <= subject_tokens(row[6]):
+                continue
+            items.append(_row_message(row))
+            if len(items) == limit:
+                break
+        if len(rows) < limit:
+            break
+        before = rows[-1][0]
+    return items
+
+
+class _Writer(threading.Thread):
+    """
+    Owns the connection. Inserts and status updates queued by the reactor
+    thread are applied in one transaction per batch, and old rows are
+    deleted every RETENTION_INTERVAL seconds. Reads are queued the same
+    way, run after the writes queued before them, and their results handed
+    back through ``call_back`` (the reactor's callFromThread).
+    """
+
+    def __init__(self, path: str, retention_days: int, retention_rows: int,
+                 call_back: Callable[..., None]) -> None:
+        super().__init__(name="store-writer", daemon=True)
+        self._path = path
+        self._call_back = call_back
+        self._retention_ns = retention_days * 86400 * 10**9
+        self._retention_rows = retention_rows
+        self.queue: "queue.SimpleQueue[tuple | None]" = queue.SimpleQueue()
+        self.rows = 0
+        self.dropped = 0
+
+    def run(self) -> None:
+        conn = _connect(self._path)
+        next_retention = 0.0
+        stopping = False
+        while not stopping:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + BATCH_LINGER
+            # A read waiting in the batch ends the linger.
+            while (len(batch) < BATCH_MAX and batch[-1] is not None
+                   and batch[-1][0] != "read"):
+                try:
+                    batch.append(self.queue.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            stopping = batch[-1] is None
+            if time.monotonic() >= next_retention:
+                next_retention = time.monotonic() + RETENTION_INTERVAL
+                try:
+                    self._retain(conn)
+                except sqlite3.Error:
+                    log.err(None, "message history retention failed")
+            try:
+                self._apply(conn, batch)
+            except sqlite3.Error:
+                log.err(None, "message history write failed")
+            for op in batch:
+                if op is not None and op[0] == "read":
+                    self._read(conn, *op[1])
+        conn.close()
+
+    def _read(self, conn: sqlite3.Connection, fn: Callable[..., Any],
+              d: defer.Deferred[Any]) -> None:
+        try:
+            result = fn(conn)
+        except BaseException:
+            self._call_back(d.errback, Failure())
+        else:
+            self._call_back(d.callback, result)
+
+    def _apply(self, conn: sqlite3.Connection, batch: List[tuple | None]) -> None:
+        inserts: Dict[int, list] = {}
+        recipients = []
+        updates = []
+        duplicates = []
+        for op in batch:
+            if op is None or op[0] == "read":
+                continue
+            kind, args = op
+            if kind == "insert":
+                row, rcpts = args
+                inserts[row[0]] = row
+                recipients.extend((r, row[0]) for r in rcpts)
+            elif kind == "update":
+                row = inserts.get(args[-1])
+                if row is not None:
+                    # Still unwritten: fold the relay result into the insert.
+                    row[10:14] = args[:-1]
+                else:
+                    updates.append(args)
+            else:
+                row = inserts.get(args[-1])
+                if row is not None:
+                    row[10], row[14] = args[0], args[1]
+                else:
+                    duplicates.append(args)
+        if not inserts and not updates and not duplicates:
+            return
+        writes = [(_INSERT, list(inserts.values())), (_RECIPIENT, recipients),
+                  (_UPDATE, updates), (_SET_DUPLICATE, duplicates)]
+        conn.execute("BEGIN")
+        try:
+            for sql, rows in writes:
+                conn.executemany(sql, rows)
+            conn.execute("COMMIT")
+        except sqlite3.Error:
+            conn.execute("ROLLBACK")
+            log.err(None, "message history batch write failed, retrying row by row")
+            self._apply_rows(conn, writes)
+            return
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        self.rows += len(inserts)
+
+    def _apply_rows(self, conn: sqlite3.Connection, writes: List[tuple]) -> None:
+        # So one bad row costs only itself; the ones that still fail are
+        # counted in ``dropped``.
+        for sql, rows in writes:
+            for row in rows:
+                try:
+                    conn.execute(sql, row)
+                except sqlite3.Error:
+                    self.dropped += 1
+                    log.err(None, "message history write failed")
+                else:
+                    if sql is _INSERT:
+                        self.rows += 1
+
+    def _retain(self, conn: sqlite3.Connection) -> None:
+        keep_from = 0
+        if self._retention_ns:
+            row = conn.execute("SELECT MIN(seq) FROM messages WHERE received_ns >= ?",
+                               (time.time_ns() - self._retention_ns,)).fetchone()
+            keep_from = row[0] if row[0] is not None else (
+                conn.execute("SELECT MAX(seq) FROM messages").fetchone()[0] or 0) + 1
+        if self._retention_rows:
+            last = conn.execute("SELECT MAX(seq) FROM messages").fetchone()[0] or 0
+            keep_from = max(keep_from, last - self._retention_rows + 1)
+        if keep_from <= 1:
+            return
+        conn.execute("BEGIN")
+        deleted = conn.execute("DELETE FROM messages WHERE seq < ?", (keep_from,)).rowcount
+        conn.execute("DELETE FROM recipients WHERE seq < ?", (keep_from,))
+        conn.execute("COMMIT")
+        self.rows -= deleted
+
+
+class SqliteMessageStore(MessageStore):
+    """
+    MessageStore that also keeps every message in a SQLite database (WAL
+    mode). The in-memory ring still serves recent messages and live
+    updates, and get(), page() and query() only see the ring; fetch() and
+    fetch_page() fall through to the database for older history. All disk
+    access after startup happens on one thread, so the reactor never waits
+    on it.
+    """
+
+    def __init__(self, path: str, max_store: int, retention_days: int = 0,
+                 retention_rows: int = 0, reactor=None) -> None:  # type: ignore[no-untyped-def]
+        super().__init__(max_store)
+        if reactor is None:
+            from twisted.internet import reactor
+        conn = _connect(path)
+        try:
+            conn.executescript(_SCHEMA)
+            _migrate(conn)
+            last, rows = conn.execute("SELECT MAX(seq), COUNT(*) FROM messages").fetchone()
+        finally:
+            conn.close()
+        # New messages continue the numbering of the stored history.
+        self._last_seq = self._base_seq = last or 0
+        self._writer = _Writer(path, retention_days, retention_rows, reactor.callFromThread)
+        self._writer.rows = rows
+        self._writer.start()
+        self.add_gauge_source(lambda: {"history_dropped_writes": self._writer.dropped})
+
+    def close(self) -> None:
+        if self._writer.is_alive():
+            self._writer.queue.put(None)
+            self._writer.join()
+
+    def _read(self, fn: Callable[..., Any], *args: Any, **kw: Any) -> defer.Deferred[Any]:
+        d: defer.Deferred[Any] = defer.Deferred()
+        self._writer.queue.put(("read", (lambda conn: fn(conn, *args, **kw), d)))
+        return d
+
+    def flush(self) -> defer.Deferred[None]:
+        """Fires once everything queued so far is committed."""
+        return self._read(lambda conn: None)
+
+    def stats(self) -> StatsSnapshot:
+        s = super().stats()
+        return StatsSnapshot(
+            started_at=s.started_at,
+            received_total=s.received_total,
+            relayed_ok_total=s.relayed_ok_total,
+            relayed_fail_total=s.relayed_fail_total,
+            stored_count=max(s.stored_count, self._writer.rows),
+            duplicate_total=s.duplicate_total,
+            gauges=s.gauges,
+        )
+
+    def add_received(self, peer: str, helo: str | None, envelope_from: str,
+                     envelope_to: List[str], subject: str | None,
+                     raw_bytes: bytes | None = None, sha256: str | None = None,
+                     size_bytes: int | None = None) -> str:
+        msg_id = super().add_received(peer, helo, envelope_from, envelope_to, subject,
+                                      raw_bytes, sha256, size_bytes)
+        slot = (self._last_seq - 1) % self._max_store
+        host = self._strings.get(self._peer_host[slot]) or ""
+        row = [self._last_seq, self._received_ns[slot], peer, host, helo, envelope_from,
+               "\n".join(envelope_to), subject, self._size[slot],
+               self._sha256[32 * slot:32 * slot + 32].hex(), _PENDING, None, None, None, None]
+        self._writer.queue.put(("insert", (row, envelope_to)))
+        return msg_id
+
+    def set_relay_attempt(self, message_id: str, attempt: RelayAttempt,
+                          trace: StageTimes = ()) -> None:
+        # Stage traces are only kept in memory.
+        super().set_relay_attempt(message_id, attempt, trace)
+        if not message_id.isdigit():
+            return
+        self._writer.queue.put(("update", (
+            _OK if attempt.ok else _FAIL,
+            _to_ns(attempt.started_at),
+            _to_ns(attempt.finished_at) if attempt.finished_at is not None else None,
+            attempt.error,
+            int(message_id),
+        )))
+
+    def set_duplicate(self, message_id: str, original_id: str) -> None:
+        super().set_duplicate(message_id, original_id)
+        if message_id.isdigit():
+            self._writer.queue.put(("duplicate", (_DUP, original_id, int(message_id))))
+
+    def relink_duplicate(self, message_id: str, original_id: str | None) -> None:
+        super().relink_duplicate(message_id, original_id)
+        if message_id.isdigit():
+            status = _DUP if original_id is not None else _PENDING
+            self._writer.queue.put(("duplicate", (status, original_id, int(message_id))))
+
+    def fetch(self, message_id: str) -> defer.Deferred[StoredMessage | None]:
+        item = self.get(message_id)
+        if item is not None or not message_id.isdigit():
+            return defer.succeed(item)
+        return self._read(_get, int(message_id))
+
+    def fetch_page(self, cursor: int | None, limit: int, **filters: Any,
+                   ) -> defer.Deferred[Tuple[List[StoredMessage], int | None]]:
+        status = filters.get("status")
+        if status and status.upper() not in STATUSES:
+            raise ValueError(f"unknown status: {status}")
+        oldest = self._oldest_seq()
+        items: List[StoredMessage] = []
+        if cursor is None or cursor > oldest:
+            if filters:
+                items, _ = self.query(cursor, limit, **filters)
+            else:
+                items, _ = self.page(cursor, limit)
+            cursor = oldest
+        if len(items) == limit:
+            return defer.succeed((items, int(items[-1].message_id)))
+
+        def _page(older: List[StoredMessage]) -> Tuple[List[StoredMessage], int | None]:
+            found = items + older
+            return found, (int(found[-1].message_id) if len(found) == limit else None)
+
+        return self._read(_history, cursor, limit - len(items), **filters).addCallback(_page)
@@ -1,13 +1,17 @@
 from __future__ import annotations
 
 import hashlib
-import itertools
-from collections import deque
-from dataclasses import dataclass
-from datetime import datetime
-from typing import Deque, Dict, Iterable, List, Optional, Tuple
+import time
+from array import array
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Dict, Iterable, List, Set, Tuple
 
+from twisted.internet import defer
+
+from .index import MessageIndex, subject_tokens
 from .models import RelayAttempt, StoredMessage, utc_now
+from .tracing import StageTimes
 
 
 @dataclass(frozen=True, slots=True)
@@ -17,31 +21,167 @@ class StatsSnapshot:
     relayed_ok_total: int
     relayed_fail_total: int
     stored_count: int
+    duplicate_total: int = 0
+    gauges: Dict[str, int] = field(default_factory=dict)
+
+
+# Called with ("received", item) after add_received, ("relayed", item)
+# after set_relay_attempt and ("duplicate", item) after set_duplicate.
+StoreListener = Callable[[str, StoredMessage], None]
+
+# Sampled on every stats() call, for values that change with time rather
+# than with events.
+GaugeSource = Callable[[], Dict[str, int]]
+
+
+_PENDING, _OK, _FAIL, _DUP = 0, 1, 2, 3
+_NONE = -1
+STATUSES = {"PENDING": _PENDING, "OK": _OK, "FAIL": _FAIL, "DUP": _DUP}
+
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+_MICROSECOND = timedelta(microseconds=1)
+
+
+def _to_ns(dt: datetime) -> int:
+    return (dt - _EPOCH) // _MICROSECOND * 1000
+
+
+def _from_ns(ns: int) -> datetime:
+    return _EPOCH + timedelta(microseconds=ns // 1000)
+
+
+class _Interned:
+    """
+    Strings shared by many messages (peer hosts, senders, recipient lists),
+    stored once and referenced by index. Reference counted so that values
+    only seen by evicted messages are freed.
+    """
+
+    __slots__ = ("_values", "_index", "_refs", "_free")
+
+    def __init__(self) -> None:
+        self._values: List[str | None] = []
+        self._index: Dict[str, int] = {}
+        self._refs = array("l")
+        self._free: List[int] = []
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def add(self, value: str | None) -> int:
+        if value is None:
+            return _NONE
+        idx = self._index.get(value)
+        if idx is None:
+            if self._free:
+                idx = self._free.pop()
+                self._values[idx] = value
+            else:
+                idx = len(self._values)
+                self._values.append(value)
+                self._refs.append(0)
+            self._index[value] = idx
+        self._refs[idx] += 1
+        return idx
+
+    def release(self, idx: int) -> None:
+        if idx == _NONE:
+            return
+        self._refs[idx] -= 1
+        if self._refs[idx] == 0:
+            del self._index[self._values[idx]]  # type: ignore[arg-type]
+            self._values[idx] = None
+            self._free.append(idx)
+
+    def get(self, idx: int) -> str | None:
+        return None if idx == _NONE else self._values[idx]
 
 
 class MessageStore:
+    """
+    Fixed-capacity ring buffer of the last ``max_store`` messages, kept as
+    column arrays indexed by slot (sequence number modulo capacity).
+    StoredMessage objects are only built when a message is read, and relay
+    results are written into the slot in place.
+    """
+
     def __init__(self, max_store: int) -> None:
         self._max_store = max_store
         self._started_at = utc_now()
-        self._seq = itertools.count(1)
-        self._order: Deque[str] = deque()
-        self._items: Dict[str, StoredMessage] = {}
+        self._last_seq = 0
+        # The ring only holds sequence numbers above this (set when history
+        # numbering continues from a persistent store).
+        self._base_seq = 0
+        self._version = 0
         self._received_total = 0
         self._relayed_ok_total = 0
         self._relayed_fail_total = 0
+        self._duplicate_total = 0
+        self._listeners: List[StoreListener] = []
+        self._gauges: Dict[str, int] = {}
+        self._gauge_sources: List[GaugeSource] = []
+
+        n = max_store
+        self._strings = _Interned()
+        self._seq = array("q", bytes(8 * n))
+        self._received_ns = array("q", bytes(8 * n))
+        self._size = array("q", bytes(8 * n))
+        self._peer_host = array("i", [_NONE]) * n
+        self._peer_port = array("i", [_NONE]) * n
+        self._helo = array("i", [_NONE]) * n
+        self._from = array("i", [_NONE]) * n
+        self._to = array("i", [_NONE]) * n
+        self._sha256 = bytearray(32 * n)
+        self._subject: List[str | None] = [None] * n
+        self._status = array("b", bytes(n))
+        self._relay_started_ns = array("q", bytes(8 * n))
+        self._relay_finished_ns = array("q", bytes(8 * n))
+        self._errors: Dict[int, str] = {}
+        self._duplicate_of: Dict[int, str] = {}
+        self._traces: Dict[int, StageTimes] = {}
+        self._index = MessageIndex()
+        # Sequence numbers by status, for the statuses that stay small.
+        self._by_status: Dict[int, Set[int]] = {_PENDING: set(), _FAIL: set(), _DUP: set()}
 
     def started_at(self) -> datetime:
         return self._started_at
 
+    def version(self) -> int:
+        # Bumped whenever a message is added or updated; gauges don't count.
+        return self._version
+
+    def subscribe(self, listener: StoreListener) -> None:
+        self._listeners.append(listener)
+
+    def unsubscribe(self, listener: StoreListener) -> None:
+        self._listeners.remove(listener)
+
+    def _notify(self, event: str, slot: int) -> None:
+        item = self._materialize(slot)
+        for listener in list(self._listeners):
+            listener(event, item)
+
     def stats(self) -> StatsSnapshot:
+        gauges = dict(self._gauges)
+        for source in self._gauge_sources:
+            gauges.update(source())
         return StatsSnapshot(
             started_at=self._started_at,
             received_total=self._received_total,
             relayed_ok_total=self._relayed_ok_total,
             relayed_fail_total=self._relayed_fail_total,
-            stored_count=len(self._order),
+            stored_count=self._last_seq - self._oldest_seq() + 1,
+            duplicate_total=self._duplicate_total,
+            gauges=gauges,
         )
 
+    def set_gauge(self, name: str, value: int) -> None:
+        self._gauges[name] = value
+
+    def add_gauge_source(self, source: GaugeSource) -> None:
+        self._gauge_sources.append(source)
+
     def add_received(
         self,
         peer: str,
@@ -49,57 +189,294 @@ class MessageStore:
         envelope_from: str,
         envelope_to: List[str],
         subject: str | None,
-        raw_bytes: bytes,
+        raw_bytes: bytes | None = None,
+        sha256: str | None = None,
+        size_bytes: int | None = None,
     ) -> str:
+        if raw_bytes is not None:
+            sha256 = hashlib.sha256(raw_bytes).hexdigest()
+            size_bytes = len(raw_bytes)
+        if sha256 is None or size_bytes is None:
+            raise ValueError("add_received needs raw_bytes or sha256 and size_bytes")
         self._received_total += 1
-        seq = next(self._seq)
-        msg_id = f"{seq:08d}"
-        sha = hashlib.sha256(raw_bytes).hexdigest()
-        item = StoredMessage(
-            message_id=msg_id,
-            received_at=utc_now(),
-            peer=peer,
-            helo=helo,
-            envelope_from=envelope_from,
-            envelope_to=list(envelope_to),
-            subject=subject,
-            size_bytes=len(raw_bytes),
-            sha256=sha,
-            relay_attempt=None,
-        )
-        self._items[msg_id] = item
-        self._order.appendleft(msg_id)
-        self._trim()
-        return msg_id
-
-    def set_relay_attempt(self, message_id: str, attempt: RelayAttempt) -> None:
-        item = self._items.get(message_id)
-        if item is None:
+        self._last_seq += 1
+        seq = self._last_seq
+        slot = (seq - 1) % self._max_store
+        if seq - self._base_seq > self._max_store:
+            self._evict(slot)
+
+        strings = self._strings
+        host, sep, port = peer.rpartition(":")
+        if not (sep and port.isdigit()):
+            host, port = peer, ""
+        self._peer_host[slot] = strings.add(host)
+        self._peer_port[slot] = int(port) if port else _NONE
+        self._helo[slot] = strings.add(helo)
+        self._from[slot] = strings.add(envelope_from)
+        self._to[slot] = strings.add("\n".join(envelope_to))
+        self._seq[slot] = seq
+        # Never before the previous message, even if the wall clock steps
+        # back, so _first_seq_at() can bisect.
+        self._received_ns[slot] = max(self._received_ns[(seq - 2) % self._max_store],
+                                      time.time_ns())
+        self._size[slot] = size_bytes
+        self._sha256[32 * slot:32 * slot + 32] = bytes.fromhex(sha256)
+        self._subject[slot] = subject
+        self._status[slot] = _PENDING
+        self._by_status[_PENDING].add(seq)
+        self._index.add(seq, envelope_from, envelope_to, host, subject)
+
+        self._version += 1
+        if self._listeners:
+            self._notify("received", slot)
+        return f"{seq:08d}"
+
+    def _evict(self, slot: int) -> None:
+        strings = self._strings
+        seq = self._seq[slot]
+        to = strings.get(self._to[slot])
+        self._index.evict(seq, strings.get(self._from[slot]) or "",
+                          to.split("\n") if to else [],
+                          strings.get(self._peer_host[slot]) or "",
+                          self._subject[slot])
+        for seqs in self._by_status.values():
+            seqs.discard(seq)
+        strings.release(self._peer_host[slot])
+        strings.release(self._helo[slot])
+        strings.release(self._from[slot])
+        strings.release(self._to[slot])
+        self._subject[slot] = None
+        self._errors.pop(slot, None)
+        self._duplicate_of.pop(slot, None)
+        self._traces.pop(slot, None)
+
+    def _slot(self, message_id: str) -> int | None:
+        if not message_id.isdigit():
+            return None
+        seq = int(message_id)
+        if seq > self._last_seq or seq < self._oldest_seq():
+            return None
+        return (seq - 1) % self._max_store
+
+    def set_relay_attempt(self, message_id: str, attempt: RelayAttempt,
+                          trace: StageTimes = ()) -> None:
+        slot = self._slot(message_id)
+        if slot is None:
             return
         if attempt.ok:
             self._relayed_ok_total += 1
         else:
             self._relayed_fail_total += 1
-        self._items[message_id] = StoredMessage(
-            message_id=item.message_id,
-            received_at=item.received_at,
-            peer=item.peer,
-            helo=item.helo,
-            envelope_from=item.envelope_from,
-            envelope_to=item.envelope_to,
-            subject=item.subject,
-            size_bytes=item.size_bytes,
-            sha256=item.sha256,
+        self._set_status(slot, _OK if attempt.ok else _FAIL)
+        self._relay_started_ns[slot] = _to_ns(attempt.started_at)
+        self._relay_finished_ns[slot] = (
+            _to_ns(attempt.finished_at) if attempt.finished_at is not None else 0)
+        if attempt.error is not None:
+            self._errors[slot] = attempt.error
+        else:
+            self._errors.pop(slot, None)
+        if trace:
+            self._traces[slot] = trace
+        self._version += 1
+        if self._listeners:
+            self._notify("relayed", slot)
+
+    def _set_status(self, slot: int, status: int) -> None:
+        seq = self._seq[slot]
+        self._by_status.get(self._status[slot], set()).discard(seq)
+        self._status[slot] = status
+        if status in self._by_status:
+            self._by_status[status].add(seq)
+
+    def set_duplicate(self, message_id: str, original_id: str) -> None:
+        """Mark a message as accepted but not relayed, as a copy of another."""
+        slot = self._slot(message_id)
+        if slot is None:
+            return
+        self._duplicate_total += 1
+        self._set_status(slot, _DUP)
+        self._duplicate_of[slot] = original_id
+        self._version += 1
+        if self._listeners:
+            self._notify("duplicate", slot)
+
+    def relink_duplicate(self, message_id: str, original_id: str | None) -> None:
+        """
+        Point a duplicate at another original after its own failed, or with
+        None make it pending again because it is now relayed itself.
+        """
+        slot = self._slot(message_id)
+        if slot is None or self._status[slot] != _DUP:
+            return
+        if original_id is None:
+            self._set_status(slot, _PENDING)
+            self._duplicate_of.pop(slot, None)
+        else:
+            self._duplicate_of[slot] = original_id
+        self._version += 1
+        if self._listeners:
+            self._notify("relinked", slot)
+
+    def _materialize(self, slot: int) -> StoredMessage:
+        strings = self._strings
+        host = strings.get(self._peer_host[slot]) or ""
+        port = self._peer_port[slot]
+        to = strings.get(self._to[slot])
+        attempt = None
+        status = self._status[slot]
+        if status in (_OK, _FAIL):
+            finished = self._relay_finished_ns[slot]
+            attempt = RelayAttempt(
+                started_at=_from_ns(self._relay_started_ns[slot]),
+                finished_at=_from_ns(finished) if finished else None,
+                ok=status == _OK,
+                error=self._errors.get(slot),
+            )
+        return StoredMessage(
+            message_id=f"{self._seq[slot]:08d}",
+            received_at=_from_ns(self._received_ns[slot]),
+            peer=f"{host}:{port}" if port != _NONE else host,
+            helo=strings.get(self._helo[slot]),
+            envelope_from=strings.get(self._from[slot]) or "",
+            envelope_to=to.split("\n") if to else [],
+            subject=self._subject[slot],
+            size_bytes=self._size[slot],
+            sha256=self._sha256[32 * slot:32 * slot + 32].hex(),
             relay_attempt=attempt,
+            duplicate_of=self._duplicate_of.get(slot) if status == _DUP else None,
+            trace=self._traces.get(slot, ()),
         )
 
     def get(self, message_id: str) -> StoredMessage | None:
-        return self._items.get(message_id)
+        slot = self._slot(message_id)
+        return None if slot is None else self._materialize(slot)
 
     def list_recent(self) -> List[StoredMessage]:
-        return [self._items[mid] for mid in list(self._order)]
+        return self.page(None, self._max_store)[0]
+
+    def last_seq(self) -> int:
+        return self._last_seq
+
+    def _oldest_seq(self) -> int:
+        return max(self._base_seq + 1, self._last_seq - self._max_store + 1)
+
+    def page(self, cursor: int | None, limit: int) -> Tuple[List[StoredMessage], int | None]:
+        """
+        Up to ``limit`` messages older than sequence number ``cursor`` (or
+        the newest ones if None), newest first, plus the cursor for the next
+        page. Slots follow from sequence numbers, so there is no scan.
+        """
+        oldest = self._oldest_seq()
+        start = self._last_seq if cursor is None else min(cursor - 1, self._last_seq)
+        stop = max(oldest, start - limit + 1)
+        n = self._max_store
+        items = [self._materialize((seq - 1) % n) for seq in range(start, stop - 1, -1)]
+        return items, (stop if stop > oldest else None)
+
+    def _first_seq_at(self, ns: int, lo: int, hi: int) -> int:
+        # First sequence number in [lo, hi] received at or after ``ns``
+        # (hi + 1 if none); receive times never decrease with sequence.
+        n = self._max_store
+        received = self._received_ns
+        hi += 1
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if received[(mid - 1) % n] < ns:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def query(
+        self,
+        cursor: int | None,
+        limit: int,
+        status: str | None = None,
+        sender: str | None = None,
+        recipient: str | None = None,
+        peer: str | None = None,
+        text: str | None = None,
+        since: datetime | None = None,
+        until: datetime | None = None,
+    ) -> Tuple[List[StoredMessage], int | None]:
+        """
+        Like page(), restricted to messages matching every given filter.
+        Sender, recipient and peer host are exact (case-insensitive); text
+        matches messages whose subject contains all of its words. The
+        smallest matching index drives the walk and the other filters are
+        checked against the columns.
+        """
+        lo = self._oldest_seq()
+        hi = self._last_seq if cursor is None else min(cursor - 1, self._last_seq)
+        if since is not None:
+            lo = self._first_seq_at(_to_ns(since), lo, hi)
+        if until is not None:
+            hi = self._first_seq_at(_to_ns(until) + 1000, lo, hi) - 1
+        code = STATUSES.get(status.upper()) if status else None
+        if status and code is None:
+            raise ValueError(f"unknown status: {status}")
+        tokens = subject_tokens(text)
+        if lo > hi:
+            return [], None
+
+        index = self._index
+        keyed = [(index.sender, sender), (index.recipient, recipient),
+                 (index.peer, peer)] + [(index.token, t) for t in tokens]
+        best = None
+        best_count = hi - lo + 1
+        for key_index, key in keyed:
+            if not key:
+                continue
+            postings = key_index.get(key.lower())
+            if postings is None:
+                return [], None
+            count = postings.count_between(lo, hi)
+            if count < best_count:
+                best, best_count = postings, count
+        candidates: Iterable[int]
+        if code in self._by_status and len(self._by_status[code]) < best_count:
+            candidates = sorted((s for s in self._by_status[code] if lo <= s <= hi),
+                                reverse=True)
+        elif best is not None:
+            candidates = best.descending(lo, hi)
+        else:
+            candidates = range(hi, lo - 1, -1)
+
+        strings = self._strings
+        n = self._max_store
+        sender_l = sender.lower() if sender else None
+        recipient_l = recipient.lower() if recipient else None
+        peer_l = peer.lower() if peer else None
+        items: List[StoredMessage] = []
+        for seq in candidates:
+            slot = (seq - 1) % n
+            if code is not None and self._status[slot] != code:
+                continue
+            if sender_l and (strings.get(self._from[slot]) or "").lower() != sender_l:
+                continue
+            if peer_l and (strings.get(self._peer_host[slot]) or "").lower() != peer_l:
+                continue
+            if recipient_l:
+                to = strings.get(self._to[slot]) or ""
+                if recipient_l not in to.lower().split("\n"):
+                    continue
+            if tokens and not tokens <= subject_tokens(self._subject[slot]):
+                continue
+            items.append(self._materialize(slot))
+            if len(items) == limit:
+                last = seq
+                return items, (last if last > lo else None)
+        return items, None
+
+    # The web resources read through these, so that a store backed by disk
+    # can serve older history off the reactor thread.
+
+    def fetch(self, message_id: str) -> defer.Deferred[StoredMessage | None]:
+        return defer.succeed(self.get(message_id))
 
-    def _trim(self) -> None:
-        while len(self._order) > self._max_store:
-            tail = self._order.pop()
-            self._items.pop(tail, None)
+    def fetch_page(self, cursor: int | None, limit: int, **filters: Any,
+                   ) -> defer.Deferred[Tuple[List[StoredMessage], int | None]]:
+        """query() with ``filters``, or page() without."""
+        if filters:
+            return defer.succeed(self.query(cursor, limit, **filters))
+        return defer.succeed(self.page(cursor, limit))
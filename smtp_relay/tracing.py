@@ -0,0 +1,112 @@
+from __future__ import annotations
+
+import time
+from collections import deque
+from typing import Callable, Deque, Dict, Iterable, List, Tuple
+
+# Each stage is named after what happened in the interval ending at its
+# mark, in pipeline order:
+#   greeting  connect to MAIL (first transaction of a session only)
+#   envelope  MAIL to DATA
+#   data      DATA to end of message
+#   spool     writing and fsyncing the spool file
+#   parse     header scan and store insert
+#   prepare   X-Original-* headers, MIME repair of malformed messages
+#   quota     waiting for upstream quota
+#   pool      waiting for an upstream session (or for one to be started)
+#   connect   TCP connect to the upstream
+#   starttls  banner, EHLO, STARTTLS and the TLS handshake
+#   auth      EHLO over TLS and AUTH
+#   transfer  MAIL, RCPT, DATA and the message body
+#   reply     waiting for the upstream's final reply
+#   retry     from a failed attempt to the next one (backoff included)
+STAGES = ("greeting", "envelope", "data", "spool", "parse", "prepare", "quota", "pool",
+          "connect", "starttls", "auth", "transfer", "reply", "retry")
+
+# (stage, seconds) in the order the stages happened; a stage repeats when
+# a message was retried or failed over.
+StageTimes = Tuple[Tuple[str, float], ...]
+
+_PERCENTILES = (50, 95, 99)
+
+
+class MessageTrace:
+    """
+    Monotonic timestamps of the stages one message went through, from the
+    SMTP session to the upstream's reply. Marks never go backwards: one
+    taken before the previous mark (e.g. a session that was already
+    connecting when the message was queued) counts as zero.
+    """
+
+    __slots__ = ("start", "marks", "_clock")
+
+    def __init__(self, start: float | None = None,
+                 clock: Callable[[], float] = time.monotonic) -> None:
+        self._clock = clock
+        self.start = clock() if start is None else start
+        self.marks: List[Tuple[str, float]] = []
+
+    def last(self) -> float:
+        return self.marks[-1][1] if self.marks else self.start
+
+    def mark(self, stage: str, at: float | None = None) -> None:
+        now = self._clock() if at is None else at
+        self.marks.append((stage, max(now, self.last())))
+
+    def fork(self) -> "MessageTrace":
+        # For one of several transactions sent in parallel.
+        child = MessageTrace(self.start, self._clock)
+        child.marks = list(self.marks)
+        return child
+
+    def join(self, forks: Iterable["MessageTrace"]) -> None:
+        # The message took as long as its slowest transaction.
+        slowest = max(forks, key=MessageTrace.last, default=None)
+        if slowest is not None:
+            self.marks = list(slowest.marks)
+
+    def stages(self) -> StageTimes:
+        out = []
+        prev = self.start
+        for stage, at in self.marks:
+            out.append((stage, at - prev))
+            prev = at
+        return tuple(out)
+
+
+class StageTimings:
+    """
+    Per-stage durations of the last ``window`` delivered messages, with
+    p50/p95/p99 exposed as ``stage.<name>.p<N>_ms`` gauges. Percentiles are
+    only recomputed when something was added since the last read.
+    """
+
+    def __init__(self, window: int = 1000) -> None:
+        self._samples: Dict[str, Deque[float]] = {
+            stage: deque(maxlen=window) for stage in STAGES}
+        self._dirty = False
+        self._gauges: Dict[str, int] = {}
+
+    def add(self, stages: StageTimes) -> None:
+        totals: Dict[str, float] = {}
+        for stage, seconds in stages:
+            totals[stage] = totals.get(stage, 0.0) + seconds
+        for stage, seconds in totals.items():
+            samples = self._samples.get(stage)
+            if samples is not None:
+                samples.append(seconds)
+        self._dirty = True
+
+    def gauges(self) -> Dict[str, int]:
+        if self._dirty:
+            self._dirty = False
+            values: Dict[str, int] = {}
+            for stage, samples in self._samples.items():
+                if not samples:
+                    continue
+                ordered = sorted(samples)
+                for p in _PERCENTILES:
+                    idx = min(len(ordered) - 1, len(ordered) * p // 100)
+                    values[f"stage.{stage}.p{p}_ms"] = round(ordered[idx] * 1000)
+            self._gauges = values
+        return dict(self._gauges)
@@ -0,0 +1,209 @@
+from __future__ import annotations
+
+from collections import deque
+from typing import BinaryIO, Callable, Deque, Dict, List, Tuple
+
+from twisted.internet import defer
+from twisted.python import log
+from twisted.python.failure import Failure
+
+from .config import RelayConfig, Upstream
+from .pool import UpstreamPool
+from .relay_client import SendScheduler, is_permanent
+from .tracing import MessageTrace
+
+CLOSED, HALF_OPEN, OPEN = 0, 1, 2
+
+
+class CircuitBreaker:
+    """
+    Tracks the last ``window`` sends to one upstream. A send counts as bad
+    if it failed or took at least ``slow_seconds`` (0 disables that). Once
+    ``min_calls`` have been seen and the bad fraction reaches
+    ``failure_rate`` the breaker opens; after ``cooldown`` seconds one
+    trial send is let through, and its outcome closes or reopens it.
+    """
+
+    def __init__(self, failure_rate: float, slow_seconds: float, cooldown: float,
+                 clock: Callable[[], float], window: int = 20, min_calls: int = 5) -> None:
+        self.failure_rate = failure_rate
+        self.slow_seconds = slow_seconds
+        self.cooldown = cooldown
+        self._clock = clock
+        self._min_calls = min_calls
+        self._outcomes: Deque[bool] = deque(maxlen=window)
+        self._latencies: Deque[float] = deque(maxlen=window)
+        self.state = CLOSED
+        self._opened_at = 0.0
+        self._trial = False
+
+    def available(self) -> bool:
+        if self.state == CLOSED:
+            return True
+        if self.state == HALF_OPEN:
+            return not self._trial
+        return self._clock() >= self._opened_at + self.cooldown
+
+    def acquire(self) -> None:
+        # Called for a send that available() allowed.
+        if self.state == OPEN and self.available():
+            self.state = HALF_OPEN
+        if self.state == HALF_OPEN:
+            self._trial = True
+
+    def record(self, ok: bool, seconds: float) -> None:
+        if ok:
+            self._latencies.append(seconds)
+        bad = not ok or bool(self.slow_seconds and seconds >= self.slow_seconds)
+        if self.state == HALF_OPEN:
+            self._trial = False
+            if bad:
+                self._open()
+            else:
+                self.state = CLOSED
+                self._outcomes.clear()
+            return
+        if self.state == OPEN:
+            return
+        self._outcomes.append(bad)
+        if (len(self._outcomes) >= self._min_calls
+                and sum(self._outcomes) >= self.failure_rate * len(self._outcomes)):
+            self._open()
+
+    def _open(self) -> None:
+        self.state = OPEN
+        self._opened_at = self._clock()
+        self._outcomes.clear()
+
+    def failure_pct(self) -> int:
+        if not self._outcomes:
+            return 0
+        return round(100 * sum(self._outcomes) / len(self._outcomes))
+
+    def latency_ms(self) -> int:
+        if not self._latencies:
+            return 0
+        return round(1000 * sum(self._latencies) / len(self._latencies))
+
+
+class _Host:
+    def __init__(self, cfg: RelayConfig, upstream: Upstream, pool: UpstreamPool,
+                 reactor) -> None:  # type: ignore[no-untyped-def]
+        self.upstream = upstream
+        self.pool = pool
+        self.breaker = CircuitBreaker(cfg.upstream_breaker_failure_rate,
+                                      cfg.upstream_breaker_slow_seconds,
+                                      cfg.upstream_breaker_cooldown, reactor.seconds)
+        # Quotas are per account, so each upstream is paced on its own;
+        # the scheduler hands messages back to send() once they are due.
+        self.sender = SendScheduler(cfg, self, reactor)  # type: ignore[arg-type]
+        self._clock = reactor.seconds
+        self.assigned = 0
+        self.sent = 0
+        self.failed = 0
+
+    def send(self, from_addr: str, to_addrs: List[str],
+             open_data: Callable[[], BinaryIO],
+             trace: MessageTrace | None = None,
+             record: bool = True) -> defer.Deferred[object]:
+        # Only sends the breaker let through are recorded, so that one sent
+        # regardless cannot settle a half-open breaker's trial.
+        started = self._clock()
+        d = self.pool.send(from_addr, to_addrs, open_data, trace)
+        if not record:
+            return d
+
+        def _done(result: object) -> object:
+            # A permanent rejection is the upstream working as it should.
+            ok = not isinstance(result, Failure) or is_permanent(result)
+            self.breaker.record(ok, self._clock() - started)
+            return result
+
+        return d.addBoth(_done)
+
+
+class UpstreamBalancer:
+    """
+    Spreads messages over the configured upstreams, each message going to
+    the upstream with the fewest assigned messages per unit of weight
+    among those whose circuit breaker is closed. A message that fails
+    temporarily on one upstream is tried once on each of the others before
+    the failure is returned (and retried later by the delivery scheduler);
+    a permanent 5xx rejection is returned as is. When every
+    breaker is open, messages still go out, to the least loaded upstream.
+    """
+
+    def __init__(self, cfg: RelayConfig, reactor=None,
+                 make_pool: Callable[[Upstream], UpstreamPool] | None = None) -> None:  # type: ignore[no-untyped-def]
+        if reactor is None:
+            from twisted.internet import reactor
+        if make_pool is None:
+            make_pool = lambda upstream: UpstreamPool(cfg, reactor, upstream)  # noqa: E731
+        self._hosts = [_Host(cfg, upstream, make_pool(upstream), reactor)
+                       for upstream in cfg.upstream_hosts()]
+        self._by_name = {host.upstream.name: host for host in self._hosts}
+
+    def close(self) -> None:
+        for host in self._hosts:
+            host.pool.close()
+
+    def _choose(self, tried: Tuple[_Host, ...]) -> Tuple[_Host, bool]:
+        # Also whether the host's breaker let the send through; only those
+        # sends are recorded against it.
+        candidates = [h for h in self._hosts if h not in tried]
+        healthy = [h for h in candidates if h.breaker.available()]
+        host = min(healthy or candidates,
+                   key=lambda h: (h.assigned + 1) / h.upstream.weight)
+        if healthy:
+            host.breaker.acquire()
+        return host, bool(healthy)
+
+    def send(self, from_addr: str, to_addrs: List[str],
+             open_data: Callable[[], BinaryIO], upstream: str | None = None,
+             trace: MessageTrace | None = None,
+             _tried: Tuple[_Host, ...] = ()) -> defer.Deferred[object]:
+        # A named upstream (from a route) is used whatever its breaker
+        # says, with no failover: the route picked that account on purpose.
+        if upstream is not None:
+            host, acquired = self._by_name[upstream], False
+        else:
+            host, acquired = self._choose(_tried)
+        host.assigned += 1
+
+        def _sent(result: object) -> object:
+            host.assigned -= 1
+            host.sent += 1
+            return result
+
+        def _failed(failure: Failure) -> object:
+            host.assigned -= 1
+            host.failed += 1
+            tried = _tried + (host,)
+            if (upstream is None and len(tried) < len(self._hosts)
+                    and not is_permanent(failure)):
+                log.msg(f"Upstream {host.upstream.name} failed "
+                        f"({failure.getErrorMessage()}), trying another")
+                return self.send(from_addr, to_addrs, open_data, None, trace, tried)
+            return failure
+
+        return host.sender.send(from_addr, to_addrs, open_data, trace,
+                                record=acquired).addCallbacks(_sent, _failed)
+
+    def gauges(self) -> Dict[str, int]:
+        values: Dict[str, int] = {}
+        for host in self._hosts:
+            for name, value in host.sender.gauges().items():
+                if name == "upstream_drain_seconds":
+                    values[name] = max(values.get(name, 0), value)
+                else:
+                    values[name] = values.get(name, 0) + value
+            prefix = f"upstream.{host.upstream.name}."
+            values[prefix + "breaker"] = host.breaker.state
+            values[prefix + "weight"] = host.upstream.weight
+            values[prefix + "sessions"] = host.pool.size()
+            values[prefix + "inflight"] = host.assigned
+            values[prefix + "sent"] = host.sent
+            values[prefix + "failed"] = host.failed
+            values[prefix + "failure_pct"] = host.breaker.failure_pct()
+            values[prefix + "latency_ms"] = host.breaker.latency_ms()
+        return values
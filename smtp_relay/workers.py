@@ -0,0 +1,277 @@
+from __future__ import annotations
+
+import json
+import os
+import socket
+import sys
+from collections import OrderedDict
+from dataclasses import replace
+from datetime import datetime
+from typing import Dict, List, Tuple
+
+from twisted.internet import error, protocol
+from twisted.python import log
+
+from .config import RelayConfig
+from .metrics import Metrics
+from .models import RelayAttempt, StoredMessage
+from .store import MessageStore
+
+# File descriptor, in each worker, of the pipe carrying store events back to
+# the supervisor. 0-2 are stdin (closed by the supervisor on exit) and the
+# inherited stdout/stderr.
+EVENT_FD = 3
+
+# Per-upstream and per-stage gauges that are states, averages or
+# percentiles rather than counts: the supervisor shows the worst worker's
+# value instead of the sum.
+_MAX_GAUGES = (".breaker", ".weight", ".failure_pct", ".latency_ms",
+               ".p50_ms", ".p95_ms", ".p99_ms")
+
+
+def listen_socket(host: str, port: int, backlog: int = 128) -> socket.socket:
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.setblocking(False)
+    os.set_inheritable(sock.fileno(), True)
+    return sock
+
+
+def socket_family(fd: int) -> socket.AddressFamily:
+    sock = socket.socket(fileno=fd)
+    try:
+        return sock.family
+    finally:
+        sock.detach()
+
+
+def _share(limit: int, count: int) -> int:
+    # 0 means unlimited; a set limit never rounds down to unlimited.
+    return max(1, limit // count) if limit else 0
+
+
+def worker_config(cfg: RelayConfig, count: int) -> RelayConfig:
+    # Upstream quotas are per account, and workers share the blob
+    # directory, so each worker gets an equal share.
+    return replace(
+        cfg,
+        blob_max_bytes=max(1, cfg.blob_max_bytes // count),
+        upstream_msgs_per_sec=cfg.upstream_msgs_per_sec / count,
+        upstream_rcpts_per_min=_share(cfg.upstream_rcpts_per_min, count),
+        upstream_msgs_per_day=_share(cfg.upstream_msgs_per_day, count),
+    )
+
+
+def _fmt_dt(dt: datetime | None) -> str | None:
+    return dt.isoformat() if dt is not None else None
+
+
+def _parse_dt(raw: str | None) -> datetime | None:
+    return datetime.fromisoformat(raw) if raw is not None else None
+
+
+def encode_event(event: str, item: StoredMessage) -> bytes:
+    if event == "received":
+        payload = {
+            "t": event,
+            "id": item.message_id,
+            "peer": item.peer,
+            "helo": item.helo,
+            "from": item.envelope_from,
+            "to": item.envelope_to,
+            "subject": item.subject,
+            "sha256": item.sha256,
+            "size": item.size_bytes,
+        }
+    elif event in ("duplicate", "relinked"):
+        payload = {"t": event, "id": item.message_id, "of": item.duplicate_of}
+    else:
+        attempt = item.relay_attempt
+        assert attempt is not None
+        payload = {
+            "t": event,
+            "id": item.message_id,
+            "ok": attempt.ok,
+            "error": attempt.error,
+            "started": _fmt_dt(attempt.started_at),
+            "finished": _fmt_dt(attempt.finished_at),
+            "stages": item.trace,
+        }
+    return json.dumps(payload).encode("utf-8") + b"\n"
+
+
+class WorkerChannel(protocol.Protocol):
+    """
+    Worker side of the supervisor pipe. Forwards store events as JSON lines
+    and stops the worker when the supervisor goes away.
+    """
+
+    def __init__(self, reactor) -> None:  # type: ignore[no-untyped-def]
+        self._reactor = reactor
+
+    def forward(self, event: str, item: StoredMessage) -> None:
+        if self.transport is not None:
+            self.transport.write(encode_event(event, item))
+
+    def send_stats(self, store: MessageStore, metrics: Metrics) -> None:
+        if self.transport is not None:
+            payload = {"t": "stats", "gauges": store.stats().gauges,
+                       "metrics": metrics.snapshot()}
+            self.transport.write(json.dumps(payload).encode("utf-8") + b"\n")
+
+    def connectionLost(self, reason=protocol.connectionDone):  # type: ignore[no-untyped-def]
+        log.msg("Supervisor went away, stopping worker")
+        try:
+            self._reactor.stop()
+        except error.ReactorNotRunning:
+            pass
+
+
+class _WorkerProtocol(protocol.ProcessProtocol):
+    def __init__(self, supervisor: "WorkerSupervisor", index: int) -> None:
+        self._supervisor = supervisor
+        self._index = index
+        self._buf = b""
+
+    def childDataReceived(self, childFD: int, data: bytes) -> None:
+        if childFD != EVENT_FD:
+            return
+        lines = (self._buf + data).split(b"\n")
+        self._buf = lines.pop()
+        for line in lines:
+            if line:
+                self._supervisor.apply(self._index, json.loads(line))
+
+    def processEnded(self, reason) -> None:  # type: ignore[no-untyped-def]
+        self._supervisor._workerExited(self._index, reason)
+
+
+class WorkerSupervisor:
+    """
+    Runs ``count`` SMTP worker processes that all accept on the inherited
+    listening socket, and replays their store events into the local store
+    so the dashboard covers the whole fleet.
+    """
+
+    def __init__(
+        self,
+        cfg: RelayConfig,
+        store: MessageStore,
+        listen_fd: int,
+        count: int,
+        reactor=None,  # type: ignore[no-untyped-def]
+    ) -> None:
+        if reactor is None:
+            from twisted.internet import reactor
+        self._cfg = cfg
+        self._store = store
+        self._fd = listen_fd
+        self._count = count
+        self._reactor = reactor
+        self._stopping = False
+        self._procs: Dict[int, protocol.ProcessProtocol] = {}
+        # (worker index, worker message id) -> supervisor message id, for
+        # messages whose relay outcome has not been reported yet.
+        self._ids: "OrderedDict[Tuple[int, str], str]" = OrderedDict()
+        self._gauges: Dict[int, Dict[str, int]] = {}
+        self._metrics: Dict[int, Dict[str, object]] = {}
+
+    def start(self) -> None:
+        for index in range(self._count):
+            self._spawn(index)
+        self._reactor.addSystemEventTrigger("before", "shutdown", self.stop)
+
+    def stop(self) -> None:
+        self._stopping = True
+        for proto in self._procs.values():
+            if proto.transport is not None and proto.transport.pid is not None:
+                proto.transport.signalProcess("TERM")
+
+    def _spawn(self, index: int) -> None:
+        args = [
+            sys.executable, "-m", "smtp_relay.main",
+            "--worker-index", str(index),
+            "--listen-fd", str(self._fd),
+            "--workers", str(self._count),
+        ]
+        proto = _WorkerProtocol(self, index)
+        self._procs[index] = proto
+        self._reactor.spawnProcess(
+            proto, sys.executable, args, env=dict(os.environ),
+            childFDs={0: "w", 1: 1, 2: 2, EVENT_FD: "r", self._fd: self._fd},
+        )
+        log.msg(f"Started SMTP worker {index}")
+
+    def _workerExited(self, index: int, reason) -> None:  # type: ignore[no-untyped-def]
+        self._procs.pop(index, None)
+        self._gauges.pop(index, None)
+        self._metrics.pop(index, None)
+        self._sumGauges()
+        if self._stopping:
+            return
+        log.msg(f"SMTP worker {index} exited ({reason.value}), restarting")
+        self._reactor.callLater(1, self._spawn, index)
+
+    def _sumGauges(self) -> None:
+        totals: Dict[str, int] = {}
+        for values in self._gauges.values():
+            for name, value in values.items():
+                if name.endswith(_MAX_GAUGES):
+                    totals[name] = max(totals.get(name, 0), value)
+                else:
+                    totals[name] = totals.get(name, 0) + value
+        for name in self._store.stats().gauges:
+            totals.setdefault(name, 0)
+        for name, value in totals.items():
+            self._store.set_gauge(name, value)
+
+    def metric_sources(self) -> List[Tuple[Dict[str, str], Dict[str, object]]]:
+        return [({"worker": str(index)}, snap)
+                for index, snap in sorted(self._metrics.items())]
+
+    def apply(self, index: int, event: dict) -> None:
+        if event["t"] == "stats":
+            self._gauges[index] = event["gauges"]
+            self._metrics[index] = event["metrics"]
+            self._sumGauges()
+            return
+        key = (index, event["id"])
+        if event["t"] == "received":
+            self._ids[key] = self._store.add_received(
+                peer=event["peer"],
+                helo=event["helo"],
+                envelope_from=event["from"],
+                envelope_to=event["to"],
+                subject=event["subject"],
+                sha256=event["sha256"],
+                size_bytes=event["size"],
+            )
+            while len(self._ids) > self._cfg.max_store:
+                self._ids.popitem(last=False)
+        elif event["t"] == "duplicate":
+            msg_id = self._ids.get(key)
+            if msg_id is not None:
+                self._store.set_duplicate(
+                    msg_id, self._ids.get((index, event["of"]), event["of"]))
+        elif event["t"] == "relinked":
+            msg_id = self._ids.get(key)
+            if msg_id is not None:
+                of = event["of"]
+                self._store.relink_duplicate(
+                    msg_id, of if of is None else self._ids.get((index, of), of))
+        elif event["t"] == "relayed":
+            # Kept (up to max_store) so later duplicates can name the original.
+            msg_id = self._ids.get(key)
+            if msg_id is None:
+                return
+            started = _parse_dt(event["started"])
+            assert started is not None
+            self._store.set_relay_attempt(msg_id, RelayAttempt(
+                started_at=started,
+                finished_at=_parse_dt(event["finished"]),
+                ok=event["ok"],
+                error=event["error"],
+            ), tuple((stage, seconds) for stage, seconds in event.get("stages", ())))
@@ -0,0 +1,64 @@
+from __future__ import annotations
+
+import json
+import unittest
+
+from twisted.web.resource import getChildForRequest
+from twisted.web.test.requesthelper import DummyRequest
+
+from smtp_relay.http_server import Root
+from smtp_relay.store import MessageStore
+
+
+def _get(root: Root, path: str, **args: str):  # type: ignore[no-untyped-def]
+    request = DummyRequest(path.lstrip("/").encode().split(b"/"))
+    for key, value in args.items():
+        request.addArg(key.encode(), value.encode())
+    body = getChildForRequest(root, request).render(request)
+    return request.responseCode or 200, json.loads(body)
+
+
+class TestApi(unittest.TestCase):
+    def setUp(self) -> None:
+        self.store = MessageStore(max_store=10)
+        for i in range(5):
+            self.store.add_received(peer="p", helo="h", envelope_from="a",
+                                    envelope_to=["b"], subject=f"s{i}",
+                                    raw_bytes=b"x" * i)
+        self.root = Root(self.store)
+
+    def test_pages_messages(self) -> None:
+        code, page = _get(self.root, "/api/messages", limit="2")
+        self.assertEqual(code, 200)
+        self.assertEqual([m["id"] for m in page["messages"]], ["00000005", "00000004"])
+        self.assertEqual(page["messages"][0]["status"], "PENDING")
+        _, page = _get(self.root, "/api/messages", limit="2",
+                       cursor=str(page["next_cursor"]))
+        self.assertEqual([m["id"] for m in page["messages"]], ["00000003", "00000002"])
+
+    def test_rejects_bad_arguments(self) -> None:
+        code, body = _get(self.root, "/api/messages", limit="0")
+        self.assertEqual(code, 400)
+        code, _ = _get(self.root, "/api/messages", cursor="abc")
+        self.assertEqual(code, 400)
+
+    def test_filters_messages(self) -> None:
+        self.store.add_received(peer="p", helo="h", envelope_from="other",
+                                envelope_to=["b"], subject="s1", raw_bytes=b"")
+        code, page = _get(self.root, "/api/messages", q="S1", **{"from": "a"})
+        self.assertEqual(code, 200)
+        self.assertEqual([m["id"] for m in page["messages"]], ["00000002"])
+        _, page = _get(self.root, "/api/messages", since="1h", status="pending")
+        self.assertEqual(len(page["messages"]), 6)
+        code, _ = _get(self.root, "/api/messages", status="LOST")
+        self.assertEqual(code, 400)
+        code, _ = _get(self.root, "/api/messages", since="yesterday")
+        self.assertEqual(code, 400)
+
+    def test_message_and_stats(self) -> None:
+        code, msg = _get(self.root, "/api/messages/00000003")
+        self.assertEqual((code, msg["subject"], msg["size_bytes"]), (200, "s2", 2))
+        code, _ = _get(self.root, "/api/messages/nope")
+        self.assertEqual(code, 404)
+        _, stats = _get(self.root, "/api/stats")
+        self.assertEqual((stats["received_total"], stats["last_seq"]), (5, 5))
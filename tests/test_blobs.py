@@ -0,0 +1,96 @@
+from __future__ import annotations
+
+import hashlib
+import io
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from twisted.internet.testing import StringTransport
+from twisted.web.resource import getChildForRequest
+from twisted.web.test.requesthelper import DummyRequest
+
+from smtp_relay.blobs import BlobStore
+from smtp_relay.http_server import Root
+from smtp_relay.store import MessageStore
+
+
+def _put(blobs: BlobStore, data: bytes) -> str:
+    sha256 = hashlib.sha256(data).hexdigest()
+    blobs.put(sha256, io.BytesIO(data))
+    return sha256
+
+
+class TestBlobStore(unittest.TestCase):
+    def setUp(self) -> None:
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.dir = tmp.name
+
+    def test_round_trip_in_bounded_chunks(self) -> None:
+        blobs = BlobStore(self.dir, 10 * 1024 * 1024)
+        data = b"Subject: hi\n\n" + b"A" * 5_000_000
+        sha256 = _put(blobs, data)
+        self.assertLess(blobs.total_bytes, 100_000)
+        chunks = list(blobs.chunks(sha256))  # type: ignore[arg-type]
+        self.assertEqual(b"".join(chunks), data)
+        self.assertLessEqual(max(len(c) for c in chunks), 64 * 1024)
+        self.assertIsNone(blobs.chunks("0" * 64))
+
+    def test_dedup_and_lru_budget(self) -> None:
+        blobs = BlobStore(self.dir, 2500)
+        payloads = [os.urandom(1000) for _ in range(3)]
+        first, second = _put(blobs, payloads[0]), _put(blobs, payloads[1])
+        # storing it again only marks it as recently used
+        self.assertFalse(blobs.put(first, io.BytesIO(payloads[0])))
+        third = _put(blobs, payloads[2])
+        self.assertEqual(len(blobs), 2)
+        self.assertNotIn(second, blobs)
+        self.assertIn(first, blobs)
+
+        # a second instance picks up what is on disk
+        self.assertEqual(len(BlobStore(self.dir, 2500)), 2)
+        self.assertEqual(b"".join(BlobStore(self.dir, 2500).chunks(third)),  # type: ignore[arg-type]
+                         payloads[2])
+
+    def test_raw_download(self) -> None:
+        blobs = BlobStore(self.dir, 1024 * 1024)
+        store = MessageStore(max_store=10)
+        data = b"Subject: hi\n\nbody\n" * 10000
+        msg_id = store.add_received(peer="p", helo="h", envelope_from="a",
+                                    envelope_to=["b"], subject="hi", raw_bytes=data)
+        root = Root(store, blobs=blobs)
+
+        def get():  # type: ignore[no-untyped-def]
+            request = DummyRequest([b"messages", msg_id.encode(), b"raw"])
+            getChildForRequest(root, request).render(request)
+            return request
+
+        self.assertEqual(get().responseCode, 404)
+        blobs.put(store.get(msg_id).sha256, io.BytesIO(data))  # type: ignore[union-attr]
+        request = get()
+        self.assertEqual(b"".join(request.written), data)
+        self.assertEqual(request.finished, 1)
+        self.assertEqual(request.responseHeaders.getRawHeaders(b"content-type"),
+                         [b"message/rfc822"])
+
+    def test_truncated_blob_aborts_the_download(self) -> None:
+        blobs = BlobStore(self.dir, 1024 * 1024)
+        store = MessageStore(max_store=10)
+        data = os.urandom(200_000)
+        msg_id = store.add_received(peer="p", helo="h", envelope_from="a",
+                                    envelope_to=["b"], subject="hi", raw_bytes=data)
+        sha256 = _put(blobs, data)
+        path = blobs._find(sha256)
+        assert path is not None
+        os.truncate(path, os.path.getsize(path) // 2)
+
+        request = DummyRequest([b"messages", msg_id.encode(), b"raw"])
+        request.transport = StringTransport()
+        with mock.patch("smtp_relay.http_server.log.err") as err:
+            getChildForRequest(Root(store, blobs=blobs), request).render(request)
+        err.assert_called_once()
+        self.assertTrue(request.transport.disconnecting)
+        self.assertEqual(request.finished, 0)
+        self.assertLess(sum(map(len, request.written)), len(data))
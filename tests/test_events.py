@@ -0,0 +1,89 @@
+from __future__ import annotations
+
+import json
+import unittest
+
+from twisted.internet.task import Clock
+
+from smtp_relay.events import EventHub
+from smtp_relay.models import RelayAttempt, utc_now
+from smtp_relay.store import MessageStore
+
+
+class _Request:
+    def __init__(self) -> None:
+        self.written: list = []
+        self.producer = None
+
+    def write(self, data: bytes) -> None:
+        self.written.append(data)
+
+    def registerProducer(self, producer, streaming):  # type: ignore[no-untyped-def]
+        self.producer = producer
+
+    def events(self) -> list:
+        out = []
+        for frame in self.written:
+            if frame.startswith(b"event: "):
+                head, data = frame.decode().split("\ndata: ")
+                out.append((head[len("event: "):], json.loads(data)))
+        return out
+
+
+class TestEventHub(unittest.TestCase):
+    def setUp(self) -> None:
+        self.store = MessageStore(max_store=100)
+        self.clock = Clock()
+        self.hub = EventHub(self.store, self.clock, max_buffered=3)
+
+    def _add(self, subject: str = "s") -> str:
+        return self.store.add_received(peer="p", helo=None, envelope_from="a",
+                                       envelope_to=["b"], subject=subject,
+                                       raw_bytes=b"x")
+
+    def test_pushes_changes_and_stats_deltas(self) -> None:
+        request = _Request()
+        self.hub.add(request)  # type: ignore[arg-type]
+        msg_id = self._add()
+        self.store.set_relay_attempt(msg_id, RelayAttempt(
+            started_at=utc_now(), finished_at=utc_now(), ok=True, error=None))
+        self.clock.advance(2)
+        events = request.events()
+        self.assertEqual(events[0][0], "stats")
+        self.assertEqual([(e, d["event"], d["status"]) for e, d in events[1:3]],
+                         [("message", "received", "PENDING"),
+                          ("message", "relayed", "OK")])
+        self.assertEqual(events[3], ("stats", {"received_total": 1,
+                                               "relayed_ok_total": 1,
+                                               "stored_count": 1}))
+        self.clock.advance(2)
+        self.assertEqual(request.written[-1], b":\n\n")
+
+    def test_paused_subscriber_coalesces_then_resyncs(self) -> None:
+        request = _Request()
+        sub = self.hub.add(request)  # type: ignore[arg-type]
+        request.written.clear()
+        sub.pauseProducing()
+        msg_id = self._add()
+        self.store.set_relay_attempt(msg_id, RelayAttempt(
+            started_at=utc_now(), finished_at=utc_now(), ok=False, error="x"))
+        self.clock.advance(2)
+        self.assertEqual(request.written, [])
+        sub.resumeProducing()
+        self.assertEqual([(e, d.get("status")) for e, d in request.events()],
+                         [("message", "FAIL"), ("stats", None)])
+
+        request.written.clear()
+        sub.pauseProducing()
+        for i in range(5):
+            self._add()
+        sub.resumeProducing()
+        self.assertEqual(request.events(), [("resync", {})])
+
+    def test_ticker_stops_without_subscribers(self) -> None:
+        request = _Request()
+        sub = self.hub.add(request)  # type: ignore[arg-type]
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+        sub.stopProducing()
+        self.assertEqual(self.hub.subscribers(), 0)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
@@ -0,0 +1,116 @@
+from __future__ import annotations
+
+import gzip
+import unittest
+
+from twisted.internet import defer
+from twisted.web.resource import getChildForRequest
+from twisted.web.server import NOT_DONE_YET
+from twisted.web.test.requesthelper import DummyRequest
+
+from smtp_relay.http_server import Root
+from smtp_relay.models import RelayAttempt, utc_now
+from smtp_relay.store import MessageStore
+
+
+class TestRenderCache(unittest.TestCase):
+    def setUp(self) -> None:
+        self.store = MessageStore(max_store=10)
+        self._add()
+        self.root = Root(self.store)
+
+    def _add(self) -> None:
+        self.store.add_received(peer="p", helo="h", envelope_from="a",
+                                envelope_to=["b"], subject="hello", raw_bytes=b"x")
+
+    def _get(self, path: bytes, **headers: bytes):  # type: ignore[no-untyped-def]
+        request = DummyRequest(path.lstrip(b"/").split(b"/"))
+        request.uri = path
+        for name, value in headers.items():
+            request.requestHeaders.setRawHeaders(name.replace("_", "-"), [value])
+        body = getChildForRequest(self.root, request).render(request)
+        etag = request.responseHeaders.getRawHeaders(b"etag", [None])[0]
+        return request.responseCode or 200, etag, body
+
+    def test_etag_and_not_modified(self) -> None:
+        code, etag, body = self._get(b"/messages")
+        self.assertEqual(code, 200)
+        self.assertIn(b"hello", body)
+        code, again, body = self._get(b"/messages", if_none_match=etag)
+        self.assertEqual((code, again, body), (304, etag, b""))
+
+        self._add()
+        code, changed, _ = self._get(b"/messages", if_none_match=etag)
+        self.assertEqual(code, 200)
+        self.assertNotEqual(changed, etag)
+
+    def test_history_read_finishes_later(self) -> None:
+        pending: list = []
+
+        def fetch(message_id):  # type: ignore[no-untyped-def]
+            pending.append(defer.Deferred())
+            return pending[-1]
+
+        self.store.fetch = fetch  # type: ignore[method-assign]
+        request = DummyRequest([b"messages", b"00000001"])
+        request.uri = b"/messages/00000001"
+        body = getChildForRequest(self.root, request).render(request)
+        self.assertEqual((body, request.finished), (NOT_DONE_YET, 0))
+        pending[0].callback(self.store.get("00000001"))
+        self.assertEqual(request.finished, 1)
+        self.assertIn(b"hello", b"".join(request.written))
+
+    def test_gzip_has_its_own_etag(self) -> None:
+        _, plain_tag, plain = self._get(b"/messages/00000001")
+        code, gz_tag, body = self._get(b"/messages/00000001",
+                                       accept_encoding=b"gzip, deflate")
+        self.assertEqual(code, 200)
+        self.assertNotEqual(gz_tag, plain_tag)
+        self.assertEqual(gzip.decompress(body), plain)
+        code, _, _ = self._get(b"/messages/00000001", accept_encoding=b"gzip",
+                               if_none_match=gz_tag)
+        self.assertEqual(code, 304)
+
+    def test_dashboard_tracks_gauges(self) -> None:
+        _, etag, _ = self._get(b"/")
+        self.store.set_gauge("smtp_connections", 7)
+        code, changed, body = self._get(b"/", if_none_match=etag)
+        self.assertEqual(code, 200)
+        self.assertIn(b'<code id="g-smtp_connections">7</code>', body)
+
+    def test_dashboard_lists_upstreams(self) -> None:
+        self.store.set_gauge("upstream.backup.breaker", 2)
+        self.store.set_gauge("upstream.backup.sent", 4)
+        _, _, body = self._get(b"/")
+        self.assertIn(b"<td>backup</td>", body)
+        self.assertIn(b'<code id="g-upstream.backup.breaker">open</code>', body)
+        self.assertIn(b'<code id="g-upstream.backup.sent">4</code>', body)
+        self.assertNotIn(b"<li>upstream.backup", body)
+
+    def test_stage_timings(self) -> None:
+        self.store.set_gauge("stage.data.p99_ms", 40)
+        _, _, body = self._get(b"/")
+        self.assertIn(b'<code id="g-stage.data.p99_ms">40</code>', body)
+        self.store.set_relay_attempt("00000001", RelayAttempt(
+            started_at=utc_now(), finished_at=utc_now(), ok=True, error=None),
+            (("data", 0.25), ("reply", 0.5)))
+        _, _, body = self._get(b"/messages/00000001")
+        self.assertIn(b"<li>reply: <code>500.0 ms</code></li>", body)
+        self.assertIn(b"<li>Total: <code>750.0 ms</code></li>", body)
+
+
+class TestMessagesFilter(unittest.TestCase):
+    def test_filter_and_older_link(self) -> None:
+        store = MessageStore(max_store=10)
+        for sender in ("a@x", "b@x", "a@x", "a@x"):
+            store.add_received(peer="p", helo="h", envelope_from=sender,
+                               envelope_to=["r"], subject=None, raw_bytes=b"x")
+        request = DummyRequest([b"messages"])
+        request.uri = b"/messages?from=a%40x&limit=2"
+        request.addArg(b"from", b"a@x")
+        request.addArg(b"limit", b"2")
+        body = getChildForRequest(Root(store), request).render(request)
+        self.assertIn(b"00000004", body)
+        self.assertIn(b"00000003", body)
+        self.assertNotIn(b"00000002", body)
+        self.assertIn(b"/messages?from=a%40x&amp;limit=2&amp;cursor=3", body)
@@ -0,0 +1,44 @@
+from __future__ import annotations
+
+import unittest
+
+from smtp_relay.metrics import Metrics, render
+from smtp_relay.store import MessageStore
+
+
+class TestMetrics(unittest.TestCase):
+    def test_renders_counters_histograms_and_gauges(self) -> None:
+        m = Metrics()
+        m.received_messages.inc()
+        m.received_bytes.inc(2000)
+        m.message_size.observe(2000)
+        m.message_size.observe(10 ** 9)
+        store = MessageStore(max_store=10)
+        store.set_gauge("smtp_connections", 3)
+        store.set_gauge("upstream.a.sent", 5)
+        store.set_gauge("upstream.b.sent", 2)
+
+        text = render(m, [({}, m.snapshot())], store.stats()).decode()
+        lines = text.splitlines()
+        self.assertIn("# TYPE smtp_relay_received_messages_total counter", lines)
+        self.assertIn("smtp_relay_received_bytes_total 2000", lines)
+        self.assertIn('smtp_relay_message_size_bytes_bucket{le="1024"} 0', lines)
+        self.assertIn('smtp_relay_message_size_bytes_bucket{le="4096"} 1', lines)
+        self.assertIn('smtp_relay_message_size_bytes_bucket{le="+Inf"} 2', lines)
+        self.assertIn("smtp_relay_message_size_bytes_count 2", lines)
+        self.assertIn("smtp_relay_smtp_connections 3", lines)
+        self.assertIn("smtp_relay_store_messages 0", lines)
+        self.assertEqual(lines.count("# TYPE smtp_relay_upstream_sent gauge"), 1)
+        self.assertIn('smtp_relay_upstream_sent{upstream="a"} 5', lines)
+        self.assertIn('smtp_relay_upstream_sent{upstream="b"} 2', lines)
+
+    def test_labels_each_source(self) -> None:
+        m = Metrics()
+        m.data_seconds.observe(0.2)
+        snap = m.snapshot()
+        text = render(Metrics(), [({"worker": "0"}, snap), ({"worker": "1"}, {})],
+                      MessageStore(max_store=10).stats()).decode()
+        self.assertIn('smtp_relay_data_to_eom_seconds_bucket{worker="0",le="0.25"} 1',
+                      text)
+        self.assertIn('smtp_relay_data_to_eom_seconds_count{worker="1"} 0', text)
+        self.assertIn('smtp_relay_relayed_messages_total{worker="1"} 0', text)
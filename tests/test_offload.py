@@ -0,0 +1,62 @@
+from __future__ import annotations
+
+import threading
+import time
+import unittest
+
+from twisted.internet import defer
+
+from smtp_relay.models import InboundMeta
+from smtp_relay.offload import Offloader
+from smtp_relay.relay_client import repair_message
+
+
+class _ThreadReactor:
+    # Runs callFromThread callbacks in the calling thread; enough to collect
+    # results in tests.
+    def callFromThread(self, f, *args, **kw):  # type: ignore[no-untyped-def]
+        f(*args, **kw)
+
+    def addSystemEventTrigger(self, *args):  # type: ignore[no-untyped-def]
+        pass
+
+
+def _wait(d):  # type: ignore[no-untyped-def]
+    done = threading.Event()
+    results: list = []
+    d.addBoth(lambda r: (results.append(r), done.set()))
+    assert done.wait(30)
+    return results[0]
+
+
+class TestOffloader(unittest.TestCase):
+    def test_small_work_runs_inline(self) -> None:
+        off = Offloader(threshold=1000, threads=2, reactor=_ThreadReactor())
+        results: list = []
+        off.run(999, threading.get_ident).addCallback(results.append)
+        self.assertEqual(results, [threading.get_ident()])
+
+    def test_large_work_runs_on_pool(self) -> None:
+        off = Offloader(threshold=1000, threads=2, reactor=_ThreadReactor())
+        off.start()
+        self.addCleanup(off.stop)
+        self.assertNotEqual(_wait(off.run(1000, threading.get_ident)),
+                            threading.get_ident())
+
+    def test_cpu_work_runs_in_process_pool(self) -> None:
+        off = Offloader(threshold=10, threads=1, processes=1, reactor=_ThreadReactor())
+        off.start()
+        self.addCleanup(off.stop)
+        meta = InboundMeta(peer="p", helo=None, envelope_from="a@x", envelope_to=["b@y"])
+        raw = b"Subject: hi\n\nbody\n"
+        self.assertEqual(_wait(off.run_cpu(len(raw), repair_message, raw, meta)),
+                         repair_message(raw, meta))
+
+    def test_cpu_work_cancelled_at_shutdown_fails(self) -> None:
+        off = Offloader(threshold=10, threads=1, processes=1, reactor=_ThreadReactor())
+        off.start()
+        ds = [off.run_cpu(10, time.sleep, 0.2) for _ in range(4)]
+        off.stop()
+        results = [_wait(d) for d in ds]
+        self.assertIsNone(results[0])
+        self.assertIsInstance(results[-1].value, defer.CancelledError)
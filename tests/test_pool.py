@@ -0,0 +1,173 @@
+from __future__ import annotations
+
+import unittest
+from io import BytesIO
+
+from twisted.internet.address import IPv4Address
+from twisted.internet.error import ConnectionAborted
+from twisted.internet.interfaces import ISSLTransport
+from twisted.internet.testing import MemoryReactorClock, StringTransport
+from twisted.python.failure import Failure
+from zope.interface import implementer
+
+from smtp_relay.pool import UpstreamPool
+from smtp_relay.tracing import MessageTrace
+
+from .util import make_config
+
+
+@implementer(ISSLTransport)
+class _TLSTransport(StringTransport):
+    pass
+
+
+class _Upstream:
+    def __init__(self, reactor: MemoryReactorClock, index: int = -1) -> None:
+        factory = reactor.tcpClients[index][2]
+        self.proto = factory.buildProtocol(IPv4Address("TCP", "127.0.0.1", 587))
+        self.transport = _TLSTransport()
+        self.proto.makeConnection(self.transport)
+
+    def written(self) -> bytes:
+        out = self.transport.value()
+        self.transport.clear()
+        return out
+
+    def reply(self, *lines: bytes) -> None:
+        self.proto.dataReceived(b"".join(line + b"\r\n" for line in lines))
+
+    def pump(self) -> None:
+        while self.transport.producer is not None:
+            self.transport.producer.resumeProducing()
+
+    def handshake(self) -> None:
+        self.reply(b"220 ready")
+        self.reply(b"250-upstream.example", b"250 AUTH PLAIN")
+        self.reply(b"235 ok")
+        self.written()
+
+    def transaction(self) -> None:
+        self.reply(b"250 sender ok")
+        self.reply(b"250 rcpt ok")
+        self.reply(b"354 go ahead")
+        self.pump()
+        self.reply(b"250 queued")
+
+
+class TestUpstreamPool(unittest.TestCase):
+    def test_reuses_authenticated_session(self) -> None:
+        reactor = MemoryReactorClock()
+        pool = UpstreamPool(make_config(), reactor)
+        results: list = []
+
+        pool.send("a@example.com", ["b@example.com"],
+                  lambda: BytesIO(b"Subject: 1\n\nx\n")).addCallback(results.append)
+        self.assertEqual(len(reactor.tcpClients), 1)
+        up = _Upstream(reactor)
+        up.handshake()
+        up.transaction()
+        self.assertEqual(len(results), 1)
+        self.assertIn(b"RSET", up.written())
+        up.reply(b"250 reset")
+        self.assertEqual(pool.idle_count(), 1)
+
+        pool.send("a@example.com", ["b@example.com"],
+                  lambda: BytesIO(b"Subject: 2\n\ny\n")).addCallback(results.append)
+        self.assertEqual(len(reactor.tcpClients), 1)
+        self.assertTrue(up.written().startswith(b"MAIL FROM:<a@example.com>"))
+        up.transaction()
+        self.assertEqual(len(results), 2)
+
+    def test_traces_session_setup_for_first_message_only(self) -> None:
+        reactor = MemoryReactorClock()
+        pool = UpstreamPool(make_config(), reactor)
+        first, second = MessageTrace(), MessageTrace()
+        pool.send("a@example.com", ["b@example.com"], lambda: BytesIO(b"x\n"), first)
+        up = _Upstream(reactor)
+        up.handshake()
+        up.transaction()
+        up.reply(b"250 reset")
+        pool.send("a@example.com", ["b@example.com"], lambda: BytesIO(b"y\n"), second)
+        up.transaction()
+        self.assertEqual([stage for stage, _ in first.stages()],
+                         ["pool", "connect", "starttls", "auth", "transfer", "reply"])
+        self.assertEqual([stage for stage, _ in second.stages()],
+                         ["pool", "transfer", "reply"])
+
+    def test_retires_after_max_messages(self) -> None:
+        reactor = MemoryReactorClock()
+        pool = UpstreamPool(make_config(upstream_max_messages=1), reactor)
+        pool.send("a@example.com", ["b@example.com"], lambda: BytesIO(b"x\n"))
+        up = _Upstream(reactor)
+        up.handshake()
+        up.transaction()
+        up.written()
+        up.reply(b"250 reset")
+        self.assertEqual(up.written(), b"QUIT\r\n")
+        self.assertEqual(pool.size(), 0)
+
+    def test_idle_timeout_closes_session(self) -> None:
+        reactor = MemoryReactorClock()
+        pool = UpstreamPool(make_config(upstream_idle_timeout=5), reactor)
+        pool.send("a@example.com", ["b@example.com"], lambda: BytesIO(b"x\n"))
+        up = _Upstream(reactor)
+        up.handshake()
+        up.transaction()
+        up.reply(b"250 reset")
+        up.written()
+        reactor.advance(5)
+        self.assertEqual(up.written(), b"QUIT\r\n")
+        self.assertEqual(pool.idle_count(), 0)
+
+    def test_pipelines_batched_transactions(self) -> None:
+        reactor = MemoryReactorClock()
+        pool = UpstreamPool(make_config(upstream_batch_size=2), reactor)
+        results: list = []
+        errors: list = []
+        for n in range(3):
+            pool.send("a@example.com", ["b@example.com", "c@example.com"],
+                      lambda: BytesIO(b"x\n")).addCallbacks(results.append, errors.append)
+        self.assertEqual(len(reactor.tcpClients), 2)
+        up = _Upstream(reactor, 0)
+        up.reply(b"220 ready")
+        up.reply(b"250-upstream.example", b"250-PIPELINING", b"250 AUTH PLAIN")
+        up.reply(b"235 ok")
+        self.assertEqual(up.written().splitlines()[-4:], [
+            b"MAIL FROM:<a@example.com>",
+            b"RCPT TO:<b@example.com>",
+            b"RCPT TO:<c@example.com>",
+            b"DATA",
+        ])
+        up.reply(b"250 sender ok", b"250 rcpt ok", b"550 no such user", b"354 go")
+        up.pump()
+        up.reply(b"250 queued")
+        self.assertEqual(len(results), 1)
+        self.assertEqual(results[0][0], 1)
+        self.assertNotIn(b"RSET", up.written())
+
+        up.reply(b"550 sender rejected", b"503 no sender", b"503 no sender",
+                 b"503 no valid recipients")
+        self.assertEqual(len(results), 1)
+        self.assertEqual(errors[0].value.code, 550)
+        self.assertIn(b"RSET", up.written())
+        self.assertEqual(pool.queued(), 1)
+
+    def test_data_accepted_after_failed_transaction_drops_session(self) -> None:
+        reactor = MemoryReactorClock()
+        pool = UpstreamPool(make_config(upstream_batch_size=2), reactor)
+        errors: list = []
+        for n in range(2):
+            pool.send("a@example.com", ["b@example.com"],
+                      lambda: BytesIO(b"x\n")).addErrback(errors.append)
+        up = _Upstream(reactor)
+        up.reply(b"220 ready")
+        up.reply(b"250-upstream.example", b"250-PIPELINING", b"250 AUTH PLAIN")
+        up.reply(b"235 ok")
+        up.written()
+        up.reply(b"550 sender rejected", b"503 no sender", b"354 go")
+        self.assertEqual([f.value.code for f in errors], [550])
+        self.assertTrue(up.transport.disconnecting)
+        self.assertNotIn(b".\r\n", up.written())
+        up.proto.connectionLost(Failure(ConnectionAborted()))
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(pool.queued(), 1)
@@ -0,0 +1,133 @@
+from __future__ import annotations
+
+import unittest
+from email import message_from_bytes
+from io import BytesIO
+
+from twisted.internet import defer
+from twisted.internet.task import Clock
+
+from smtp_relay.models import InboundMeta
+from smtp_relay.relay_client import SendScheduler, parse_headers, relay_to_gmail
+
+from .util import make_config
+
+_META = InboundMeta(peer="10.0.0.1:4000", helo="client.example",
+                    envelope_from="a@example.com",
+                    envelope_to=["b@example.com", "c@example.com"])
+
+
+class _CapturingPool:
+    def __init__(self) -> None:
+        self.opened: list = []
+
+    def send(self, from_addr, to_addrs, open_data):  # type: ignore[no-untyped-def]
+        self.opened.append(open_data)
+        return defer.succeed(None)
+
+    def body(self, index: int = 0, chunk: int = 7) -> bytes:
+        f = self.opened[index]()
+        out = []
+        while True:
+            data = f.read(chunk)
+            if not data:
+                break
+            out.append(data)
+        f.close()
+        return b"".join(out)
+
+
+class TestParseHeaders(unittest.TestCase):
+    def test_unfolds_and_keeps_first_occurrence(self) -> None:
+        info = parse_headers(
+            b"Subject: hello\n  world\nsubject: second\nMessage-ID: <1@x>\n"
+        )
+        self.assertFalse(info.malformed)
+        self.assertEqual(info.subject, "hello  world")
+        self.assertEqual(info.message_id, "<1@x>")
+
+    def test_missing_and_empty_subject(self) -> None:
+        self.assertIsNone(parse_headers(b"From: a@x\n").subject)
+        self.assertIsNone(parse_headers(b"Subject:   \n").subject)
+        self.assertIsNone(parse_headers(b"").subject)
+
+    def test_flags_malformed_lines(self) -> None:
+        self.assertTrue(parse_headers(b"not a header\nSubject: x\n").malformed)
+        self.assertTrue(parse_headers(b" leading continuation\n").malformed)
+
+
+class TestRelayToGmail(unittest.TestCase):
+    def test_prepends_x_headers_without_reparsing(self) -> None:
+        raw = b"Subject: hi\nFrom: a@example.com\n\nbody line\n"
+        pool = _CapturingPool()
+        relay_to_gmail(make_config(), pool, lambda: BytesIO(raw), _META)  # type: ignore[arg-type]
+        out = pool.body()
+        self.assertTrue(out.endswith(raw))
+        msg = message_from_bytes(out)
+        self.assertEqual(msg["X-Original-Peer"], "10.0.0.1:4000")
+        self.assertEqual(msg["X-Original-HELO"], "client.example")
+        self.assertEqual(msg["X-Original-Rcpt-To"], "b@example.com, c@example.com")
+        self.assertEqual(msg["Subject"], "hi")
+
+    def test_can_be_reopened_for_retries(self) -> None:
+        pool = _CapturingPool()
+        relay_to_gmail(make_config(), pool, lambda: BytesIO(b"Subject: x\n\ny\n"),  # type: ignore[arg-type]
+                       _META)
+        self.assertEqual(pool.body(chunk=3), pool.body(chunk=1024))
+
+    def test_malformed_message_goes_through_email_package(self) -> None:
+        pool = _CapturingPool()
+        relay_to_gmail(make_config(), pool, lambda: BytesIO(b"Subject: x\n\nbody\n"),  # type: ignore[arg-type]
+                       _META, malformed=True)
+        msg = message_from_bytes(pool.body())
+        self.assertEqual(msg["X-Original-Mail-From"], "a@example.com")
+        self.assertEqual(msg.get_payload().strip(), "body")
+
+    def test_without_x_headers_sends_original_bytes(self) -> None:
+        raw = b"Subject: x\n\nbody\n"
+        pool = _CapturingPool()
+        relay_to_gmail(make_config(add_x_headers=False), pool, lambda: BytesIO(raw),  # type: ignore[arg-type]
+                       _META)
+        self.assertEqual(pool.body(), raw)
+
+
+class TestSendScheduler(unittest.TestCase):
+    def _scheduler(self, **kw):  # type: ignore[no-untyped-def]
+        clock = Clock()
+        pool = _CapturingPool()
+        return SendScheduler(make_config(**kw), pool, clock), pool, clock  # type: ignore[arg-type]
+
+    def test_paces_messages_per_second(self) -> None:
+        sched, pool, clock = self._scheduler(upstream_msgs_per_sec=2.0)
+        results = [sched.send("a", ["b"], lambda: BytesIO(b"")) for _ in range(6)]
+        self.assertEqual(len(pool.opened), 2)
+        self.assertEqual(sched.queued(), 4)
+        self.assertEqual(sched.gauges()["upstream_drain_seconds"], 2)
+        clock.advance(0.5)
+        self.assertEqual(len(pool.opened), 3)
+        clock.pump([0.5, 0.5, 0.5])
+        self.assertEqual(len(pool.opened), 6)
+        for d in results:
+            self.assertTrue(d.called)
+
+    def test_counts_recipients_and_daily_messages(self) -> None:
+        sched, pool, clock = self._scheduler(upstream_msgs_per_sec=0,
+                                             upstream_rcpts_per_min=4,
+                                             upstream_msgs_per_day=100)
+        sched.send("a", ["b", "c", "d"], lambda: BytesIO(b""))
+        sched.send("a", ["b", "c"], lambda: BytesIO(b""))
+        self.assertEqual(len(pool.opened), 1)
+        gauges = sched.gauges()
+        self.assertEqual(gauges["quota_rcpts_per_min_used"], 3)
+        self.assertEqual(gauges["quota_msgs_per_day_used"], 1)
+        clock.advance(15)
+        self.assertEqual(len(pool.opened), 2)
+        self.assertEqual(sched.queued(), 0)
+
+    def test_unlimited_sends_immediately(self) -> None:
+        sched, pool, _ = self._scheduler(upstream_msgs_per_sec=0)
+        for _ in range(50):
+            sched.send("a", ["b"], lambda: BytesIO(b""))
+        self.assertEqual(len(pool.opened), 50)
+        self.assertEqual(sched.gauges(), {"upstream_queued": 0,
+                                          "upstream_drain_seconds": 0})
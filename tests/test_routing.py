@@ -0,0 +1,65 @@
+from __future__ import annotations
+
+import unittest
+
+from smtp_relay.config import RouteRule, parse_routes
+from smtp_relay.routing import Route, RoutingTable
+
+from .util import make_config
+
+_RULES = """
+# pattern          destinations                   upstream
+alice@a.example    alice@gmail.example
+@a.example         ops@a.example,oncall@a.example tenant_a
+.b.example         *                              tenant_b
+*.deep.b.example   deep@b.example
+*                  archive@example.com
+"""
+
+
+class TestParseRoutes(unittest.TestCase):
+    def test_parses_rules(self) -> None:
+        rules = parse_routes(_RULES)
+        self.assertEqual(rules[1], RouteRule("@a.example",
+                                             ("ops@a.example", "oncall@a.example"), "tenant_a"))
+        self.assertEqual(rules[2].destinations, ())
+
+    def test_rejects_bad_rules(self) -> None:
+        for text in ("", "a*@x.example dest@x", "@x.example", "@x dest@x up extra",
+                     "@x d@x\n*@x e@x", "* not-an-address"):
+            with self.assertRaises(ValueError, msg=text):
+                parse_routes(text)
+
+
+class TestRoutingTable(unittest.TestCase):
+    def setUp(self) -> None:
+        self.table = RoutingTable(parse_routes(_RULES))
+
+    def test_most_specific_match_wins(self) -> None:
+        lookup = self.table.lookup
+        self.assertEqual(lookup("Alice@A.example"), Route(("alice@gmail.example",)))
+        self.assertEqual(lookup("bob@a.example").upstream, "tenant_a")  # type: ignore[union-attr]
+        self.assertEqual(lookup("x@mx.b.example"), Route((), "tenant_b"))
+        self.assertEqual(lookup("x@b.example"), Route(("archive@example.com",)))
+        self.assertEqual(lookup("x@a.deep.b.example"), Route(("deep@b.example",)))
+        self.assertEqual(lookup("x@sub.a.example"), Route(("archive@example.com",)))
+
+    def test_split_groups_recipients_per_route(self) -> None:
+        txs = self.table.split(["bob@a.example", "x@mx.b.example", "carol@a.example",
+                                "y@mx.b.example", "z@other.example"])
+        self.assertEqual(txs, [
+            ("tenant_a", ("ops@a.example", "oncall@a.example")),
+            ("tenant_b", ("x@mx.b.example", "y@mx.b.example")),
+            (None, ("archive@example.com",)),
+        ])
+
+    def test_defaults_to_forward_to(self) -> None:
+        table = RoutingTable.from_config(make_config())
+        self.assertEqual(table.split(["a@x", "b@y"]), [(None, ("dest@example.com",))])
+        strict = RoutingTable.from_config(make_config(allow_any_rcpt=False))
+        self.assertIsNone(strict.lookup("a@x"))
+        self.assertIsNotNone(strict.lookup("Dest@Example.com"))
+
+
+if __name__ == "__main__":
+    unittest.main()
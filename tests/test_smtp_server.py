@@ -0,0 +1,329 @@
+from __future__ import annotations
+
+import os
+import tempfile
+import unittest
+
+from twisted.internet import defer
+from twisted.internet.address import IPv4Address
+from twisted.internet.task import Clock
+from twisted.internet.testing import StringTransport
+
+from smtp_relay.admission import AdmissionController
+from smtp_relay.config import RouteRule
+from smtp_relay.routing import RoutingTable
+from smtp_relay.smtp_server import RelaySMTPFactory
+from smtp_relay.spool import Spool
+from smtp_relay.store import MessageStore
+
+from .util import make_config
+
+
+class _FakeScheduler:
+    def __init__(self) -> None:
+        self.submitted: list = []
+        self.traces: list = []
+        self.requeued: list = []
+
+    def submit(self, entry, message_id, malformed=False, size_bytes=0, sha256=None,  # type: ignore[no-untyped-def]
+               trace=None):
+        self.submitted.append((entry, message_id))
+        self.traces.append(trace)
+
+    def requeue(self, entry):  # type: ignore[no-untyped-def]
+        self.requeued.append(entry)
+
+
+class _HeldOffload:
+    # Runs nothing until release(), like a slow fsync on the thread pool.
+    def __init__(self) -> None:
+        self.pending: list = []
+
+    def run(self, size, fn, *args):  # type: ignore[no-untyped-def]
+        d: defer.Deferred = defer.Deferred()
+        self.pending.append((d, fn, args))
+        return d
+
+    def release(self) -> None:
+        pending, self.pending = self.pending, []
+        for d, fn, args in pending:
+            d.callback(fn(*args))
+
+
+class _SessionTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.store = MessageStore(max_store=1000)
+        self.spool = Spool(tmp.name)
+        self.scheduler = _FakeScheduler()
+        self.factory = RelaySMTPFactory(make_config(), self.store, self.spool,
+                                        self.scheduler)
+        self.clock = Clock()
+
+    def _connect(self, port: int, host: str = "10.0.0.1"):  # type: ignore[no-untyped-def]
+        addr = IPv4Address("TCP", host, port)
+        proto = self.factory.buildProtocol(addr)
+        proto.callLater = self.clock.callLater
+        transport = StringTransport(peerAddress=addr)
+        proto.makeConnection(transport)
+        return proto, transport
+
+
+class TestSessions(_SessionTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.factory = RelaySMTPFactory(make_config(max_connections_per_peer=1000),
+                                        self.store, self.spool, self.scheduler)
+
+    def _session_lines(self, i: int, transactions: int = 2) -> list:
+        lines = [b"EHLO client%d" % i]
+        for t in range(transactions):
+            lines += [
+                b"MAIL FROM:<s%d-%d@x>" % (i, t),
+                b"RCPT TO:<r%d-%d@y>" % (i, t),
+                b"RCPT TO:<r%d-%d-cc@y>" % (i, t),
+                b"DATA",
+                b"Subject: %d-%d" % (i, t),
+                b"",
+                b"body",
+                b".",
+            ]
+            if t == 0:
+                lines += [b"MAIL FROM:<abandoned@x>", b"RCPT TO:<stale@y>", b"RSET"]
+        return lines + [b"QUIT"]
+
+    def test_interleaved_sessions_keep_envelopes_apart(self) -> None:
+        sessions = 200
+        conns = [self._connect(40000 + i) for i in range(sessions)]
+        scripts = [self._session_lines(i) for i in range(sessions)]
+        for step in range(max(len(s) for s in scripts)):
+            for (proto, _), script in zip(conns, scripts):
+                if step < len(script):
+                    proto.dataReceived(script[step] + b"\r\n")
+
+        for (_, transport), i in zip(conns, range(sessions)):
+            self.assertEqual(transport.value().count(b"250 Delivery in progress"), 2,
+                             transport.value())
+
+        msgs = self.store.list_recent()
+        self.assertEqual(len(msgs), sessions * 2)
+        self.assertEqual(len(self.scheduler.submitted), sessions * 2)
+        for msg in msgs:
+            i, t = msg.subject.split("-")  # type: ignore[union-attr]
+            self.assertEqual(msg.peer, f"10.0.0.1:{40000 + int(i)}")
+            self.assertEqual(msg.helo, f"client{i}")
+            self.assertEqual(msg.envelope_from, f"s{i}-{t}@x")
+            self.assertEqual(msg.envelope_to, [f"r{i}-{t}@y", f"r{i}-{t}-cc@y"])
+
+    def test_spooled_message_is_accepted_even_if_queueing_fails(self) -> None:
+        def submit(*args, **kwargs):  # type: ignore[no-untyped-def]
+            raise RuntimeError("boom")
+
+        self.scheduler.submit = submit  # type: ignore[method-assign]
+        proto, transport = self._connect(40000)
+        proto.dataReceived(b"EHLO c\r\nMAIL FROM:<a@x>\r\nRCPT TO:<b@y>\r\nDATA\r\n"
+                           b"Subject: hi\r\n\r\nbody\r\n.\r\n")
+        self.assertTrue(transport.value().endswith(b"250 Delivery in progress\r\n"))
+        self.assertEqual(self.spool.recover(), self.scheduler.requeued)
+
+    def test_traces_ingest_stages(self) -> None:
+        proto, _ = self._connect(40000)
+        for line in self._session_lines(0):
+            proto.dataReceived(line + b"\r\n")
+        first, second = ([stage for stage, _ in t.stages()] for t in self.scheduler.traces)
+        # Only the session's first transaction includes the greeting.
+        self.assertEqual(first, ["greeting", "envelope", "data", "spool", "parse"])
+        self.assertEqual(second, ["envelope", "data", "spool", "parse"])
+
+
+class TestAdmission(_SessionTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        cfg = make_config(max_connections=3, max_connections_per_peer=2,
+                          max_inflight_relays=2)
+        self.admission = AdmissionController(cfg, self.store)
+        self.factory = RelaySMTPFactory(cfg, self.store, self.spool,
+                                        self.scheduler, self.admission)
+
+    def test_connection_caps_answer_421(self) -> None:
+        first = [self._connect(1), self._connect(2)]
+        _, refused = self._connect(3)
+        self.assertTrue(refused.value().startswith(b"421 "))
+        self.assertTrue(refused.disconnecting)
+
+        self._connect(4, host="10.0.0.2")
+        _, refused = self._connect(5, host="10.0.0.3")
+        self.assertTrue(refused.value().startswith(b"421 "))
+        self.assertEqual(self.store.stats().gauges["smtp_connections"], 3)
+
+        proto, transport = first[0]
+        proto.connectionLost(None)
+        _, accepted = self._connect(6, host="10.0.0.3")
+        self.assertTrue(accepted.value().startswith(b"220 "))
+
+    def test_full_queue_tempfails_mail_and_pauses_reading(self) -> None:
+        proto, transport = self._connect(1)
+        self.admission.relay_started(100)
+        self.admission.relay_started(100)
+        self.assertEqual(transport.producerState, "paused")
+
+        proto.dataReceived(b"EHLO c\r\nMAIL FROM:<a@x>\r\n")
+        self.assertIn(b"451 Relay queue is full", transport.value())
+        _, refused = self._connect(2, host="10.0.0.2")
+        self.assertTrue(refused.value().startswith(b"421 "))
+
+        self.admission.relay_finished(100)
+        self.assertEqual(transport.producerState, "producing")
+        self.assertEqual(self.store.stats().gauges["queued_bytes"], 100)
+
+
+class TestRouting(_SessionTestCase):
+    def test_unrouted_recipient_is_refused(self) -> None:
+        routes = RoutingTable([RouteRule("@tenant.example", ())])
+        self.factory = RelaySMTPFactory(make_config(), self.store, self.spool,
+                                        self.scheduler, routes=routes)
+        proto, transport = self._connect(1)
+        proto.dataReceived(b"EHLO c\r\nMAIL FROM:<a@x>\r\n"
+                           b"RCPT TO:<b@tenant.example>\r\nRCPT TO:<c@other.example>\r\n")
+        replies = transport.value().splitlines()
+        self.assertTrue(replies[-2].startswith(b"250 "))
+        self.assertTrue(replies[-1].startswith(b"550 "))
+
+
+class TestMessageSize(_SessionTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        # Spill early so the oversized message has a temporary file to clean up.
+        self.spool = Spool(self.spool.directory, 16)
+        self.factory = RelaySMTPFactory(make_config(max_message_size=100), self.store,
+                                        self.spool, self.scheduler)
+
+    def test_advertises_and_checks_declared_size(self) -> None:
+        proto, transport = self._connect(1)
+        proto.dataReceived(b"EHLO c\r\n")
+        self.assertIn(b"-SIZE 100\r\n", transport.value().replace(b"250 ", b"250-"))
+        transport.clear()
+        proto.dataReceived(b"MAIL FROM:<a@x> SIZE=101\r\n")
+        self.assertTrue(transport.value().startswith(b"552 5.3.4 "))
+        transport.clear()
+        proto.dataReceived(b"MAIL FROM:<a@x> SIZE=big\r\n")
+        self.assertTrue(transport.value().startswith(b"501 "))
+        transport.clear()
+        proto.dataReceived(b"MAIL FROM:<a@x> SIZE=100\r\n")
+        self.assertTrue(transport.value().startswith(b"250 "))
+
+    def test_oversized_data_is_dropped_and_refused_at_end(self) -> None:
+        proto, transport = self._connect(1)
+        proto.dataReceived(b"EHLO c\r\nMAIL FROM:<a@x>\r\nRCPT TO:<b@y>\r\nDATA\r\n")
+        transport.clear()
+        proto.dataReceived(b"Subject: big\r\n\r\n" + b"x" * 60 + b"\r\n")
+        proto.dataReceived(b"y" * 60 + b"\r\n")
+        self.assertEqual(transport.value(), b"")
+        proto.dataReceived(b".\r\n")
+        self.assertTrue(transport.value().startswith(b"552 5.3.4 "))
+        self.assertEqual(self.scheduler.submitted, [])
+        self.assertEqual(self.store.stats().received_total, 0)
+        self.assertEqual(os.listdir(self.spool.directory), ["failed"])
+        self.assertEqual(self.factory.metrics.oversized_messages.value, 1)
+
+        transport.clear()
+        proto.dataReceived(b"MAIL FROM:<a@x>\r\nRCPT TO:<b@y>\r\nDATA\r\nsmall\r\n.\r\n")
+        self.assertIn(b"250 Delivery in progress", transport.value())
+
+    def test_zero_disables_the_limit(self) -> None:
+        self.factory = RelaySMTPFactory(make_config(max_message_size=0), self.store,
+                                        self.spool, self.scheduler)
+        proto, transport = self._connect(1)
+        proto.dataReceived(b"EHLO c\r\nMAIL FROM:<a@x> SIZE=999999999\r\n")
+        self.assertIn(b"-SIZE\r\n", transport.value().replace(b"250 ", b"250-"))
+        self.assertTrue(transport.value().splitlines()[-1].startswith(b"250 "))
+
+
+class TestPipeliningAndChunking(_SessionTestCase):
+    def _body(self, entry) -> bytes:  # type: ignore[no-untyped-def]
+        with self.spool.open_body(entry) as f:
+            return f.read()
+
+    def test_advertises_extensions(self) -> None:
+        proto, transport = self._connect(1)
+        proto.dataReceived(b"EHLO c\r\n")
+        replies = transport.value().replace(b"250 ", b"250-")
+        self.assertIn(b"-PIPELINING\r\n", replies)
+        self.assertIn(b"-CHUNKING\r\n", replies)
+
+    def test_pipelined_commands_are_answered_after_pending_message(self) -> None:
+        offload = _HeldOffload()
+        self.factory = RelaySMTPFactory(make_config(), self.store, self.spool,
+                                        self.scheduler, offload=offload)
+        proto, transport = self._connect(1)
+        proto.dataReceived(b"EHLO c\r\nMAIL FROM:<a@x>\r\nRCPT TO:<b@y>\r\nDATA\r\n"
+                           b"Subject: one\r\n\r\nbody\r\n.\r\n"
+                           b"MAIL FROM:<c@x>\r\nRCPT TO:<d@y>\r\nBDAT 5 LAST\r\n")
+        self.assertTrue(transport.value().endswith(b"354 Continue\r\n"))
+        proto.dataReceived(b"x\r\n\r\n")
+        self.assertEqual(len(offload.pending), 1)
+
+        transport.clear()
+        offload.release()
+        self.assertEqual(len(offload.pending), 1)
+        self.assertEqual(transport.value().splitlines(),
+                         [b"250 Delivery in progress",
+                          b"250 Sender address accepted",
+                          b"250 Recipient address accepted"])
+        transport.clear()
+        offload.release()
+        self.assertEqual(transport.value(), b"250 Delivery in progress\r\n")
+        self.assertEqual([self._body(e) for e, _ in self.scheduler.submitted],
+                         [b"Subject: one\n\nbody\n", b"x\n\n"])
+
+    def test_bdat_stores_the_same_message_as_data(self) -> None:
+        message = b"Subject: hi\r\n\r\n.dot\r\nbinary \x00\xff\r\n"
+        proto, transport = self._connect(1)
+        proto.dataReceived(b"EHLO c\r\nMAIL FROM:<a@x>\r\nRCPT TO:<b@y>\r\nDATA\r\n"
+                           + message.replace(b"\r\n.", b"\r\n..") + b".\r\n")
+        # Split inside a CRLF and across packets.
+        first, second = message[:12], message[12:]
+        proto.dataReceived(b"MAIL FROM:<a@x>\r\nRCPT TO:<b@y>\r\n"
+                           b"BDAT %d\r\n%s" % (len(first), first[:5]))
+        proto.dataReceived(first[5:] + b"BDAT %d\r\n%s" % (len(second), second))
+        proto.dataReceived(b"BDAT 0 LAST\r\n")
+        replies = transport.value().splitlines()
+        self.assertEqual(replies[-3:], [b"250 2.0.0 12 octets received",
+                                        b"250 2.0.0 %d octets received" % len(second),
+                                        b"250 Delivery in progress"])
+        via_data, via_bdat = (self._body(e) for e, _ in self.scheduler.submitted)
+        self.assertEqual(via_data, b"Subject: hi\n\n.dot\nbinary \x00\xff\n")
+        self.assertEqual(via_bdat, via_data)
+        hashes = {m.sha256 for m in self.store.list_recent()}
+        self.assertEqual(len(hashes), 1)
+
+    def test_bdat_errors(self) -> None:
+        self.factory = RelaySMTPFactory(make_config(max_message_size=10), self.store,
+                                        self.spool, self.scheduler)
+        proto, transport = self._connect(1)
+        # The chunk is still read, not taken for commands.
+        proto.dataReceived(b"EHLO c\r\nBDAT 6\r\nRSET\r\n")
+        self.assertTrue(transport.value().endswith(b"503 5.5.1 Need MAIL and RCPT before BDAT\r\n"))
+
+        transport.clear()
+        proto.dataReceived(b"MAIL FROM:<a@x>\r\nRCPT TO:<b@y>\r\nBDAT 4\r\nabcd"
+                           b"MAIL FROM:<c@x>\r\nDATA\r\n")
+        self.assertEqual(transport.value().splitlines()[-2:],
+                         [b"503 5.5.1 BDAT transaction in progress",
+                          b"503 Must have valid receiver and originator"])
+
+        transport.clear()
+        proto.dataReceived(b"BDAT 8 LAST\r\nefghijkl")
+        self.assertTrue(transport.value().startswith(b"552 5.3.4 "))
+        self.assertEqual(self.scheduler.submitted, [])
+        self.assertEqual(os.listdir(self.spool.directory), ["failed"])
+
+        transport.clear()
+        proto.dataReceived(b"MAIL FROM:<a@x>\r\nRCPT TO:<b@y>\r\nBDAT 2 LAST\r\nok")
+        self.assertTrue(transport.value().endswith(b"250 Delivery in progress\r\n"))
+
+        transport.clear()
+        proto.dataReceived(b"BDAT many\r\n")
+        self.assertTrue(transport.value().startswith(b"501 "))
+        self.assertTrue(transport.disconnecting)
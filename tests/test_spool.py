@@ -0,0 +1,289 @@
+from __future__ import annotations
+
+import hashlib
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from twisted.internet import defer
+from twisted.internet.testing import MemoryReactorClock
+from twisted.mail import smtp
+
+from smtp_relay.config import RouteRule
+from smtp_relay.dedup import DedupCache
+from smtp_relay.delivery import DeliveryScheduler
+from smtp_relay.metrics import Metrics
+from smtp_relay.models import InboundMeta
+from smtp_relay.routing import RoutingTable
+from smtp_relay.spool import Spool
+from smtp_relay.store import MessageStore
+
+from .util import make_config
+
+_META = InboundMeta(peer="127.0.0.1:1234", helo="client", envelope_from="a@x",
+                    envelope_to=["b@y"])
+
+
+class _FakePool:
+    def __init__(self) -> None:
+        self.sent: list = []
+        self.routes: list = []
+
+    def send(self, from_addr, to_addrs, data, upstream=None, trace=None):  # type: ignore[no-untyped-def]
+        d: defer.Deferred[object] = defer.Deferred()
+        self.sent.append((data, d))
+        self.routes.append((upstream, list(to_addrs)))
+        return d
+
+
+class TestSpool(unittest.TestCase):
+    def setUp(self) -> None:
+        self._tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self._tmp.cleanup)
+        self.dir = self._tmp.name
+
+    def test_adopt_moves_another_spools_messages(self) -> None:
+        old = Spool(os.path.join(self.dir, "worker-3"))
+        old.write(_META, b"Subject: one\n\nbody\n")
+        spool = Spool(self.dir)
+        self.assertEqual(spool.adopt(old.directory), 1)
+        self.assertEqual(old.recover(), [])
+        [entry] = spool.recover()
+        self.assertEqual(spool.read(entry), b"Subject: one\n\nbody\n")
+
+    def test_recover_returns_written_entries_in_order(self) -> None:
+        spool = Spool(self.dir)
+        first = spool.write(_META, b"Subject: one\n\nbody\n")
+        spool.write(_META, b"Subject: two\n\nbody\n")
+        with open(os.path.join(self.dir, "partial.msg.tmp"), "wb") as f:
+            f.write(b"{}\n")
+
+        entries = Spool(self.dir).recover()
+        self.assertEqual([e.spool_id for e in entries][0], first.spool_id)
+        self.assertEqual(len(entries), 2)
+        self.assertEqual(entries[0].meta, _META)
+        self.assertEqual(spool.read(entries[1]), b"Subject: two\n\nbody\n")
+        self.assertFalse(os.path.exists(os.path.join(self.dir, "partial.msg.tmp")))
+
+    def test_remove_leaves_a_locked_file_for_recovery(self) -> None:
+        spool = Spool(self.dir)
+        entry = spool.write(_META, b"Subject: one\n\nbody\n")
+        with mock.patch("smtp_relay.spool.os.remove", side_effect=PermissionError(13, "in use")):
+            spool.remove(entry)
+        self.assertEqual([e.spool_id for e in spool.recover()], [entry.spool_id])
+        spool.remove(entry)
+        spool.remove(entry)  # already gone
+        self.assertEqual(spool.recover(), [])
+
+    def test_writer_spills_past_threshold(self) -> None:
+        spool = Spool(self.dir, spill_threshold=64)
+        w = spool.writer(_META)
+        lines = [b"Subject: big", b""] + [b"x" * 30] * 10
+        for line in lines:
+            w.append_line(line)
+        raw = b"".join(line + b"\n" for line in lines)
+        self.assertTrue(w.spilled)
+        self.assertEqual(w.headers, b"Subject: big\n")
+        self.assertEqual(w.size, len(raw))
+        self.assertEqual(w.sha256, hashlib.sha256(raw).hexdigest())
+
+        entry = w.commit()
+        self.assertEqual(spool.read(entry), raw)
+        self.assertEqual(spool.scan(entry),
+                         (b"Subject: big\n", hashlib.sha256(raw).hexdigest(), len(raw)))
+
+    def test_discard_removes_partial_file(self) -> None:
+        spool = Spool(self.dir, spill_threshold=1)
+        w = spool.writer(_META)
+        w.append_line(b"partial")
+        w.discard()
+        self.assertEqual(os.listdir(self.dir), ["failed"])
+
+    def test_remove_and_move_to_failed(self) -> None:
+        spool = Spool(self.dir)
+        a = spool.write(_META, b"a\n")
+        b = spool.write(_META, b"b\n")
+        spool.remove(a)
+        spool.move_to_failed(b)
+        self.assertEqual(spool.recover(), [])
+        self.assertEqual(os.listdir(os.path.join(self.dir, "failed")),
+                         [b.spool_id + ".msg"])
+
+
+class TestDeliveryScheduler(unittest.TestCase):
+    def setUp(self) -> None:
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.spool = Spool(tmp.name)
+        self.store = MessageStore(max_store=10)
+        self.pool = _FakePool()
+        self.reactor = MemoryReactorClock()
+        cfg = make_config(add_x_headers=False, retry_base_delay=10,
+                          retry_max_delay=40, retry_max_attempts=3)
+        self.scheduler = DeliveryScheduler(cfg, self.store, self.spool,  # type: ignore[arg-type]
+                                           self.pool, self.reactor)
+
+    def _submit(self) -> str:
+        entry = self.spool.write(_META, b"Subject: hi\n\nbody\n")
+        msg_id = self.store.add_received(peer="p", helo=None, envelope_from="a@x",
+                                         envelope_to=["b@y"], subject="hi",
+                                         raw_bytes=b"")
+        self.scheduler.submit(entry, msg_id)
+        return msg_id
+
+    def test_retries_temporary_failure_then_delivers(self) -> None:
+        msg_id = self._submit()
+        self.pool.sent[0][1].errback(smtp.SMTPConnectError(-1, "refused"))
+        self.assertIsNone(self.store.get(msg_id).relay_attempt)  # type: ignore[union-attr]
+        delay = self.reactor.getDelayedCalls()[0].getTime()
+        self.assertTrue(5 <= delay <= 10)
+
+        self.reactor.advance(delay)
+        self.assertEqual(len(self.pool.sent), 2)
+        self.pool.sent[1][1].callback(None)
+        item = self.store.get(msg_id)
+        self.assertTrue(item.relay_attempt.ok)  # type: ignore[union-attr]
+        self.assertEqual([stage for stage, _ in item.trace],  # type: ignore[union-attr]
+                         ["prepare", "retry", "prepare"])
+        self.assertIn("stage.retry.p99_ms", self.scheduler.timings.gauges())
+        self.assertEqual(self.spool.recover(), [])
+        self.assertEqual(self.scheduler.pending(), 0)
+
+    def test_permanent_failure_is_not_retried(self) -> None:
+        msg_id = self._submit()
+        self.pool.sent[0][1].errback(smtp.SMTPDeliveryError(550, "no such user"))
+        attempt = self.store.get(msg_id).relay_attempt  # type: ignore[union-attr]
+        self.assertFalse(attempt.ok)
+        self.assertEqual(self.reactor.getDelayedCalls(), [])
+        self.assertEqual(self.spool.recover(), [])
+
+    def test_splits_by_route_and_retries_only_failed_transactions(self) -> None:
+        cfg = make_config(add_x_headers=False, retry_base_delay=10, retry_max_delay=10)
+        routes = RoutingTable([RouteRule("@a.example", ("ops@a.example",), "a"),
+                               RouteRule("*", ())])
+        scheduler = DeliveryScheduler(cfg, self.store, self.spool,  # type: ignore[arg-type]
+                                      self.pool, self.reactor, routes=routes)
+        meta = InboundMeta(peer="p", helo=None, envelope_from="s@x",
+                           envelope_to=["x@a.example", "c@c.example", "y@a.example"])
+        msg_id = self.store.add_received(peer="p", helo=None, envelope_from="s@x",
+                                         envelope_to=meta.envelope_to, subject=None,
+                                         raw_bytes=b"")
+        scheduler.submit(self.spool.write(meta, b"Subject: hi\n\nbody\n"), msg_id)
+        self.assertEqual(self.pool.routes, [("a", ["ops@a.example"]),
+                                            (None, ["c@c.example"])])
+
+        self.pool.sent[0][1].callback(None)
+        self.pool.sent[1][1].errback(smtp.SMTPDeliveryError(451, "later"))
+        self.assertIsNone(self.store.get(msg_id).relay_attempt)  # type: ignore[union-attr]
+        self.reactor.advance(10)
+        self.assertEqual(self.pool.routes[2:], [(None, ["c@c.example"])])
+        self.pool.sent[2][1].callback(None)
+        self.assertTrue(self.store.get(msg_id).relay_attempt.ok)  # type: ignore[union-attr]
+
+    def test_requeue_retries_from_the_spool_until_queued(self) -> None:
+        entry = self.spool.write(_META, b"Subject: hi\n\nbody\n")
+        real = self.store.add_received
+        calls = []
+
+        def add_received(**kwargs):  # type: ignore[no-untyped-def]
+            calls.append(kwargs)
+            if len(calls) == 1:
+                raise OSError("disk")
+            return real(**kwargs)
+
+        with mock.patch.object(self.store, "add_received", add_received), \
+                mock.patch("smtp_relay.delivery.log.err") as err:
+            self.scheduler.requeue(entry)
+            self.assertEqual(self.scheduler.gauges(), {"requeue_waiting": 1})
+            self.reactor.advance(10)
+            err.assert_called_once()
+            self.assertEqual(self.pool.sent, [])
+            self.reactor.advance(20)
+        self.assertEqual(len(self.pool.sent), 1)
+        self.assertEqual(self.scheduler.gauges(), {"requeue_waiting": 0})
+        self.assertEqual(self.scheduler._metrics.requeued_messages.value, 1)
+        self.assertEqual(self.store.get("00000001").subject, "hi")  # type: ignore[union-attr]
+
+    def test_backoff_is_capped(self) -> None:
+        for attempts in range(1, 10):
+            self.assertLessEqual(self.scheduler.backoff(attempts), 40)
+
+    def test_duplicates_are_not_relayed_within_window(self) -> None:
+        cfg = make_config(add_x_headers=False, retry_max_attempts=1)
+        scheduler = DeliveryScheduler(cfg, self.store, self.spool,  # type: ignore[arg-type]
+                                      self.pool, self.reactor,
+                                      dedup=DedupCache(60, 100, self.reactor.seconds))
+        raw = b"Subject: hi\n\nbody\n"
+        sha256 = hashlib.sha256(raw).hexdigest()
+
+        def submit(meta: InboundMeta = _META) -> str:
+            entry = self.spool.write(meta, raw)
+            msg_id = self.store.add_received(peer="p", helo=None, envelope_from="a@x",
+                                             envelope_to=["b@y"], subject="hi",
+                                             raw_bytes=raw)
+            scheduler.submit(entry, msg_id, sha256=sha256)
+            return msg_id
+
+        first = submit()
+        second = submit()
+        self.assertEqual(len(self.pool.sent), 1)
+        self.assertEqual(self.store.get(second).status, "DUP")  # type: ignore[union-attr]
+        self.assertEqual(self.store.get(second).duplicate_of, first)  # type: ignore[union-attr]
+        self.assertEqual(self.store.stats().duplicate_total, 1)
+        # Kept until the original is delivered.
+        self.assertEqual(len(self.spool.recover()), 2)
+
+        # another recipient is a different message
+        submit(InboundMeta(peer="p", helo=None, envelope_from="A@x", envelope_to=["c@y"]))
+        self.assertEqual(len(self.pool.sent), 2)
+
+        # a failed original has the waiting copy relayed instead
+        self.pool.sent[0][1].errback(smtp.SMTPDeliveryError(550, "no"))
+        self.assertEqual(len(self.pool.sent), 3)
+        third = submit()
+        self.assertEqual(self.store.get(third).duplicate_of, second)  # type: ignore[union-attr]
+        self.assertEqual(len(self.pool.sent), 3)
+
+        # delivering it drops the copies waiting on it, and later ones
+        self.pool.sent[2][1].callback(None)
+        self.assertTrue(self.store.get(second).relay_attempt.ok)  # type: ignore[union-attr]
+        self.assertEqual(len(self.spool.recover()), 1)
+        submit()
+        self.assertEqual(len(self.spool.recover()), 1)
+
+        self.reactor.advance(61)
+        submit()
+        self.assertEqual(len(self.pool.sent), 4)
+
+    def test_failed_original_promotes_a_waiting_duplicate_once(self) -> None:
+        cfg = make_config(add_x_headers=False, retry_max_attempts=1)
+        metrics = Metrics()
+        scheduler = DeliveryScheduler(cfg, self.store, self.spool,  # type: ignore[arg-type]
+                                      self.pool, self.reactor, metrics=metrics,
+                                      dedup=DedupCache(60, 100, self.reactor.seconds))
+        raw = b"Subject: hi\n\nbody\n"
+        ids = []
+        for _ in range(3):
+            entry = self.spool.write(_META, raw)
+            ids.append(self.store.add_received(peer="p", helo=None, envelope_from="a@x",
+                                               envelope_to=["b@y"], subject="hi",
+                                               raw_bytes=raw))
+            scheduler.submit(entry, ids[-1], sha256=hashlib.sha256(raw).hexdigest())
+        first, second, third = ids
+
+        self.pool.sent[0][1].errback(smtp.SMTPDeliveryError(550, "no"))
+        self.assertEqual(len(self.pool.sent), 2)
+        self.assertEqual(metrics.duplicate_messages.value, 2)
+        self.assertEqual(self.store.stats().duplicate_total, 2)
+        promoted = self.store.get(second)
+        assert promoted is not None
+        self.assertEqual(promoted.status, "PENDING")
+        self.assertIsNone(promoted.duplicate_of)
+        self.assertEqual(self.store.get(third).duplicate_of, second)  # type: ignore[union-attr]
+
+        self.pool.sent[1][1].callback(None)
+        self.assertTrue(self.store.get(second).relay_attempt.ok)  # type: ignore[union-attr]
+        self.assertEqual(self.store.get(third).status, "DUP")  # type: ignore[union-attr]
+        self.assertEqual(self.spool.recover(), [])
+        self.assertEqual(scheduler.pending(), 0)
@@ -0,0 +1,150 @@
+from __future__ import annotations
+
+import os
+import sqlite3
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from twisted.python.failure import Failure
+
+from smtp_relay.models import RelayAttempt, utc_now
+from smtp_relay.sqlite_store import SqliteMessageStore
+
+
+def _add(store: SqliteMessageStore, i: int) -> str:
+    return store.add_received(peer=f"10.0.0.{i % 2}:25", helo="h",
+                              envelope_from=f"s{i % 3}@x", envelope_to=["a@y", f"r{i}@y"],
+                              subject=f"report {i}", raw_bytes=b"x" * i)
+
+
+class _InlineReactor:
+    # Runs read callbacks on the store's thread; _wait() blocks for them.
+    @staticmethod
+    def callFromThread(f, *args):  # type: ignore[no-untyped-def]
+        f(*args)
+
+
+def _wait(d):  # type: ignore[no-untyped-def]
+    done = threading.Event()
+    out: list = []
+    d.addBoth(lambda r: (out.append(r), done.set()))
+    done.wait(10)
+    if isinstance(out[0], Failure):
+        out[0].raiseException()
+    return out[0]
+
+
+class TestSqliteStore(unittest.TestCase):
+    def setUp(self) -> None:
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        self.path = os.path.join(self.dir.name, "history.db")
+
+    def _open(self, **kw) -> SqliteMessageStore:  # type: ignore[no-untyped-def]
+        store = SqliteMessageStore(self.path, max_store=10, reactor=_InlineReactor(), **kw)
+        self.addCleanup(store.close)
+        return store
+
+    def test_history_outlives_ring_and_restart(self) -> None:
+        store = self._open()
+        for i in range(1, 31):
+            _add(store, i)
+        store.set_relay_attempt("00000004", RelayAttempt(
+            started_at=utc_now(), finished_at=utc_now(), ok=False, error="550 no"))
+        store.close()
+
+        store = self._open()
+        self.assertEqual(store.stats().stored_count, 30)
+        self.assertEqual(_add(store, 31), "00000031")
+
+        self.assertIsNone(store.get("00000004"))  # only the ring is read inline
+        old = _wait(store.fetch("00000004"))
+        assert old is not None and old.relay_attempt is not None
+        self.assertEqual((old.envelope_to, old.size_bytes, old.relay_attempt.error),
+                         (["a@y", "r4@y"], 4, "550 no"))
+
+        items, cursor = _wait(store.fetch_page(None, 5))
+        self.assertEqual([m.message_id for m in items],
+                         ["00000031", "00000030", "00000029", "00000028", "00000027"])
+        items, cursor = _wait(store.fetch_page(cursor, 100))
+        self.assertEqual((len(items), items[-1].message_id, cursor), (26, "00000001", None))
+
+        def ids(**kw):  # type: ignore[no-untyped-def]
+            return [int(m.message_id) for m in _wait(store.fetch_page(None, 100, **kw))[0]]
+
+        self.assertEqual(ids(status="FAIL"), [4])
+        self.assertEqual(ids(sender="S1@X", peer="10.0.0.0"), [28, 22, 16, 10, 4])
+        self.assertEqual(ids(recipient="r7@y"), [7])
+        self.assertEqual(ids(text="report 3"), [3])
+        self.assertEqual(len(ids(since=old.received_at)), 28)
+        items, cursor = _wait(store.fetch_page(None, 2, sender="s0@x"))
+        self.assertEqual(([m.message_id for m in items], cursor), (["00000030", "00000027"], 27))
+        self.assertEqual(ids(status="PENDING", sender="s2@x"), [29, 26, 23, 20, 17, 14, 11, 8, 5, 2])
+
+    def test_retention_by_rows(self) -> None:
+        store = self._open(retention_rows=5)
+        for i in range(1, 21):
+            _add(store, i)
+        store.close()
+        store = self._open(retention_rows=5)
+        _wait(store.flush())
+        self.assertIsNone(_wait(store.fetch("00000015")))
+        self.assertEqual([m.message_id for m in _wait(store.fetch_page(None, 10))[0]],
+                         [f"{i:08d}" for i in range(20, 15, -1)])
+
+    def test_duplicates_keep_their_own_column(self) -> None:
+        store = self._open()
+        for i in range(1, 13):
+            _add(store, i)
+        store.set_duplicate("00000012", "00000011")
+        _wait(store.flush())
+        store.set_duplicate("00000001", "00000002")  # already written
+        store.set_duplicate("00000003", "00000002")
+        store.relink_duplicate("00000003", None)  # relayed itself after all
+        store.close()
+
+        store = self._open()
+        for seq, original in (("00000012", "00000011"), ("00000001", "00000002")):
+            dup = _wait(store.fetch(seq))
+            self.assertEqual((dup.status, dup.duplicate_of, dup.relay_attempt),
+                             ("DUP", original, None))
+        self.assertEqual([int(m.message_id) for m in
+                          _wait(store.fetch_page(None, 100, status="DUP"))[0]], [12, 1])
+        promoted = _wait(store.fetch("00000003"))
+        self.assertEqual((promoted.status, promoted.duplicate_of), ("PENDING", None))
+
+    def test_migrates_duplicates_out_of_error(self) -> None:
+        conn = sqlite3.connect(self.path)
+        conn.executescript("""
+            CREATE TABLE messages (seq INTEGER PRIMARY KEY, received_ns INTEGER NOT NULL,
+                peer TEXT NOT NULL, peer_host TEXT NOT NULL COLLATE NOCASE, helo TEXT,
+                envelope_from TEXT NOT NULL COLLATE NOCASE, envelope_to TEXT NOT NULL,
+                subject TEXT, size_bytes INTEGER NOT NULL, sha256 TEXT NOT NULL,
+                status INTEGER NOT NULL DEFAULT 0, relay_started_ns INTEGER,
+                relay_finished_ns INTEGER, error TEXT);
+        """)
+        conn.execute("INSERT INTO messages VALUES (1, 1, 'p', 'p', 'h', 'a@x', 'b@y', 's',"
+                     " 1, 'ab', 3, NULL, NULL, '00000007')")
+        conn.commit()
+        conn.close()
+
+        store = self._open()
+        dup = _wait(store.fetch("00000001"))
+        self.assertEqual((dup.status, dup.duplicate_of), ("DUP", "00000007"))
+
+    def test_failed_batch_is_written_row_by_row(self) -> None:
+        store = self._open()
+        conn = sqlite3.connect(self.path)
+        self.addCleanup(conn.close)
+        conn.execute("CREATE TRIGGER reject BEFORE INSERT ON messages"
+                     " WHEN NEW.subject = 'report 2' BEGIN SELECT RAISE(ABORT, 'no'); END")
+        conn.commit()
+        with mock.patch("smtp_relay.sqlite_store.log.err"):
+            for i in range(1, 4):
+                _add(store, i)
+            _wait(store.flush())
+        self.assertEqual(conn.execute("SELECT seq FROM messages ORDER BY seq").fetchall(),
+                         [(1,), (3,)])
+        self.assertEqual(store.stats().gauges["history_dropped_writes"], 1)
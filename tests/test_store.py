@@ -1,7 +1,9 @@
 from __future__ import annotations
 
 import unittest
+from unittest import mock
 
+from smtp_relay.models import RelayAttempt, utc_now
 from smtp_relay.store import MessageStore
 
 
@@ -20,3 +22,112 @@ class TestStore(unittest.TestCase):
         self.assertEqual(s.stats().stored_count, 10)
         self.assertIsNotNone(s.get("00000020"))
         self.assertIsNone(s.get("00000001"))
+
+    def test_page_walks_newest_first_with_cursor(self) -> None:
+        s = MessageStore(max_store=10)
+        for i in range(25):
+            s.add_received(peer="p", helo=None, envelope_from="a",
+                           envelope_to=["b"], subject=None, raw_bytes=b"x")
+        items, cursor = s.page(None, 4)
+        self.assertEqual([m.message_id for m in items],
+                         ["00000025", "00000024", "00000023", "00000022"])
+        self.assertEqual(cursor, 22)
+        seen = [m.message_id for m in items]
+        while cursor is not None:
+            items, cursor = s.page(cursor, 4)
+            seen += [m.message_id for m in items]
+        self.assertEqual(seen, [f"{n:08d}" for n in range(25, 15, -1)])
+        self.assertEqual(s.page(3, 4), ([], None))
+        self.assertEqual(MessageStore(max_store=10).page(None, 4), ([], None))
+
+    def test_relay_update_in_place_and_round_trip(self) -> None:
+        s = MessageStore(max_store=10)
+        msg_id = s.add_received(peer="[::1]:2525", helo=None, envelope_from="a@x",
+                                envelope_to=["b@y", "c@y"], subject="hi",
+                                raw_bytes=b"hello")
+        item = s.get(msg_id)
+        assert item is not None
+        self.assertEqual((item.peer, item.helo, item.envelope_to, item.size_bytes),
+                         ("[::1]:2525", None, ["b@y", "c@y"], 5))
+        self.assertIsNone(item.relay_attempt)
+
+        started = utc_now()
+        s.set_relay_attempt(msg_id, RelayAttempt(started_at=started, finished_at=None,
+                                                 ok=False, error="boom"))
+        item = s.get(msg_id)
+        assert item is not None and item.relay_attempt is not None
+        self.assertEqual(item.relay_attempt.error, "boom")
+        self.assertIsNone(item.relay_attempt.finished_at)
+        self.assertLess(abs((item.relay_attempt.started_at - started).total_seconds()), 1e-3)
+        self.assertEqual(s.stats().relayed_fail_total, 1)
+
+    def test_evicted_strings_are_released(self) -> None:
+        s = MessageStore(max_store=10)
+        for i in range(30):
+            s.add_received(peer=f"10.0.0.{i}:25", helo="h", envelope_from=f"s{i}",
+                           envelope_to=["b"], subject=None, raw_bytes=b"x")
+        # 10 live peers + 10 senders, plus the shared helo and recipients
+        self.assertEqual(len(s._strings), 22)
+        self.assertIsNone(s.get("00000020"))
+        self.assertEqual(s.get("00000021").envelope_from, "s20")  # type: ignore[union-attr]
+
+    def test_query_filters_and_stays_consistent_on_eviction(self) -> None:
+        s = MessageStore(max_store=20)
+        for i in range(50):
+            s.add_received(peer=f"10.0.0.{i % 3}:25", helo="h",
+                           envelope_from="Alice@x" if i % 2 else "bob@x",
+                           envelope_to=["b@y", f"r{i % 5}@y"],
+                           subject=f"Invoice {i % 4} ready", raw_bytes=b"x")
+        fail = RelayAttempt(started_at=utc_now(), finished_at=utc_now(), ok=False, error="e")
+        for seq in (33, 35, 40, 45, 48):
+            s.set_relay_attempt(f"{seq:08d}", fail)
+        s.set_relay_attempt("00000045", RelayAttempt(
+            started_at=utc_now(), finished_at=utc_now(), ok=True, error=None))
+
+        def ids(**kw):  # type: ignore[no-untyped-def]
+            return [int(m.message_id) for m in s.query(None, 100, **kw)[0]]
+
+        live = range(50, 30, -1)
+        self.assertEqual(ids(sender="alice@X"), [n for n in live if n % 2 == 0])
+        self.assertEqual(ids(status="fail"), [48, 40, 35, 33])
+        self.assertEqual(ids(status="FAIL", sender="alice@x"), [48, 40])
+        self.assertEqual(ids(recipient="r3@y", peer="10.0.0.0"),
+                         [n for n in live if (n - 1) % 5 == 3 and (n - 1) % 3 == 0])
+        self.assertEqual(ids(text="ready INVOICE 2"), [n for n in live if (n - 1) % 4 == 2])
+        self.assertEqual(ids(status="PENDING", sender="bob@x", text="invoice 0"),
+                         [49, 41, 37])
+        self.assertEqual(ids(sender="nobody"), [])
+        with self.assertRaises(ValueError):
+            s.query(None, 10, status="LOST")
+
+        items, cursor = s.query(None, 2, sender="bob@x")
+        self.assertEqual(([m.message_id for m in items], cursor),
+                         (["00000049", "00000047"], 47))
+        self.assertEqual([int(m.message_id) for m in s.query(cursor, 2, sender="bob@x")[0]],
+                         [45, 43])
+
+        received = s.get("00000041").received_at  # type: ignore[union-attr]
+        self.assertEqual(ids(since=received, sender="bob@x"),
+                         [n for n in range(50, 40, -1) if n % 2])
+
+        # evicted messages leave no index entries behind
+        for i in range(20):
+            s.add_received(peer="z:1", helo="h", envelope_from="carol@x",
+                           envelope_to=["q@y"], subject="other", raw_bytes=b"x")
+        self.assertEqual(ids(sender="alice@x"), [])
+        self.assertEqual(ids(status="FAIL"), [])
+        self.assertEqual(len(s._index.sender), 1)
+        self.assertEqual(len(s._index.token), 1)
+        self.assertEqual(len(ids(status="pending", text="other")), 20)
+
+    def test_receive_times_do_not_go_back_with_the_clock(self) -> None:
+        s = MessageStore(max_store=10)
+        clock = iter([3_000_000_000, 1_000_000_000, 2_000_000_000, 4_000_000_000])
+        with mock.patch("smtp_relay.store.time.time_ns", lambda: next(clock)):
+            for i in range(4):
+                s.add_received(peer="p", helo="h", envelope_from="a@x",
+                               envelope_to=["b@y"], subject=None, raw_bytes=b"x")
+        received = [s.get(f"{n:08d}").received_at for n in range(1, 5)]  # type: ignore[union-attr]
+        self.assertEqual(received, sorted(received))
+        self.assertEqual([int(m.message_id) for m in
+                          s.query(None, 10, since=received[0])[0]], [4, 3, 2, 1])
@@ -0,0 +1,55 @@
+from __future__ import annotations
+
+import unittest
+
+from smtp_relay.tracing import MessageTrace, StageTimings
+
+
+class _Clock:
+    def __init__(self) -> None:
+        self.now = 100.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class TestMessageTrace(unittest.TestCase):
+    def test_stages_are_intervals_between_marks(self) -> None:
+        clock = _Clock()
+        trace = MessageTrace(clock=clock)
+        clock.now = 100.5
+        trace.mark("data")
+        # A mark from before the previous one counts as zero.
+        trace.mark("pool", 99.0)
+        trace.mark("connect", 101.0)
+        self.assertEqual(trace.stages(), (("data", 0.5), ("pool", 0.0), ("connect", 0.5)))
+
+    def test_join_keeps_the_slowest_fork(self) -> None:
+        clock = _Clock()
+        trace = MessageTrace(clock=clock)
+        trace.mark("parse")
+        fast, slow = trace.fork(), trace.fork()
+        clock.now = 101.0
+        fast.mark("reply")
+        clock.now = 103.0
+        slow.mark("reply")
+        trace.join([fast, slow])
+        self.assertEqual(trace.stages(), (("parse", 0.0), ("reply", 3.0)))
+
+
+class TestStageTimings(unittest.TestCase):
+    def test_percentiles_over_window(self) -> None:
+        timings = StageTimings(window=100)
+        self.assertEqual(timings.gauges(), {})
+        for ms in range(1, 201):
+            # Repeated stages (retries) add up per message.
+            timings.add((("reply", ms / 2000), ("reply", ms / 2000), ("unknown", 1.0)))
+        gauges = timings.gauges()
+        self.assertEqual(gauges["stage.reply.p50_ms"], 151)
+        self.assertEqual(gauges["stage.reply.p99_ms"], 200)
+        self.assertNotIn("stage.unknown.p50_ms", gauges)
+        self.assertNotIn("stage.data.p50_ms", gauges)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,87 @@
+from __future__ import annotations
+
+import json
+import unittest
+
+from smtp_relay.models import RelayAttempt, utc_now
+from smtp_relay.store import MessageStore
+from smtp_relay.workers import WorkerSupervisor, encode_event, worker_config
+
+from .util import make_config
+
+
+class TestWorkerEvents(unittest.TestCase):
+    def _worker_events(self, store: MessageStore) -> list:
+        events: list = []
+        store.subscribe(lambda event, item: events.append(
+            json.loads(encode_event(event, item))))
+        return events
+
+    def test_replays_worker_store_into_supervisor(self) -> None:
+        worker = MessageStore(max_store=10)
+        events = self._worker_events(worker)
+        local_id = worker.add_received(peer="p", helo="h", envelope_from="a",
+                                       envelope_to=["b"], subject="s",
+                                       raw_bytes=b"hello")
+        worker.set_relay_attempt(local_id, RelayAttempt(
+            started_at=utc_now(), finished_at=utc_now(), ok=False, error="boom"),
+            (("data", 0.5),))
+        dup_id = worker.add_received(peer="p", helo="h", envelope_from="a",
+                                     envelope_to=["b"], subject="s", raw_bytes=b"hello")
+        worker.set_duplicate(dup_id, local_id)
+
+        parent = MessageStore(max_store=10)
+        parent.add_received(peer="x", helo=None, envelope_from="x",
+                            envelope_to=["y"], subject=None, raw_bytes=b"")
+        sup = WorkerSupervisor(make_config(), parent, listen_fd=-1, count=0,
+                               reactor=object())
+        for event in events:
+            sup.apply(1, event)
+
+        stats = parent.stats()
+        self.assertEqual(stats.received_total, 3)
+        self.assertEqual(stats.relayed_fail_total, 1)
+        self.assertEqual(parent.get("00000003").duplicate_of, "00000002")  # type: ignore[union-attr]
+        item = parent.get("00000002")
+        assert item is not None and item.relay_attempt is not None
+        self.assertEqual(item.sha256, worker.get(local_id).sha256)  # type: ignore[union-attr]
+        self.assertEqual(item.subject, "s")
+        self.assertEqual(item.relay_attempt.error, "boom")
+        self.assertEqual(item.trace, (("data", 0.5),))
+
+    def test_same_local_id_from_different_workers(self) -> None:
+        parent = MessageStore(max_store=10)
+        sup = WorkerSupervisor(make_config(), parent, listen_fd=-1, count=0,
+                               reactor=object())
+        for index in (0, 1):
+            worker = MessageStore(max_store=10)
+            events = self._worker_events(worker)
+            local_id = worker.add_received(peer="p", helo=None, envelope_from="a",
+                                           envelope_to=["b"], subject=None,
+                                           raw_bytes=b"x")
+            worker.set_relay_attempt(local_id, RelayAttempt(
+                started_at=utc_now(), finished_at=utc_now(), ok=True, error=None))
+            for event in events:
+                sup.apply(index, event)
+        self.assertEqual(parent.stats().relayed_ok_total, 2)
+        for msg in parent.list_recent():
+            self.assertIsNotNone(msg.relay_attempt)
+
+    def test_sums_worker_stats(self) -> None:
+        parent = MessageStore(max_store=10)
+        sup = WorkerSupervisor(make_config(), parent, listen_fd=-1, count=0,
+                               reactor=object())
+        sup.apply(0, {"t": "stats", "gauges": {"smtp_connections": 3},
+                      "metrics": {"received_messages_total": 5}})
+        sup.apply(1, {"t": "stats", "gauges": {"smtp_connections": 4},
+                      "metrics": {"received_messages_total": 6}})
+        self.assertEqual(parent.stats().gauges["smtp_connections"], 7)
+        self.assertEqual(sup.metric_sources()[1],
+                         ({"worker": "1"}, {"received_messages_total": 6}))
+
+    def test_worker_config_splits_quotas(self) -> None:
+        cfg = worker_config(make_config(upstream_msgs_per_sec=4.0,
+                                        upstream_msgs_per_day=500), 3)
+        self.assertAlmostEqual(cfg.upstream_msgs_per_sec, 4.0 / 3)
+        self.assertEqual(cfg.upstream_msgs_per_day, 166)
+        self.assertEqual(cfg.upstream_rcpts_per_min, 0)
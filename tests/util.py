@@ -0,0 +1,23 @@
+from __future__ import annotations
+
+from smtp_relay.config import RelayConfig
+
+
+def make_config(**kw) -> RelayConfig:  # type: ignore[no-untyped-def]
+    base = dict(
+        smtp_listen_host="127.0.0.1",
+        smtp_listen_port=2525,
+        http_listen_host="127.0.0.1",
+        http_listen_port=8080,
+        gmail_host="upstream.example",
+        gmail_port=587,
+        gmail_username="u@example.com",
+        gmail_app_password="pw",
+        relay_from="u@example.com",
+        forward_to=["dest@example.com"],
+        allow_any_rcpt=True,
+        add_x_headers=True,
+        max_store=10,
+    )
+    base.update(kw)
+    return RelayConfig(**base)  # type: ignore[arg-type]